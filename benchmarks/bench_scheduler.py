@@ -0,0 +1,400 @@
+# coding=utf-8
+"""Benchmark the database scheduler.
+
+Generate N periodic tasks spread over interval, crontab and solar
+schedules, then measure:
+
+* ``load``: ``all_as_schedule()``, reading every enabled task
+* ``load_memory``: memory allocated by ``all_as_schedule()`` at its peak,
+  and still held by the loaded schedule
+* ``tick``: ``tick()`` latency, every task being due
+* ``sync``: ``sync()`` writing the run state of all the entries
+* ``schedule_changed``: ``schedule_changed()`` when nothing changed
+* ``reload``: reading the schedule again after one task changed
+
+Every case runs in its own process, so the engines, the caches and the
+peak memory of a case don't leak into the next one. The results are
+written as JSON to compare them between commits::
+
+    $ python benchmarks/bench_scheduler.py -n 1000,10000 -o before.json
+    $ git checkout my-branch
+    $ python benchmarks/bench_scheduler.py -n 1000,10000 -o after.json
+    $ python benchmarks/bench_scheduler.py --compare before.json after.json
+
+Use ``--postgres`` to run the cases against a local PostgreSQL database
+as well, its tables are dropped and created again by every case.
+"""
+
+import argparse
+import datetime as dt
+import gc
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+basedir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, basedir)
+
+import celery  # noqa: E402
+import sqlalchemy as sa  # noqa: E402
+from celery import Celery  # noqa: E402
+from sqlalchemy.pool import StaticPool  # noqa: E402
+
+from celery_sqlalchemy_scheduler import schedulers  # noqa: E402
+from celery_sqlalchemy_scheduler.models import (  # noqa: E402
+    PeriodicTask, IntervalSchedule, CrontabSchedule, SolarSchedule,
+)
+from celery_sqlalchemy_scheduler.session import ModelBase  # noqa: E402
+
+DEFAULT_SIZES = '1000,10000,100000'
+DEFAULT_BACKENDS = 'sqlite-file,sqlite-memory'
+
+# distinct schedule rows shared by the generated tasks
+INTERVALS = 50
+CRONTABS = 60
+SOLAR_EVENTS = ('sunrise', 'sunset', 'dawn_civil', 'dusk_civil', 'solar_noon')
+
+# rows per INSERT when generating the tasks
+INSERT_CHUNK = 5000
+
+# a last run far in the past makes every task due
+LONG_AGO = dt.datetime(2000, 1, 1)
+
+
+class BenchScheduler(schedulers.DatabaseScheduler):
+    """Scheduler counting the due tasks instead of sending them."""
+
+    sent = 0
+
+    def send_task(self, *args, **kwargs):
+        self.sent += 1
+        return SimpleNamespace(id=None)
+
+
+def summarize(samples):
+    """Return the statistics of a list of durations in seconds."""
+    samples = sorted(samples)
+    return {
+        'count': len(samples),
+        'min': samples[0],
+        'median': statistics.median(samples),
+        'mean': statistics.mean(samples),
+        'p95': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        'max': samples[-1],
+    }
+
+
+def timed(func, repeat=1):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def populate(engine, n):
+    """Create ``n`` periodic tasks, a third of them for every kind of
+    schedule, with core inserts.
+    """
+    ModelBase.metadata.drop_all(engine)
+    ModelBase.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(IntervalSchedule.__table__.insert(), [
+            {'id': i + 1, 'every': 60 + i, 'period': 'seconds'}
+            for i in range(INTERVALS)
+        ])
+        conn.execute(CrontabSchedule.__table__.insert(), [
+            {'id': i + 1, 'minute': str(i), 'hour': '*',
+             'day_of_week': '*', 'day_of_month': '*',
+             'month_of_year': '*', 'timezone': 'UTC'}
+            for i in range(CRONTABS)
+        ])
+        conn.execute(SolarSchedule.__table__.insert(), [
+            {'id': i + 1, 'event': event,
+             'latitude': 10.0 + i, 'longitude': 20.0 + i}
+            for i, event in enumerate(SOLAR_EVENTS)
+        ])
+        rows = []
+        for i in range(n):
+            row = {
+                'name': 'bench-{0}'.format(i),
+                'task': 'bench.noop',
+                'interval_id': None, 'crontab_id': None, 'solar_id': None,
+                'args': json.dumps([i]),
+                'kwargs': json.dumps({'n': i}),
+                'queue': 'bench',
+                'one_off': False,
+                'enabled': True,
+                'last_run_at': LONG_AGO,
+                'total_run_count': 0,
+                'description': '',
+            }
+            kind = i % 3
+            if kind == 0:
+                row['interval_id'] = i % INTERVALS + 1
+            elif kind == 1:
+                row['crontab_id'] = i % CRONTABS + 1
+            else:
+                row['solar_id'] = i % len(SOLAR_EVENTS) + 1
+            rows.append(row)
+            if len(rows) == INSERT_CHUNK:
+                conn.execute(PeriodicTask.__table__.insert(), rows)
+                rows = []
+        if rows:
+            conn.execute(PeriodicTask.__table__.insert(), rows)
+
+
+def make_app(dburi, options):
+    app = Celery('bench', broker='memory://')
+    app.conf.update(
+        timezone='UTC',
+        result_expires=None,
+        beat_schedule={},
+        beat_dburi=dburi,
+        beat_engine_options=options.get('engine_options'),
+        beat_load_strategy=options.get('load_strategy'),
+        beat_incremental_reload=options.get('incremental_reload'),
+        beat_change_notifier=options.get('change_notifier'),
+    )
+    return app
+
+
+def run_case(backend, n, options):
+    """Run the measurements of one backend and size, in this process."""
+    workdir = None
+    engine_options = None
+    if backend == 'sqlite-file':
+        workdir = tempfile.mkdtemp(prefix='bench-scheduler-')
+        dburi = 'sqlite:///' + os.path.join(workdir, 'schedule.db')
+    elif backend == 'sqlite-memory':
+        dburi = 'sqlite://'
+        # one connection for all, every new one is another empty database
+        engine_options = {'poolclass': StaticPool,
+                          'connect_args': {'check_same_thread': False}}
+    elif backend == 'postgres':
+        dburi = options['postgres']
+    else:
+        raise ValueError('Unknown backend {0!r}'.format(backend))
+    options = dict(options, engine_options=engine_options)
+
+    try:
+        app = make_app(dburi, options)
+        lazy = BenchScheduler(app=app, lazy=True)
+        start = time.perf_counter()
+        populate(lazy.engine, n)
+        result = {
+            'backend': backend,
+            'n': n,
+            'populate': time.perf_counter() - start,
+        }
+
+        lazy.all_as_schedule()  # warm up the caches of the mappers
+        gc.collect()
+        result['load'] = summarize(
+            timed(lazy.all_as_schedule, options['repeat']))
+
+        gc.collect()
+        tracemalloc.start()
+        schedule = lazy.all_as_schedule()
+        peak = tracemalloc.get_traced_memory()[1]
+        gc.collect()
+        result['load_memory'] = {
+            'entries': len(schedule),
+            'peak_bytes': peak,
+            # held by the schedule once the session is closed
+            'retained_bytes': tracemalloc.get_traced_memory()[0],
+        }
+        tracemalloc.stop()
+        del schedule
+
+        scheduler = BenchScheduler(app=app)
+        ticks = min(options['ticks'], n)
+        # the first tick builds the heap
+        result['first_tick'] = timed(scheduler.tick)[0]
+        result['tick'] = summarize(timed(scheduler.tick, ticks))
+        result['tick']['sent'] = scheduler.sent
+
+        schedule = scheduler.schedule
+        for name, entry in list(schedule.items()):
+            schedule[name] = scheduler.reserve(entry)
+        duration = timed(scheduler.sync)[0]
+        result['sync'] = {
+            'entries': n,
+            'seconds': duration,
+            'entries_per_second': n / duration if duration else None,
+        }
+
+        result['schedule_changed'] = summarize(
+            timed(scheduler.schedule_changed, options['repeat'] * 10))
+
+        with scheduler.session_scope() as session:
+            session.query(PeriodicTask).filter_by(
+                name='bench-0').one().description = 'changed'
+        reload_time = timed(lambda: scheduler.schedule)[0]
+        result['reload'] = {
+            'seconds': reload_time,
+            'incremental': bool(scheduler.incremental_reload),
+        }
+        scheduler.close_notifier()
+        return result
+    finally:
+        if workdir is not None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=basedir,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_all(args):
+    backends = args.backends.split(',')
+    if args.postgres:
+        backends.append('postgres')
+    results = []
+    for backend in backends:
+        for n in [int(size) for size in args.sizes.split(',')]:
+            print('{0} n={1}...'.format(backend, n), file=sys.stderr)
+            output = subprocess.check_output(
+                [sys.executable, os.path.abspath(__file__),
+                 '--case', '{0}:{1}'.format(backend, n)] +
+                case_arguments(args))
+            results.append(json.loads(output.decode()))
+    return {
+        'meta': {
+            'revision': git_revision(),
+            'date': dt.datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'celery': celery.__version__,
+            'sqlalchemy': sa.__version__,
+            'load_strategy': args.load_strategy,
+            'incremental_reload': args.incremental_reload,
+            'change_notifier': args.change_notifier,
+        },
+        'results': results,
+    }
+
+
+def case_arguments(args):
+    arguments = ['--repeat', str(args.repeat), '--ticks', str(args.ticks)]
+    if args.postgres:
+        arguments += ['--postgres', args.postgres]
+    if args.load_strategy:
+        arguments += ['--load-strategy', args.load_strategy]
+    if args.incremental_reload:
+        arguments.append('--incremental-reload')
+    if args.change_notifier:
+        arguments += ['--change-notifier', args.change_notifier]
+    return arguments
+
+
+def flatten(result, prefix=''):
+    """Yield the ``(metric, value)`` of a result, comparing medians."""
+    for key, value in result.items():
+        if isinstance(value, dict):
+            if 'median' in value:
+                yield prefix + key, value['median']
+            elif 'seconds' in value:
+                yield prefix + key, value['seconds']
+            else:
+                for field in ('peak_bytes', 'retained_bytes'):
+                    if field in value:
+                        yield prefix + key + '.' + field, value[field]
+        elif isinstance(value, float):
+            yield prefix + key, value
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    old_results = {(r['backend'], r['n']): r for r in old['results']}
+    print('{0:<14} {1:>7} {2:<26} {3:>12} {4:>12} {5:>7}'.format(
+        'backend', 'n', 'metric', 'old', 'new', 'ratio'))
+    for result in new['results']:
+        key = (result['backend'], result['n'])
+        if key not in old_results:
+            continue
+        old_metrics = dict(flatten(old_results[key]))
+        for metric, value in flatten(result):
+            before = old_metrics.get(metric)
+            if before is None:
+                continue
+            ratio = value / before if before else float('inf')
+            print('{0:<14} {1:>7} {2:<26} {3:>12.6g} {4:>12.6g} '
+                  '{5:>6.2f}x'.format(key[0], key[1], metric,
+                                      before, value, ratio))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '-n', '--sizes', default=DEFAULT_SIZES,
+        help='comma separated numbers of periodic tasks')
+    parser.add_argument(
+        '-b', '--backends', default=DEFAULT_BACKENDS,
+        help='comma separated backends: sqlite-file, sqlite-memory')
+    parser.add_argument(
+        '--postgres', metavar='DBURI',
+        help='run against this PostgreSQL database as well')
+    parser.add_argument(
+        '--repeat', type=int, default=5,
+        help='repetitions of the load measurement')
+    parser.add_argument(
+        '--ticks', type=int, default=1000,
+        help='number of ticks to measure')
+    parser.add_argument('--load-strategy')
+    parser.add_argument('--incremental-reload', action='store_true')
+    parser.add_argument('--change-notifier')
+    parser.add_argument(
+        '-o', '--output', help='write the results to this JSON file')
+    parser.add_argument(
+        '--compare', nargs=2, metavar=('OLD', 'NEW'),
+        help='compare two result files')
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    logging.disable(logging.WARNING)
+    if args.compare:
+        compare(*args.compare)
+        return
+    if args.case:
+        backend, n = args.case.rsplit(':', 1)
+        result = run_case(backend, int(n), {
+            'repeat': args.repeat,
+            'ticks': args.ticks,
+            'postgres': args.postgres,
+            'load_strategy': args.load_strategy,
+            'incremental_reload': args.incremental_reload,
+            'change_notifier': args.change_notifier,
+        })
+        json.dump(result, sys.stdout)
+        return
+
+    report = run_all(args)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
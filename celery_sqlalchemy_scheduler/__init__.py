@@ -5,6 +5,7 @@ from .session import SessionManager
 from .models import (
     PeriodicTask, PeriodicTaskChanged,
     CrontabSchedule, IntervalSchedule,
-    SolarSchedule,
+    SolarSchedule, BeatLease,
 )
 from .schedulers import DatabaseScheduler
+from .async_schedulers import AsyncDatabaseScheduler
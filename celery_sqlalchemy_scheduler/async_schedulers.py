@@ -0,0 +1,279 @@
+# coding=utf-8
+"""Database scheduler doing its database I/O on an asyncio event loop.
+
+The beat loop of :class:`AsyncDatabaseScheduler` only sends the tasks due.
+Checking the schedule for changes, reloading it and saving the run state
+are jobs run one after the other by an event loop in a thread of its own,
+so a slow database doesn't delay the tasks due.
+
+With SQLAlchemy 1.4 or later and ``beat_async_dburi`` (for instance
+``sqlite+aiosqlite:///schedule.db`` or ``postgresql+asyncpg://...``) the
+jobs use an asyncio engine. Otherwise, and always with SQLAlchemy 1.3, they
+block the thread of the event loop, using the engine of ``beat_dburi``.
+"""
+
+import asyncio
+import threading
+from concurrent.futures import Future, TimeoutError
+from functools import partial
+from multiprocessing.util import Finalize
+
+from celery.utils.log import get_logger
+
+from .schedulers import DatabaseScheduler
+
+try:
+    from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+except ImportError:  # SQLAlchemy < 1.4
+    AsyncSession = create_async_engine = None
+
+logger = get_logger('celery_sqlalchemy_scheduler.async_schedulers')
+
+# How long closing the scheduler waits for the pending writes.
+STOP_TIMEOUT = 30  # seconds
+
+
+class AsyncDatabaseScheduler(DatabaseScheduler):
+    """Database scheduler keeping its database I/O off the beat loop.
+
+    The schedule is loaded by the beat loop when it starts. Afterwards the
+    event loop checks for changes every ``max_interval`` and hands the
+    reloaded schedule over to the next tick, and ``sync()`` queues the
+    dirty entries for the event loop to save. The run state of the tasks
+    sent while a reload was in flight is kept.
+
+    ``beat_shards``, ``beat_standby``, ``beat_claim_runs`` and
+    ``beat_write_behind`` are not supported.
+    """
+
+    def __init__(self, *args, **kwargs):
+        app = kwargs['app']
+        self.async_dburi = (kwargs.get('async_dburi') or
+                            app.conf.get('beat_async_dburi'))
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._loop = self._thread = self._jobs = None
+        self._closed = False
+        # handed over from the event loop to the next tick
+        self._reloaded = None
+        self._failed = set()
+        super(AsyncDatabaseScheduler, self).__init__(*args, **kwargs)
+        for option in ('shards', 'standby', 'claim_runs', 'write_behind'):
+            if getattr(self, option):
+                raise ValueError(
+                    'beat_{0} is not supported by {1}'.format(
+                        option, type(self).__name__))
+
+        self.async_engine = self.AsyncSession = None
+        if self.async_dburi:
+            if create_async_engine is None:
+                raise ImportError(
+                    'beat_async_dburi needs SQLAlchemy 1.4 or later')
+            self.async_engine = create_async_engine(
+                self.async_dburi, **self.engine_options)
+            self.AsyncSession = partial(
+                AsyncSession, self.async_engine, expire_on_commit=False)
+        # before the sync registered by DatabaseScheduler
+        self._finalize_loop = Finalize(self, self.close, exitpriority=5)
+
+    @property
+    def _tick_session(self):
+        # the session of the job running in the current thread, the
+        # beat loop and the event loop don't share their sessions
+        return getattr(self._local, 'session', None)
+
+    @_tick_session.setter
+    def _tick_session(self, session):
+        self._local.session = session
+
+    def tick(self, *args, **kwargs):
+        """override
+
+        Only send the tasks due, the event loop does the database I/O.
+        """
+        if self._loop is None and not self._closed:
+            self._start_loop()
+        self.metrics.flush()
+        with self.metrics.timer('tick_seconds'):
+            self._take_over_results()
+            if self.timing_wheel:
+                return self.wheel_tick()
+            # skip the session and the waits of DatabaseScheduler.tick
+            delay = super(DatabaseScheduler, self).tick(*args, **kwargs)
+            if self._batch is not None:
+                delay = self.batch_tick(delay)
+            return delay
+
+    @property
+    def schedule(self):
+        if self._initial_read:
+            return super(AsyncDatabaseScheduler, self).schedule
+        return self._schedule
+
+    def sync(self):
+        """override
+
+        Queue the dirty entries for the event loop to save them.
+        """
+        if self._loop is None:
+            return super(AsyncDatabaseScheduler, self).sync()
+        entries = []
+        while self._dirty:
+            name = self._dirty.pop()
+            entry = self._schedule.get(name)
+            if entry is not None:
+                entries.append(entry)
+        if not entries:
+            return
+        future = self._submit(partial(self._save, entries))
+        future.add_done_callback(partial(
+            self._saved, {entry.name for entry in entries}))
+
+    def close(self):
+        """Save the run state and stop the event loop."""
+        if self._loop is not None:
+            self.sync()
+            self._stop_loop()
+        # save what the event loop couldn't
+        super(AsyncDatabaseScheduler, self).close()
+
+    def _start_loop(self):
+        self._loop = asyncio.new_event_loop()
+        ready = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run_loop, args=(ready,),
+            name='celery-beat-db', daemon=True)
+        self._thread.start()
+        ready.wait()
+
+    def _run_loop(self, ready):
+        loop = self._loop
+        asyncio.set_event_loop(loop)
+        self._jobs = asyncio.Queue()
+        ready.set()
+        try:
+            loop.run_until_complete(self._serve())
+        finally:
+            loop.close()
+
+    def _stop_loop(self):
+        loop, self._loop = self._loop, None
+        self._closed = True
+        future = Future()
+        loop.call_soon_threadsafe(self._jobs.put_nowait, (None, future))
+        try:
+            # after the jobs queued before
+            future.result(STOP_TIMEOUT)
+        except TimeoutError:
+            logger.warning('DatabaseScheduler: The database jobs did not '
+                           'finish in %ds.', STOP_TIMEOUT)
+        self._thread.join(STOP_TIMEOUT)
+        with self._lock:
+            failed, self._failed = self._failed, set()
+        self._dirty |= failed
+
+    def _submit(self, job):
+        """Queue ``job`` for the event loop, returns its future."""
+        future = Future()
+        self._loop.call_soon_threadsafe(self._jobs.put_nowait, (job, future))
+        return future
+
+    async def _serve(self):
+        loop = asyncio.get_event_loop()
+        check_at = loop.time() + self.max_interval
+        while True:
+            try:
+                job, future = await asyncio.wait_for(
+                    self._jobs.get(), max(check_at - loop.time(), 0))
+            except asyncio.TimeoutError:
+                check_at = loop.time() + self.max_interval
+                job, future = self._check_schedule, None
+            if job is None:
+                if self.async_engine is not None:
+                    await self.async_engine.dispose()
+                future.set_result(None)
+                return
+            try:
+                result = await self._run_job(job)
+            except Exception as exc:
+                logger.exception('DatabaseScheduler: Database job failed: '
+                                 '%r', exc)
+                if future is not None:
+                    future.set_exception(exc)
+            else:
+                if future is not None:
+                    future.set_result(result)
+
+    async def _run_job(self, job):
+        """Run ``job`` in a session of its own, committed when it succeeds.
+        """
+        if self.AsyncSession is None:
+            # the thread of the loop is there for the jobs, and executors
+            # can't start threads once the interpreter shuts down
+            return self._run_sync_job(job)
+        async with self.AsyncSession() as session:
+            result = await session.run_sync(self._in_session, job)
+            await session.commit()
+        return result
+
+    def _run_sync_job(self, job):
+        with self.unit_of_work():
+            return job()
+
+    def _in_session(self, session, job):
+        self._tick_session = session
+        try:
+            return job()
+        finally:
+            self._tick_session = None
+
+    def _check_schedule(self):
+        """Load the changes of the schedule, for the next tick to apply."""
+        if self._reloaded is not None:
+            # the next tick didn't take the last reload yet
+            return
+        if self.schedule_changed():
+            logger.info('DatabaseScheduler: Schedule changed.')
+            incremental = self.incremental_reload
+        elif self.lookahead_expired():
+            logger.info('DatabaseScheduler: Lookahead window moved.')
+            incremental = False
+        else:
+            return
+        with self.metrics.timer('schedule_reload_seconds'):
+            if incremental:
+                reloaded = ('patch', self.changed_as_schedule())
+            else:
+                reloaded = ('load', self.all_as_schedule())
+        self.metrics.incr('schedule_reloads_total')
+        with self._lock:
+            self._reloaded = reloaded
+
+    def _save(self, entries):
+        with self.session_scope() as session:
+            self.Entry.save_many(session, entries)
+        logger.debug('%d entries save to database', len(entries))
+
+    def _saved(self, names, future):
+        if future.exception() is not None:
+            # retry later
+            with self._lock:
+                self._failed |= names
+
+    def _take_over_results(self):
+        """Apply the reload and retry the writes the event loop failed."""
+        with self._lock:
+            reloaded, self._reloaded = self._reloaded, None
+            failed, self._failed = self._failed, set()
+        self._dirty |= failed
+        if reloaded is None:
+            return
+        kind, changes = reloaded
+        if kind == 'patch':
+            self._keep_run_state(changes[0])
+            self._patch_schedule(changes)
+            return
+        self._keep_run_state(changes)
+        old, self._schedule = self._schedule, changes
+        self._save_next_run_at(changes.values())
+        self._reindex(old)
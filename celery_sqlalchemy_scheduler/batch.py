@@ -0,0 +1,131 @@
+# coding=utf-8
+"""Due checks of the interval entries, done for all of them at once.
+
+With ``beat_batch_intervals`` the entries of plain interval schedules are
+kept out of the heap of ``Scheduler.tick``: :class:`IntervalBatch` holds
+the time of their last run and their period as columns, and finds the
+entries due and the time until the next one with one pass over them,
+with NumPy when it is installed. The other entries go through the heap
+and their own ``is_due()``.
+"""
+
+import time
+from array import array
+from functools import partial
+from itertools import compress, count
+from operator import add, ge
+
+try:
+    import numpy
+except ImportError:  # the columns are arrays of the stdlib then
+    numpy = None
+
+INFINITY = float('inf')
+
+# The slots allocated at first, grown by doubling.
+INITIAL_CAPACITY = 64
+
+
+class IntervalBatch(object):
+    """The interval entries of the schedule, by slot.
+
+    ``last[slot] + period[slot]`` is when the entry in the slot is due.
+    The slots freed by :meth:`discard` never come due and are reused.
+    """
+
+    def __init__(self, use_numpy=True):
+        self.use_numpy = use_numpy and numpy is not None
+        self.entries = []
+        self.slots = {}
+        self._free = []
+        self.last = self._column(INITIAL_CAPACITY, 0.0)
+        self.period = self._column(INITIAL_CAPACITY, INFINITY)
+
+    def _column(self, size, value):
+        if self.use_numpy:
+            return numpy.full(size, value)
+        return array('d', [value]) * size
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, name):
+        return name in self.slots
+
+    def add(self, entry, due_at=None):
+        """Add the entry, or replace the one of the same name.
+
+        Returns False when the entry isn't a plain interval one, it
+        belongs to the heap then.
+
+        :param due_at: when the entry is due as an epoch, asked to its
+            schedule when not given.
+        """
+        seconds = entry.interval_seconds
+        if seconds is None:
+            self.discard(entry.name)
+            return False
+        if due_at is None:
+            due_at = time.time() + max(
+                entry.schedule.remaining_estimate(
+                    entry.last_run_at).total_seconds(), 0)
+        slot = self.slots.get(entry.name)
+        if slot is None:
+            slot = self._allocate()
+            self.slots[entry.name] = slot
+        self.entries[slot] = entry
+        self.last[slot] = due_at - seconds
+        self.period[slot] = seconds
+        return True
+
+    def discard(self, name):
+        slot = self.slots.pop(name, None)
+        if slot is None:
+            return
+        self.entries[slot] = None
+        self.last[slot] = 0.0
+        self.period[slot] = INFINITY
+        self._free.append(slot)
+
+    def _allocate(self):
+        if self._free:
+            return self._free.pop()
+        slot = len(self.entries)
+        if slot == len(self.period):
+            self.last = self._grow(self.last, 0.0)
+            self.period = self._grow(self.period, INFINITY)
+        self.entries.append(None)
+        return slot
+
+    def _grow(self, column, value):
+        extra = self._column(len(column), value)
+        if self.use_numpy:
+            return numpy.concatenate((column, extra))
+        column.extend(extra)
+        return column
+
+    def due(self, now):
+        """Return the entries due at ``now``, an epoch."""
+        size = len(self.entries)
+        if self.use_numpy:
+            slots = numpy.flatnonzero(
+                self.last[:size] + self.period[:size] <= now).tolist()
+        else:
+            # iterated in C, no Python code by slot
+            slots = compress(count(), map(
+                partial(ge, now), map(add, self.last, self.period)))
+        entries = self.entries
+        return [entries[slot] for slot in slots]
+
+    def delay(self, now):
+        """Return the seconds until the first entry is due, or None when
+        there is none.
+        """
+        if not self.slots:
+            return None
+        size = len(self.entries)
+        if self.use_numpy:
+            due_at = float((self.last[:size] + self.period[:size]).min())
+        else:
+            due_at = min(map(add, self.last, self.period))
+        return max(due_at - now, 0)
@@ -0,0 +1,273 @@
+# coding=utf-8
+"""Coordination of the beats sharing one database.
+
+The beats hold leases in the ``celery_beat_lease`` table: a lease belongs
+to one beat until it expires, unless the beat renews it. The clocks of the
+hosts running the beats must be synchronized.
+"""
+
+import datetime as dt
+import hashlib
+import os
+import socket
+import time
+
+import sqlalchemy
+from sqlalchemy import or_
+from celery.utils.log import get_logger
+
+from .models import BeatLease
+from .session import session_scope
+
+logger = get_logger('celery_sqlalchemy_scheduler.coordination')
+
+DEFAULT_LEASE_TTL = 30  # seconds
+
+NODE_LEASE = 'node:{0}'
+SHARD_LEASE = 'shard:{0}'
+LEADER_LEASE = 'leader'
+
+# How often a standby tries to become the leader, at most.
+STANDBY_INTERVAL = 1  # seconds
+
+# The leases of the nodes which stopped are deleted after this
+# many lease periods.
+NODE_RETENTION = 10
+
+
+def default_node_id():
+    return '{0}:{1}'.format(socket.gethostname(), os.getpid())
+
+
+def ensure_leases(Session, names):
+    """Create the rows of the leases missing among ``names``."""
+    with session_scope(Session) as session:
+        existing = {name for name, in session.query(BeatLease.name).filter(
+            BeatLease.name.in_(names))}
+        for name in set(names) - existing:
+            session.add(BeatLease(name=name))
+
+
+def acquire(session, name, owner, ttl, now):
+    """Take the lease ``name`` if it is free or expired, or renew it.
+
+    Returns True when ``owner`` holds the lease.
+    """
+    return session.query(BeatLease).filter(
+        BeatLease.name == name,
+        or_(BeatLease.owner == owner,
+            BeatLease.owner.is_(None),
+            BeatLease.expires_at < now),
+    ).update({'owner': owner, 'expires_at': now + ttl},
+             synchronize_session=False) == 1
+
+
+def release(session, name, owner):
+    """Give up the lease ``name`` if ``owner`` holds it."""
+    session.query(BeatLease).filter_by(name=name, owner=owner).update(
+        {'owner': None, 'expires_at': None}, synchronize_session=False)
+
+
+class LeaseKeeper(object):
+    """Base class of the coordinators, renewing leases between ticks.
+
+    The leases are written in their own transactions, committed right
+    away, the other beats must not wait for the end of a tick to see them.
+    """
+
+    def __init__(self, Session, node_id=None, ttl=None):
+        self.Session = Session
+        self.node_id = node_id or default_node_id()
+        ttl = ttl or DEFAULT_LEASE_TTL
+        self.ttl = dt.timedelta(seconds=ttl)
+        # renew the leases well before they expire
+        self.interval = ttl / 3.0
+        self._next_refresh = 0
+        self._valid_until = 0
+
+    def refresh_due(self):
+        return time.monotonic() >= self._next_refresh
+
+    def refresh_in(self):
+        """Return the seconds until the leases have to be renewed."""
+        return max(self._next_refresh - time.monotonic(), 0)
+
+    def _renew(self, renew, lost):
+        """Call ``renew`` to renew the leases and return its result.
+
+        When the database can't be reached, return None while the leases
+        are still valid and ``lost`` once they have expired: other beats
+        may have taken them over by then.
+        """
+        started = time.monotonic()
+        self._next_refresh = started + self.interval
+        try:
+            result = renew()
+        except sqlalchemy.exc.SQLAlchemyError as exc:
+            logger.warning('Cannot renew the leases of beat %s: %r',
+                           self.node_id, exc)
+            if time.monotonic() < self._valid_until:
+                return None
+            return lost
+        self._valid_until = started + self.ttl.total_seconds()
+        return result
+
+
+class ShardCoordinator(LeaseKeeper):
+    """Share the periodic tasks between the beats running together.
+
+    The tasks are split in ``shards`` by their id. Every beat renews the
+    lease of its node, the shards are assigned to the live nodes by
+    rendezvous hashing, and a beat only schedules the shards it holds the
+    lease of. When a beat stops renewing its leases, its shards are taken
+    over by the others once they expire.
+    """
+
+    def __init__(self, Session, shards, node_id=None, ttl=None):
+        super(ShardCoordinator, self).__init__(Session, node_id, ttl)
+        self.shards = shards
+        self.owned = frozenset()
+        self._releasing = set()
+        self._prepared = False
+
+    @property
+    def node_lease(self):
+        return NODE_LEASE.format(self.node_id)
+
+    def refresh(self):
+        """Renew the leases, claim the shards assigned to this node and
+        give up the others once the schedule doesn't have them any more.
+
+        Returns True when the owned shards changed.
+        """
+        owned = self._renew(self._refresh, set())
+        if owned is None:
+            return False
+
+        self._releasing |= self.owned - owned
+        changed = owned != self.owned
+        self.owned = frozenset(owned)
+        if changed:
+            logger.info('Beat %s owns the shards %s of %d.', self.node_id,
+                        sorted(self.owned), self.shards)
+        return changed
+
+    def _refresh(self):
+        if not self._prepared:
+            ensure_leases(self.Session, [self.node_lease] + [
+                SHARD_LEASE.format(shard) for shard in range(self.shards)])
+            self._prepared = True
+
+        owned = set()
+        with session_scope(self.Session) as session:
+            now = dt.datetime.utcnow()
+            acquire(session, self.node_lease, self.node_id, self.ttl, now)
+            nodes = self.live_nodes(session, now)
+            for shard in range(self.shards):
+                if self.assign(nodes, shard) != self.node_id:
+                    continue
+                if acquire(session, SHARD_LEASE.format(shard),
+                           self.node_id, self.ttl, now):
+                    owned.add(shard)
+            session.query(BeatLease).filter(
+                BeatLease.name.like(NODE_LEASE.format('%')),
+                BeatLease.expires_at < now - self.ttl * NODE_RETENTION,
+            ).delete(synchronize_session=False)
+        return owned
+
+    def live_nodes(self, session, now):
+        nodes = {owner for owner, in session.query(BeatLease.owner).filter(
+            BeatLease.name.like(NODE_LEASE.format('%')),
+            BeatLease.expires_at >= now)}
+        nodes.add(self.node_id)
+        return nodes
+
+    @staticmethod
+    def assign(nodes, shard):
+        """Return the node the shard belongs to."""
+        return max(nodes, key=lambda node: hashlib.md5(
+            '{0}/{1}'.format(node, shard).encode('utf-8')).hexdigest())
+
+    def owns(self, task_id):
+        return task_id is not None and task_id % self.shards in self.owned
+
+    def release(self, shards=None):
+        """Give up the leases of the shards no longer owned, or of
+        ``shards``.
+        """
+        if shards is None:
+            shards, self._releasing = self._releasing, set()
+        if not shards:
+            return
+        try:
+            with session_scope(self.Session) as session:
+                for shard in shards:
+                    release(session, SHARD_LEASE.format(shard), self.node_id)
+        except sqlalchemy.exc.SQLAlchemyError as exc:
+            # they expire anyway
+            logger.warning('Cannot release the leases of the shards %s: %r',
+                           sorted(shards), exc)
+
+    def close(self):
+        """Give up all the leases, the others take over right away."""
+        self.release(set(self.owned) | self._releasing)
+        self.owned = frozenset()
+        self._releasing = set()
+        try:
+            with session_scope(self.Session) as session:
+                session.query(BeatLease).filter_by(
+                    name=self.node_lease).delete(synchronize_session=False)
+        except sqlalchemy.exc.SQLAlchemyError as exc:
+            logger.warning('Cannot delete the lease of beat %s: %r',
+                           self.node_id, exc)
+
+
+class LeaderElector(LeaseKeeper):
+    """Elect the beat sending the tasks among beats in hot standby.
+
+    The leader renews the ``leader`` lease, the beats standing by try to
+    take it every second or so and take over once it is released or
+    expired.
+    """
+
+    def __init__(self, Session, node_id=None, ttl=None):
+        super(LeaderElector, self).__init__(Session, node_id, ttl)
+        self.is_leader = False
+        self._prepared = False
+
+    def refresh(self):
+        """Renew or try to take the leader lease.
+
+        Returns True when this beat became the leader or stopped being it.
+        """
+        is_leader = self._renew(self._refresh, False)
+        if not is_leader:
+            self._next_refresh = time.monotonic() + min(
+                self.interval, STANDBY_INTERVAL)
+        if is_leader is None or is_leader == self.is_leader:
+            return False
+        self.is_leader = is_leader
+        if is_leader:
+            logger.info('Beat %s is the leader.', self.node_id)
+        else:
+            logger.info('Beat %s is standing by.', self.node_id)
+        return True
+
+    def _refresh(self):
+        if not self._prepared:
+            ensure_leases(self.Session, [LEADER_LEASE])
+            self._prepared = True
+        with session_scope(self.Session) as session:
+            return acquire(session, LEADER_LEASE, self.node_id, self.ttl,
+                           dt.datetime.utcnow())
+
+    def close(self):
+        """Give up the leadership, a standby takes over right away."""
+        if not self.is_leader:
+            return
+        self.is_leader = False
+        try:
+            with session_scope(self.Session) as session:
+                release(session, LEADER_LEASE, self.node_id)
+        except sqlalchemy.exc.SQLAlchemyError as exc:
+            logger.warning('Cannot release the leader lease: %r', exc)
@@ -0,0 +1,325 @@
+# coding=utf-8
+"""Metrics of the database scheduler.
+
+The scheduler records timers, counters and gauges with the sink set by
+``beat_metrics``. :class:`NullMetrics`, the default, records nothing and
+the scheduler skips measuring altogether; :class:`LoggingMetrics` logs a
+summary every ``beat_metrics_interval`` seconds and
+:class:`PrometheusMetrics` renders the Prometheus text format, served on
+``beat_metrics_port``.
+"""
+
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from celery.utils.imports import symbol_by_name
+from celery.utils.log import get_logger
+
+logger = get_logger('celery_sqlalchemy_scheduler.metrics')
+
+METRICS_SINKS = {
+    'null': 'celery_sqlalchemy_scheduler.metrics:NullMetrics',
+    'logging': 'celery_sqlalchemy_scheduler.metrics:LoggingMetrics',
+    'prometheus': 'celery_sqlalchemy_scheduler.metrics:PrometheusMetrics',
+}
+
+#: prefix of the Prometheus metric names
+PREFIX = 'celery_beat_'
+
+DEFAULT_LOG_INTERVAL = 60  # seconds
+
+#: upper bounds of the histogram buckets
+SECONDS_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5,
+                   1, 5, 10, 60)
+SIZE_BUCKETS = (1, 10, 100, 1000, 10000, 100000)
+BUCKETS = {
+    'sync_batch_size': SIZE_BUCKETS,
+}
+
+DESCRIPTIONS = {
+    'tick_seconds': 'Time spent in the ticks, waits excluded.',
+    'send_lag_seconds': 'Delay between the time a task was due and the '
+                        'time it was sent.',
+    'tasks_sent_total': 'Tasks sent.',
+    'is_due_seconds': 'Time spent checking whether an entry is due.',
+    'interval_batch_seconds': 'Time spent finding the interval entries '
+                              'due.',
+    'interval_batch_entries': 'Interval entries checked at once.',
+    'schedule_changed_seconds': 'Time spent checking for schedule '
+                                'changes.',
+    'schedule_reload_seconds': 'Time spent reloading the schedule.',
+    'schedule_reloads_total': 'Reloads of the schedule.',
+    'rows_loaded_total': 'Periodic task rows loaded.',
+    'schedule_entries': 'Entries of the schedule.',
+    'sync_seconds': 'Time spent saving the run state of the entries.',
+    'sync_batch_size': 'Entries saved by a sync.',
+    'entry_save_seconds': 'Time spent saving one entry, when the batch '
+                          'could not be saved.',
+    'queries_total': 'SQL statements executed.',
+    'claims_total': 'Runs the beat tried to claim.',
+    'claims_lost_total': 'Runs claimed by another beat first.',
+}
+
+
+def get_metrics(scheduler, name=None):
+    """Create the metrics sink ``name`` (an alias or a class path) for
+    the scheduler, falling back to no metrics when it can't be set up.
+    """
+    name = name or 'null'
+    try:
+        return symbol_by_name(name, METRICS_SINKS)(scheduler)
+    except Exception as exc:
+        if name == 'null':
+            raise
+        logger.warning('Cannot use metrics sink %r, metrics disabled: %r',
+                       name, exc)
+        return NullMetrics(scheduler)
+
+
+class Histogram(object):
+    """Count the observations by bucket, with their sum and maximum."""
+
+    __slots__ = ('buckets', 'counts', 'count', 'sum', 'max')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # the last one counts the observations above all the buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+
+class Timer(object):
+    """Observe the seconds spent in a ``with`` block."""
+
+    __slots__ = ('metrics', 'name', 'started')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.name, time.perf_counter() - self.started)
+
+
+class NullTimer(object):
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+class Metrics(object):
+    """Base class of the metrics sinks, keeping the metrics in memory.
+
+    The scheduler records from the beat loop and from its background
+    threads, the sinks read them from threads of their own.
+    """
+
+    #: False when nothing is recorded, the scheduler doesn't measure then.
+    enabled = True
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    def observe(self, name, value):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(
+                    BUCKETS.get(name, SECONDS_BUCKETS))
+            histogram.observe(value)
+
+    def timer(self, name):
+        """Return a context manager observing the seconds spent in it."""
+        return Timer(self, name)
+
+    def add_collector(self, collector):
+        """Call ``collector(metrics)`` before reading the metrics, to set
+        the gauges kept elsewhere.
+        """
+        self._collectors.append(collector)
+
+    def collect(self):
+        for collector in self._collectors:
+            try:
+                collector(self)
+            except Exception as exc:
+                logger.warning('Metrics collector %r failed: %r',
+                               collector, exc)
+
+    def flush(self):
+        """Called after every tick."""
+
+    def close(self):
+        pass
+
+
+class NullMetrics(Metrics):
+    """Record nothing."""
+
+    enabled = False
+
+    def incr(self, name, value=1):
+        pass
+
+    def set(self, name, value):
+        pass
+
+    def observe(self, name, value):
+        pass
+
+    def timer(self, name):
+        return NULL_TIMER
+
+    def add_collector(self, collector):
+        pass
+
+
+class LoggingMetrics(Metrics):
+    """Log a summary of the metrics every ``beat_metrics_interval``
+    seconds.
+    """
+
+    def __init__(self, scheduler):
+        super(LoggingMetrics, self).__init__(scheduler)
+        self.interval = (scheduler.app.conf.get('beat_metrics_interval') or
+                         DEFAULT_LOG_INTERVAL)
+        self._log_at = time.monotonic() + self.interval
+
+    def flush(self):
+        if time.monotonic() < self._log_at:
+            return
+        self._log_at = time.monotonic() + self.interval
+        self.log()
+
+    def log(self):
+        self.collect()
+        with self._lock:
+            parts = ['{0}={1}'.format(name, value) for name, value in
+                     sorted(self.counters.items())]
+            parts.extend('{0}={1}'.format(name, value) for name, value in
+                         sorted(self.gauges.items()))
+            for name, histogram in sorted(self.histograms.items()):
+                if not histogram.count:
+                    continue
+                parts.append('{0}: count={1} avg={2:.6g} max={3:.6g}'.format(
+                    name, histogram.count, histogram.sum / histogram.count,
+                    histogram.max))
+        logger.info('Beat metrics: %s', ', '.join(parts))
+
+    def close(self):
+        self.log()
+
+
+class PrometheusMetrics(Metrics):
+    """Render the metrics in the Prometheus text format.
+
+    With ``beat_metrics_port`` they are served on that port, otherwise
+    :meth:`render` is left to the application.
+    """
+
+    def __init__(self, scheduler):
+        super(PrometheusMetrics, self).__init__(scheduler)
+        self.server = None
+        port = scheduler.app.conf.get('beat_metrics_port')
+        if port:
+            self.server = HTTPServer(('', port), self._handler())
+            thread = threading.Thread(target=self.server.serve_forever,
+                                      name='celery-beat-metrics',
+                                      daemon=True)
+            thread.start()
+
+    def render(self):
+        """Return the metrics in the Prometheus text format."""
+        self.collect()
+        lines = []
+        with self._lock:
+            for name, value in sorted(self.counters.items()):
+                self._header(lines, name, 'counter')
+                lines.append('{0}{1} {2}'.format(PREFIX, name, value))
+            for name, value in sorted(self.gauges.items()):
+                self._header(lines, name, 'gauge')
+                lines.append('{0}{1} {2}'.format(PREFIX, name, value))
+            for name, histogram in sorted(self.histograms.items()):
+                self._header(lines, name, 'histogram')
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append('{0}{1}_bucket{{le="{2}"}} {3}'.format(
+                        PREFIX, name, bound, cumulative))
+                lines.append('{0}{1}_bucket{{le="+Inf"}} {2}'.format(
+                    PREFIX, name, histogram.count))
+                lines.append('{0}{1}_sum {2}'.format(
+                    PREFIX, name, histogram.sum))
+                lines.append('{0}{1}_count {2}'.format(
+                    PREFIX, name, histogram.count))
+        lines.append('')
+        return '\n'.join(lines)
+
+    @staticmethod
+    def _header(lines, name, kind):
+        description = DESCRIPTIONS.get(name)
+        if description:
+            lines.append('# HELP {0}{1} {2}'.format(PREFIX, name,
+                                                    description))
+        lines.append('# TYPE {0}{1} {2}'.format(PREFIX, name, kind))
+
+    def _handler(self):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
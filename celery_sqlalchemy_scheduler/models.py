@@ -1,29 +1,230 @@
 # coding=utf-8
 
 import datetime as dt
+import threading
+from collections import OrderedDict
+
 import pytz
 
 import sqlalchemy as sa
 from sqlalchemy import func
 from sqlalchemy.event import listen
-from sqlalchemy.orm import relationship, foreign, remote
+from sqlalchemy.orm import (
+    Session, foreign, make_transient_to_detached, object_session,
+    relationship, remote,
+)
+from sqlalchemy.orm.util import identity_key
 from sqlalchemy.sql import select, insert, update
 
 from celery import schedules
 from celery.utils.log import get_logger
 
 from .tzcrontab import TzAwareCrontab
+from .solar import CachedSolar
 from .session import ModelBase
+from .notifiers import notify_changed
 
 
 logger = get_logger('celery_sqlalchemy_scheduler.models')
 
+# How long the names of the deleted tasks are kept for the beats to drop
+# them, far longer than they take to reload. The database may stamp them
+# in its local time, a few hours off the UTC time they are purged by.
+DELETED_RETENTION = dt.timedelta(days=7)
+
 
 def cronexp(field):
     """Representation of cron expression."""
     return field and str(field).replace(' ', '') or '*'
 
 
+class ScheduleCache(object):
+    """Cache of the compiled schedules, shared by all the entries.
+
+    The compiled schedule of a row is kept under ``(table, id)`` together
+    with the column values it was compiled from, so a row changed by
+    another process is compiled again on its next access.
+    """
+
+    def __init__(self):
+        self._schedules = {}
+
+    def get(self, model):
+        if model.id is None:
+            return model.make_schedule()
+        key = (model.__tablename__, model.id)
+        version = model.schedule_version
+        try:
+            cached_version, schedule = self._schedules[key]
+        except KeyError:
+            pass
+        else:
+            if cached_version == version:
+                return schedule
+        schedule = model.make_schedule()
+        self._schedules[key] = (version, schedule)
+        return schedule
+
+    def invalidate(self, mapper, connection, target):
+        """
+        :param mapper: the Mapper which is the target of this event
+        :param connection: the Connection being used
+        :param target: the mapped instance being persisted
+        """
+        self._schedules.pop((target.__tablename__, target.id), None)
+
+    def clear(self):
+        self._schedules.clear()
+
+
+schedule_cache = ScheduleCache()
+
+# Ids of the schedule rows kept by ``from_schedule``.
+SCHEDULE_IDS_SIZE = 1024
+# The key of the ids found by the transaction in ``Session.info``.
+PENDING_SCHEDULE_IDS = 'celery_sqlalchemy_scheduler.schedule_ids'
+
+
+class ScheduleIds(object):
+    """Bounded LRU cache of the ids of the schedule rows by database and
+    spec, shared by the ``from_schedule`` of the schedule models.
+
+    A cached id is returned without reading the row: the row goes to the
+    session as it was when the id was cached. The ids are kept once the
+    transaction which found or inserted their row commits, and dropped
+    when the rows are updated or deleted in this process. The scheduler
+    forgets them all when another process changed the schedule, call
+    :meth:`clear` after editing the rows elsewhere otherwise.
+    """
+
+    def __init__(self, maxsize=SCHEDULE_IDS_SIZE):
+        self.maxsize = maxsize
+        self._ids = OrderedDict()
+        # (database, table, id) -> key of `_ids`
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def get_or_create(self, session, model_type, spec):
+        """Return the row of ``spec``, inserted when there is none.
+
+        The row is inserted in a SAVEPOINT and flushed, committing is up
+        to the caller. When another process inserts it first, the unique
+        index makes the insert fail and the row is read instead.
+        """
+        database = str(session.get_bind(model_type.__mapper__).url)
+        key = (database, model_type.__tablename__,
+               model_type.spec_key(spec))
+        model = self._get(session, model_type, key, spec)
+        if model is not None:
+            return model
+        model = session.query(model_type).filter_by(**spec).first()
+        if model is None:
+            model = model_type(**spec)
+            _begin_sqlite(session)
+            try:
+                with session.begin_nested():
+                    session.add(model)
+            except sa.exc.IntegrityError:
+                # a locking read sees the row committed by the other
+                # process under any isolation level
+                model = session.query(model_type).filter_by(
+                    **spec).with_for_update().one()
+        # a rollback may remove the row still
+        session.info.setdefault(PENDING_SCHEDULE_IDS, {})[key] = model.id
+        return model
+
+    def _get(self, session, model_type, key, spec):
+        with self._lock:
+            id_ = self._ids.get(key)
+            if id_ is None:
+                return None
+            self._ids.move_to_end(key)
+        model = session.identity_map.get(identity_key(model_type, id_))
+        if model is None:
+            model = model_type(id=id_, **spec)
+            make_transient_to_detached(model)
+            session.add(model)
+            return model
+        if model_type.spec_key(
+                {field: getattr(model, field) for field in spec}) == key[2]:
+            return model
+        # changed in the session, not flushed yet
+        with self._lock:
+            self._drop(key[:2], id_)
+        return None
+
+    def _put(self, key, id_):
+        with self._lock:
+            self._ids[key] = id_
+            self._ids.move_to_end(key)
+            self._keys[key[:2] + (id_,)] = key
+            while len(self._ids) > self.maxsize:
+                old_key, old_id = self._ids.popitem(last=False)
+                self._keys.pop(old_key[:2] + (old_id,), None)
+
+    def _drop(self, table, id_):
+        """:param table: the ``(database, table name)`` of the row"""
+        key = self._keys.pop(table + (id_,), None)
+        if key is not None:
+            self._ids.pop(key, None)
+
+    def invalidate(self, mapper, connection, target):
+        """
+        :param mapper: the Mapper which is the target of this event
+        :param connection: the Connection being used
+        :param target: the mapped instance being persisted
+        """
+        table = (str(connection.engine.url), target.__tablename__)
+        session = object_session(target)
+        if session is not None:
+            pending = session.info.get(PENDING_SCHEDULE_IDS)
+            if pending:
+                for key, id_ in list(pending.items()):
+                    if key[:2] == table and id_ == target.id:
+                        del pending[key]
+        with self._lock:
+            self._drop(table, target.id)
+
+    def committed(self, session):
+        """Keep the ids found by the transaction of ``session``."""
+        transaction = session.transaction
+        if transaction is not None and transaction.nested:
+            # a SAVEPOINT released
+            return
+        pending = session.info.pop(PENDING_SCHEDULE_IDS, None)
+        if pending:
+            for key, id_ in pending.items():
+                self._put(key, id_)
+
+    def rolled_back(self, session):
+        session.info.pop(PENDING_SCHEDULE_IDS, None)
+
+    def clear(self):
+        with self._lock:
+            self._ids.clear()
+            self._keys.clear()
+
+
+def _begin_sqlite(session):
+    """Begin the transaction of the session on SQLite.
+
+    pysqlite begins the transactions before the writes only, and the
+    RELEASE of a SAVEPOINT opened out of a transaction commits it.
+    """
+    connection = session.connection()
+    if connection.dialect.name != 'sqlite':
+        return
+    dbapi_connection = connection.connection.connection
+    if not getattr(dbapi_connection, 'in_transaction', True):
+        connection.execute('BEGIN')
+
+
+schedule_ids = ScheduleIds()
+
+
 class ModelMixin(object):
 
     @classmethod
@@ -38,7 +239,11 @@ class ModelMixin(object):
 
 class IntervalSchedule(ModelBase, ModelMixin):
     __tablename__ = 'celery_interval_schedule'
-    __table_args__ = {'sqlite_autoincrement': True}
+    __table_args__ = (
+        sa.Index('ix_celery_interval_schedule_spec', 'every', 'period',
+                 unique=True),
+        {'sqlite_autoincrement': True},
+    )
 
     DAYS = 'days'
     HOURS = 'hours'
@@ -58,6 +263,13 @@ class IntervalSchedule(ModelBase, ModelMixin):
 
     @property
     def schedule(self):
+        return schedule_cache.get(self)
+
+    @property
+    def schedule_version(self):
+        return (self.every, self.period)
+
+    def make_schedule(self):
         return schedules.schedule(
             dt.timedelta(**{self.period: self.every}),
             # nowfun=lambda: make_aware(now())
@@ -65,15 +277,18 @@ class IntervalSchedule(ModelBase, ModelMixin):
         )
 
     @classmethod
-    def from_schedule(cls, session, schedule, period=SECONDS):
+    def spec_from_schedule(cls, schedule, period=SECONDS):
         every = max(schedule.run_every.total_seconds(), 0)
-        model = session.query(IntervalSchedule).filter_by(
-            every=every, period=period).first()
-        if not model:
-            model = cls(every=every, period=period)
-            session.add(model)
-            session.commit()
-        return model
+        return {'every': every, 'period': period}
+
+    @classmethod
+    def spec_key(cls, spec):
+        return (spec['every'], spec['period'])
+
+    @classmethod
+    def from_schedule(cls, session, schedule, period=SECONDS):
+        return schedule_ids.get_or_create(
+            session, cls, cls.spec_from_schedule(schedule, period))
 
     @property
     def period_singular(self):
@@ -82,7 +297,12 @@ class IntervalSchedule(ModelBase, ModelMixin):
 
 class CrontabSchedule(ModelBase, ModelMixin):
     __tablename__ = 'celery_crontab_schedule'
-    __table_args__ = {'sqlite_autoincrement': True}
+    __table_args__ = (
+        sa.Index('ix_celery_crontab_schedule_spec', 'minute', 'hour',
+                 'day_of_week', 'day_of_month', 'month_of_year', 'timezone',
+                 unique=True),
+        {'sqlite_autoincrement': True},
+    )
 
     id = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
     minute = sa.Column(sa.String(60 * 4), default='*')
@@ -101,6 +321,14 @@ class CrontabSchedule(ModelBase, ModelMixin):
 
     @property
     def schedule(self):
+        return schedule_cache.get(self)
+
+    @property
+    def schedule_version(self):
+        return (self.minute, self.hour, self.day_of_week,
+                self.day_of_month, self.month_of_year, self.timezone)
+
+    def make_schedule(self):
         return TzAwareCrontab(
             minute=self.minute,
             hour=self.hour, day_of_week=self.day_of_week,
@@ -110,7 +338,7 @@ class CrontabSchedule(ModelBase, ModelMixin):
         )
 
     @classmethod
-    def from_schedule(cls, session, schedule):
+    def spec_from_schedule(cls, schedule):
         spec = {
             'minute': schedule._orig_minute,
             'hour': schedule._orig_hour,
@@ -122,17 +350,28 @@ class CrontabSchedule(ModelBase, ModelMixin):
             spec.update({
                 'timezone': schedule.tz.zone
             })
-        model = session.query(CrontabSchedule).filter_by(**spec).first()
-        if not model:
-            model = cls(**spec)
-            session.add(model)
-            session.commit()
-        return model
+        return spec
+
+    @classmethod
+    def spec_key(cls, spec):
+        # the fields are stored as strings, whatever they are given as
+        return tuple(str(spec[field]) for field in (
+            'minute', 'hour', 'day_of_week', 'day_of_month', 'month_of_year',
+        )) + (spec.get('timezone') or 'UTC',)
+
+    @classmethod
+    def from_schedule(cls, session, schedule):
+        return schedule_ids.get_or_create(
+            session, cls, cls.spec_from_schedule(schedule))
 
 
 class SolarSchedule(ModelBase, ModelMixin):
     __tablename__ = 'celery_solar_schedule'
-    __table_args__ = {'sqlite_autoincrement': True}
+    __table_args__ = (
+        sa.Index('ix_celery_solar_schedule_spec', 'event', 'latitude',
+                 'longitude', unique=True),
+        {'sqlite_autoincrement': True},
+    )
 
     id = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
 
@@ -142,7 +381,14 @@ class SolarSchedule(ModelBase, ModelMixin):
 
     @property
     def schedule(self):
-        return schedules.solar(
+        return schedule_cache.get(self)
+
+    @property
+    def schedule_version(self):
+        return (self.event, self.latitude, self.longitude)
+
+    def make_schedule(self):
+        return CachedSolar(
             self.event,
             self.latitude,
             self.longitude,
@@ -150,18 +396,22 @@ class SolarSchedule(ModelBase, ModelMixin):
         )
 
     @classmethod
-    def from_schedule(cls, session, schedule):
-        spec = {
+    def spec_from_schedule(cls, schedule):
+        return {
             'event': schedule.event,
             'latitude': schedule.lat,
             'longitude': schedule.lon
         }
-        model = session.query(SolarSchedule).filter_by(**spec).first()
-        if not model:
-            model = cls(**spec)
-            session.add(model)
-            session.commit()
-        return model
+
+    @classmethod
+    def spec_key(cls, spec):
+        return (spec['event'], float(spec['latitude']),
+                float(spec['longitude']))
+
+    @classmethod
+    def from_schedule(cls, session, schedule):
+        return schedule_ids.get_or_create(
+            session, cls, cls.spec_from_schedule(schedule))
 
     def __repr__(self):
         return '{0} ({1}, {2})'.format(
@@ -171,6 +421,40 @@ class SolarSchedule(ModelBase, ModelMixin):
         )
 
 
+class ScheduleResolver(object):
+    """Find or create the schedule rows of many schedules at once.
+
+    All the rows of the schedule tables are loaded up front, so resolving
+    doesn't query the database. New rows are added to the session and get
+    their ids on the next flush.
+    """
+
+    def __init__(self, session, model_types):
+        self.session = session
+        self._rows = {}
+        for model_type in model_types:
+            columns = [column.key for column in model_type.__table__.columns]
+            for row in session.query(model_type):
+                spec = {column: getattr(row, column) for column in columns}
+                self._rows[self._key(model_type, spec)] = row
+
+    def _key(self, model_type, spec):
+        try:
+            return model_type, model_type.spec_key(spec)
+        except (KeyError, TypeError, ValueError):
+            # incomplete rows never match a schedule
+            return model_type, id(spec)
+
+    def get(self, model_type, schedule):
+        spec = model_type.spec_from_schedule(schedule)
+        key = self._key(model_type, spec)
+        model = self._rows.get(key)
+        if model is None:
+            model = self._rows[key] = model_type(**spec)
+            self.session.add(model)
+        return model
+
+
 class PeriodicTaskChanged(ModelBase, ModelMixin):
     """Helper table for tracking updates to periodic tasks."""
 
@@ -206,6 +490,7 @@ class PeriodicTaskChanged(ModelBase, ModelMixin):
             s = connection.execute(update(PeriodicTaskChanged).
                                    where(PeriodicTaskChanged.id == 1).
                                    values(last_update=dt.datetime.now()))
+        notify_changed(connection, target)
 
     @classmethod
     def last_change(cls, session):
@@ -214,6 +499,43 @@ class PeriodicTaskChanged(ModelBase, ModelMixin):
             return periodic_tasks.last_update
 
 
+class PeriodicTaskDeleted(ModelBase, ModelMixin):
+    """The names of the periodic tasks deleted, so the incremental reloads
+    drop them without listing all the tasks.
+    """
+
+    __tablename__ = 'celery_periodic_task_deleted'
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    name = sa.Column(sa.String(255))
+    # stamped by the database, like ``PeriodicTask.date_changed``
+    date_deleted = sa.Column(sa.DateTime(timezone=True), index=True,
+                             default=func.now())
+
+    @classmethod
+    def deleted(cls, mapper, connection, target):
+        """
+        :param mapper: the Mapper which is the target of this event
+        :param connection: the Connection being used
+        :param target: the mapped instance being deleted
+        """
+        table = cls.__table__
+        connection.execute(table.delete().where(
+            table.c.date_deleted < dt.datetime.utcnow() - DELETED_RETENTION))
+        connection.execute(table.insert().values(
+            name=target.name, date_deleted=func.now()))
+
+    @classmethod
+    def deleted_since(cls, session, since=None):
+        """Return the ``(name, date_deleted)`` of the tasks deleted since
+        ``since``, all of them when it is None.
+        """
+        query = session.query(cls.name, cls.date_deleted)
+        if since is not None:
+            query = query.filter(cls.date_deleted >= since)
+        return query.all()
+
+
 class PeriodicTask(ModelBase, ModelMixin):
 
     __tablename__ = 'celery_periodic_task'
@@ -264,6 +586,9 @@ class PeriodicTask(ModelBase, ModelMixin):
     enabled = sa.Column(sa.Boolean(), default=True)
     last_run_at = sa.Column(sa.DateTime(timezone=True))
     total_run_count = sa.Column(sa.Integer(), nullable=False, default=0)
+    # when the task is due next, worked out by the scheduler,
+    # None when it isn't known yet or the task was edited since.
+    next_run_at = sa.Column(sa.DateTime(timezone=True), index=True)
     # 修改时间
     date_changed = sa.Column(sa.DateTime(timezone=True),
                              default=func.now(), onupdate=func.now())
@@ -300,15 +625,79 @@ class PeriodicTask(ModelBase, ModelMixin):
         raise ValueError('{} schedule is None!'.format(self.name))
 
 
+class BeatLease(ModelBase, ModelMixin):
+    """A named lease held by one beat at a time, until ``expires_at``.
+
+    The beats running together use them to tell they are alive and to
+    own their share of the periodic tasks.
+    """
+
+    __tablename__ = 'celery_beat_lease'
+
+    name = sa.Column(sa.String(255), primary_key=True)
+    owner = sa.Column(sa.String(255))
+    # UTC
+    expires_at = sa.Column(sa.DateTime(), index=True)
+
+    def __repr__(self):
+        return '{0.name}: {0.owner} until {0.expires_at}'.format(self)
+
+
+def reset_next_run_at(mapper, connection, target):
+    """Forget when an edited task is due, the scheduler works it out
+    again. The scheduler saving the run state doesn't count as an edit.
+
+    :param mapper: the Mapper which is the target of this event
+    :param connection: the Connection being used
+    :param target: the mapped instance being persisted
+    """
+    if not target.no_changes:
+        target.next_run_at = None
+
+
+def touch_periodic_tasks(field):
+    """Return a listener bumping ``date_changed`` of the tasks that use
+    the schedule row, so an incremental reload picks them up as well,
+    and resetting their ``next_run_at``.
+
+    :param field: the ``PeriodicTask`` column referring to the schedule
+    """
+    column = getattr(PeriodicTask, field)
+
+    def listener(mapper, connection, target):
+        PeriodicTaskChanged.update_changed(mapper, connection, target)
+        connection.execute(update(PeriodicTask).
+                           where(column == target.id).
+                           values(date_changed=func.now(),
+                                  next_run_at=None))
+    return listener
+
+
 listen(PeriodicTask, 'after_insert', PeriodicTaskChanged.update_changed)
 listen(PeriodicTask, 'after_delete', PeriodicTaskChanged.update_changed)
+listen(PeriodicTask, 'after_delete', PeriodicTaskDeleted.deleted)
 listen(PeriodicTask, 'after_update', PeriodicTaskChanged.changed)
+listen(PeriodicTask, 'before_update', reset_next_run_at)
 listen(IntervalSchedule, 'after_insert', PeriodicTaskChanged.update_changed)
-listen(IntervalSchedule, 'after_delete', PeriodicTaskChanged.update_changed)
-listen(IntervalSchedule, 'after_update', PeriodicTaskChanged.update_changed)
+listen(IntervalSchedule, 'after_delete', touch_periodic_tasks('interval_id'))
+listen(IntervalSchedule, 'after_update', touch_periodic_tasks('interval_id'))
 listen(CrontabSchedule, 'after_insert', PeriodicTaskChanged.update_changed)
-listen(CrontabSchedule, 'after_delete', PeriodicTaskChanged.update_changed)
-listen(CrontabSchedule, 'after_update', PeriodicTaskChanged.update_changed)
+listen(CrontabSchedule, 'after_delete', touch_periodic_tasks('crontab_id'))
+listen(CrontabSchedule, 'after_update', touch_periodic_tasks('crontab_id'))
 listen(SolarSchedule, 'after_insert', PeriodicTaskChanged.update_changed)
-listen(SolarSchedule, 'after_delete', PeriodicTaskChanged.update_changed)
-listen(SolarSchedule, 'after_update', PeriodicTaskChanged.update_changed)
+listen(SolarSchedule, 'after_delete', touch_periodic_tasks('solar_id'))
+listen(SolarSchedule, 'after_update', touch_periodic_tasks('solar_id'))
+listen(IntervalSchedule, 'after_delete', schedule_cache.invalidate)
+listen(IntervalSchedule, 'after_update', schedule_cache.invalidate)
+listen(CrontabSchedule, 'after_delete', schedule_cache.invalidate)
+listen(CrontabSchedule, 'after_update', schedule_cache.invalidate)
+listen(SolarSchedule, 'after_delete', schedule_cache.invalidate)
+listen(SolarSchedule, 'after_update', schedule_cache.invalidate)
+listen(Session, 'after_commit', schedule_ids.committed)
+listen(Session, 'after_rollback', schedule_ids.rolled_back)
+listen(IntervalSchedule, 'after_delete', schedule_ids.invalidate)
+listen(IntervalSchedule, 'after_update', schedule_ids.invalidate)
+listen(CrontabSchedule, 'after_delete', schedule_ids.invalidate)
+listen(CrontabSchedule, 'after_update', schedule_ids.invalidate)
+listen(SolarSchedule, 'after_delete', schedule_ids.invalidate)
+listen(SolarSchedule, 'after_update', schedule_ids.invalidate)
@@ -0,0 +1,323 @@
+# coding=utf-8
+"""Change notification backends for the database scheduler.
+
+The scheduler asks its notifier whether the schedule changed on every tick.
+:class:`PollingNotifier` queries ``PeriodicTaskChanged`` like it always did,
+the other notifiers get told about changes by the processes writing to the
+periodic task tables, so checking them doesn't hit the database.
+"""
+
+import errno
+import os
+import select
+import socket
+import stat
+import time
+import uuid
+
+from celery.utils.imports import symbol_by_name
+from celery.utils.log import get_logger
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session, object_session
+
+logger = get_logger('celery_sqlalchemy_scheduler.notifiers')
+
+#: channel used by ``LISTEN``/``NOTIFY`` on PostgreSQL
+PG_CHANNEL = 'celery_periodic_task_changed'
+
+#: suffix of the directory of the UNIX sockets of the beats, next to the
+#: SQLite database file
+LOCAL_SOCKET_SUFFIX = '.notify'
+
+NOTIFIERS = {
+    'polling': 'celery_sqlalchemy_scheduler.notifiers:PollingNotifier',
+    'postgres': 'celery_sqlalchemy_scheduler.notifiers:PostgresNotifier',
+    'local': 'celery_sqlalchemy_scheduler.notifiers:LocalNotifier',
+}
+
+
+def local_socket_path(url):
+    """Return the path of the directory of the notification sockets of a
+    SQLite database, or None when the database isn't a SQLite file.
+    """
+    if url.get_backend_name() != 'sqlite' or not url.database \
+            or url.database == ':memory:':
+        return None
+    return os.path.abspath(url.database) + LOCAL_SOCKET_SUFFIX
+
+
+def notify_changed(connection, target):
+    """Announce a change of the periodic task tables.
+
+    Called by the ``PeriodicTaskChanged`` listeners. On PostgreSQL the
+    ``NOTIFY`` is part of the transaction, so it is only delivered on
+    commit. For SQLite the notification is sent after the session commits.
+
+    :param connection: the Connection being used
+    :param target: the mapped instance being persisted
+    """
+    dialect = connection.dialect.name
+    if dialect == 'postgresql':
+        connection.execute(text('NOTIFY {0}'.format(PG_CHANNEL)))
+    elif dialect == 'sqlite':
+        session = object_session(target)
+        path = local_socket_path(connection.engine.url)
+        if session is not None and path is not None:
+            session.info.setdefault('celery_beat_notify', set()).add(path)
+
+
+def _send_local_notifications(session):
+    for directory in session.info.pop('celery_beat_notify', ()):
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            # no beat is listening
+            continue
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            sock.setblocking(False)
+            for name in names:
+                _send_local_notification(sock, os.path.join(directory, name))
+        finally:
+            sock.close()
+
+
+def _send_local_notification(sock, path):
+    try:
+        sock.sendto(b'1', path)
+    except ConnectionRefusedError:
+        # left behind by a beat that didn't shut down cleanly
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+    except (OSError, ValueError):
+        # the beat is gone, or it already has changes pending
+        pass
+
+
+def _discard_local_notifications(session):
+    session.info.pop('celery_beat_notify', None)
+
+
+if hasattr(socket, 'AF_UNIX'):
+    event.listen(Session, 'after_commit', _send_local_notifications)
+    event.listen(Session, 'after_rollback', _discard_local_notifications)
+
+
+def get_notifier(scheduler, name=None):
+    """Create the notifier ``name`` (an alias or a class path) for
+    the scheduler, falling back to polling when it can't be set up.
+    """
+    name = name or 'polling'
+    try:
+        return symbol_by_name(name, NOTIFIERS)(scheduler)
+    except Exception as exc:
+        if name == 'polling':
+            raise
+        logger.warning(
+            'Cannot use change notifier %r, fall back to polling: %r',
+            name, exc)
+        return PollingNotifier(scheduler)
+
+
+class Notifier(object):
+    """Base class of the change notifiers."""
+
+    #: True when changes are pushed to the scheduler, so :meth:`wait`
+    #: can block until the next change instead of polling.
+    push = False
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+
+    def changed(self):
+        """Return True if the schedule changed since the last call."""
+        raise NotImplementedError('notifiers must implement changed')
+
+    def wait(self, timeout):
+        """Block for at most ``timeout`` seconds until the schedule changed.
+
+        Return True if it did, the change is reported by the
+        next :meth:`changed` call as well.
+        """
+        raise NotImplementedError('notifiers must implement wait')
+
+    def close(self):
+        pass
+
+
+class PollingNotifier(Notifier):
+    """Poll the ``last_update`` field of ``PeriodicTaskChanged``."""
+
+    _last_timestamp = None
+
+    def changed(self):
+        scheduler = self.scheduler
+        with scheduler.session_scope() as session:
+            changes = session.query(scheduler.Changes).get(1)
+            if not changes:
+                changes = scheduler.Changes(id=1)
+                session.add(changes)
+                return False
+
+            last, ts = self._last_timestamp, changes.last_update
+            try:
+                if ts and ts > (last if last else ts):
+                    return True
+            finally:
+                self._last_timestamp = ts
+            return False
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+        return False
+
+
+class PushNotifier(Notifier):
+    """Base class of the notifiers waiting on a file descriptor."""
+
+    push = True
+    _pending = False
+
+    def fileno(self):
+        raise NotImplementedError('push notifiers must implement fileno')
+
+    def drain(self):
+        """Consume the received notifications, return True if any."""
+        raise NotImplementedError('push notifiers must implement drain')
+
+    def changed(self):
+        pending, self._pending = self._pending, False
+        return self.drain() or pending
+
+    def wait(self, timeout):
+        if not self._pending:
+            readable, _, _ = select.select([self], [], [], timeout)
+            self._pending = bool(readable) and self.drain()
+        return self._pending
+
+
+class LocalNotifier(PushNotifier):
+    """Receive notifications on a UNIX datagram socket next to the SQLite
+    database file, sent by the processes committing schedule changes.
+
+    Each beat binds a socket of its own in the directory of the database,
+    the processes committing changes notify all of them.
+    """
+
+    def __init__(self, scheduler):
+        super(LocalNotifier, self).__init__(scheduler)
+        self.directory = local_socket_path(scheduler.engine.url)
+        if self.directory is None:
+            raise ValueError('local notifier needs a SQLite database file')
+        self._remove_legacy_socket()
+        self.path = os.path.join(self.directory, '{0}-{1}'.format(
+            os.getpid(), uuid.uuid4().hex[:8]))
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        while True:
+            try:
+                os.mkdir(self.directory)
+            except FileExistsError:
+                pass
+            try:
+                self.socket.bind(self.path)
+                return
+            except FileNotFoundError:
+                # removed by the last beat closing in the meantime
+                continue
+
+    def _remove_legacy_socket(self):
+        """Remove the single socket of the former versions, unless a beat
+        still listens on it.
+        """
+        try:
+            mode = os.stat(self.directory).st_mode
+        except FileNotFoundError:
+            return
+        if not stat.S_ISSOCK(mode):
+            return
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            probe.connect(self.directory)
+        except OSError as exc:
+            if exc.errno != errno.ECONNREFUSED:
+                raise
+            os.unlink(self.directory)
+        else:
+            raise ValueError('a beat of a former version listens on '
+                             '{0}'.format(self.directory))
+        finally:
+            probe.close()
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def drain(self):
+        received = False
+        while True:
+            try:
+                self.socket.recv(64)
+            except (BlockingIOError, InterruptedError):
+                return received
+            received = True
+
+    def close(self):
+        self.socket.close()
+        try:
+            os.unlink(self.path)
+            # the last beat out
+            os.rmdir(self.directory)
+        except OSError:
+            pass
+
+
+class PostgresNotifier(PushNotifier):
+    """``LISTEN`` for the notifications of PostgreSQL (psycopg2)."""
+
+    def __init__(self, scheduler):
+        super(PostgresNotifier, self).__init__(scheduler)
+        if scheduler.engine.dialect.name != 'postgresql':
+            raise ValueError('postgres notifier needs a PostgreSQL database')
+        self.connection = None
+        self.connect()
+
+    def connect(self):
+        self.connection = self.scheduler.engine.raw_connection()
+        dbapi_connection = self.connection.connection
+        dbapi_connection.autocommit = True
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute('LISTEN {0}'.format(PG_CHANNEL))
+        finally:
+            cursor.close()
+
+    def fileno(self):
+        return self.connection.connection.fileno()
+
+    def wait(self, timeout):
+        if self.connection is None:
+            self._pending = self.drain()
+        return super(PostgresNotifier, self).wait(timeout)
+
+    def drain(self):
+        try:
+            if self.connection is None:
+                self.connect()
+                # changes may have been missed in the meantime
+                return True
+            dbapi_connection = self.connection.connection
+            dbapi_connection.poll()
+        except Exception as exc:
+            logger.warning('LISTEN connection failed: %r', exc)
+            self.close()
+            return True
+        received = bool(dbapi_connection.notifies)
+        del dbapi_connection.notifies[:]
+        return received
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.invalidate()
+            self.connection = None
@@ -1,24 +1,38 @@
 # coding=utf-8
 
+import copy
+import heapq
 import logging
+import time
 import datetime as dt
+from collections import namedtuple
+from contextlib import contextmanager
+from functools import partial
 from multiprocessing.util import Finalize
 
 import sqlalchemy
+from sqlalchemy import and_, bindparam, case, event, or_, select
+from sqlalchemy.orm import joinedload, lazyload, selectinload, subqueryload
 from celery import current_app
 from celery import schedules
-from celery.beat import Scheduler, ScheduleEntry
+from celery.beat import Scheduler, ScheduleEntry, event_t
 from celery.utils.log import get_logger
 from celery.utils.time import maybe_make_aware
 from kombu.utils.encoding import safe_repr, safe_str
 from kombu.utils.json import dumps, loads
 
-from .session import session_cleanup
+from .session import session_cleanup, session_scope
 from .session import SessionManager
+from .notifiers import get_notifier
+from .coordination import LeaderElector, ShardCoordinator
+from .writer import WriteBehind
+from .metrics import get_metrics
+from .batch import IntervalBatch
+from .wheel import TimingWheel
 from .models import (
-    PeriodicTask, PeriodicTaskChanged,
+    PeriodicTask, PeriodicTaskChanged, PeriodicTaskDeleted,
     CrontabSchedule, IntervalSchedule,
-    SolarSchedule,
+    SolarSchedule, ScheduleResolver, schedule_ids,
 )
 
 # This scheduler must wake up more frequently than the
@@ -26,8 +40,47 @@ from .models import (
 # changes to the schedule into account.
 DEFAULT_MAX_INTERVAL = 5  # seconds
 
+# When the changes are pushed by the notifier the scheduler sleeps until
+# the next entry is due, this only bounds a single wait.
+PUSH_MAX_WAIT = 3600  # seconds
+
 DEFAULT_BEAT_DBURI = 'sqlite:///schedule.db'
 
+# Keep the connections of the scheduler open between ticks,
+# `beat_engine_options` is passed to `create_engine`.
+DEFAULT_ENGINE_OPTIONS = {'pool_pre_ping': True}
+
+# ``date_changed`` is stamped by the database when the statement runs, so a
+# transaction committing late can carry a timestamp older than the one we
+# already saw. Re-read rows changed shortly before the watermark.
+INCREMENTAL_RELOAD_OVERLAP = dt.timedelta(seconds=5)
+
+# How the schedules of the periodic tasks are loaded, anything
+# but ``lazy`` costs a fixed number of queries instead of one per row.
+LOAD_STRATEGIES = {
+    'selectin': selectinload,
+    'joined': joinedload,
+    'subquery': subqueryload,
+    'lazy': lazyload,
+}
+DEFAULT_LOAD_STRATEGY = 'selectin'
+
+# Names per ``IN`` clause when loading many tasks by name, SQLite
+# allows no more than 999 parameters in a statement.
+BULK_QUERY_CHUNK = 500
+
+# Entries per claiming UPDATE, each of them takes four parameters and
+# SQLite doesn't parse much longer chains of ``OR``.
+CLAIM_CHUNK = 200
+
+# The columns of a periodic task kept by its entry, the entries don't hold
+# on to the ORM instances they are loaded from.
+EntryRow = namedtuple('EntryRow', [
+    'id', 'name', 'task', 'args', 'kwargs', 'queue', 'exchange',
+    'routing_key', 'priority', 'expires', 'one_off', 'start_time',
+    'enabled', 'last_run_at', 'total_run_count', 'next_run_at',
+])
+
 ADD_ENTRY_ERROR = """\
 Cannot add entry %r to database schedule: %r. Contents: %r
 """
@@ -40,8 +93,63 @@ session_manager = SessionManager()
 logger = get_logger('celery_sqlalchemy_scheduler.schedulers')
 
 
+def _same_time(stored, value):
+    """Compare a datetime read from the database with the one written.
+
+    The columns storing naive datetimes keep the local time of the value.
+    """
+    if stored is None:
+        return False
+    if stored.tzinfo is None:
+        value = value.replace(tzinfo=None)
+    return stored == value
+
+
+_entry_layouts = {}
+
+
+def _entry_layout(cls):
+    """Return the slots of the entry class ``cls``, and whether its
+    instances may hold attributes in ``__dict__``: ``ScheduleEntry`` has
+    no slots, so they all have one, only created when an attribute is
+    stored there.
+    """
+    try:
+        return _entry_layouts[cls]
+    except KeyError:
+        pass
+    fields = []
+    has_dict = False
+    for klass in cls.__mro__:
+        if not issubclass(klass, ModelEntry):
+            continue
+        slots = vars(klass).get('__slots__')
+        if slots is None:
+            has_dict = True
+        elif isinstance(slots, str):
+            fields.append(slots)
+        else:
+            fields.extend(slots)
+    layout = _entry_layouts[cls] = (tuple(fields), has_dict)
+    return layout
+
+
 class ModelEntry(ScheduleEntry):
-    """Scheduler entry taken from database row."""
+    """Scheduler entry taken from database row.
+
+    The entry copies what it needs from the row and keeps no reference to
+    the ORM instance, so the session loading the schedule can let go of
+    them. ``__slots__`` keeps the entries of large schedules small.
+
+    ``args`` and ``kwargs`` are decoded when the task is due, until then
+    the entry holds the JSON text of the row.
+    """
+
+    __slots__ = (
+        'app', 'session_scope', '_row', 'name', 'task', 'schedule',
+        '_args', '_kwargs', 'options', 'last_run_at', 'total_run_count',
+        'enabled', 'no_changes',
+    )
 
     model_schedules = (
         # (schedule_type, model_type, model_field)
@@ -49,20 +157,37 @@ class ModelEntry(ScheduleEntry):
         (schedules.schedule, IntervalSchedule, 'interval'),
         (schedules.solar, SolarSchedule, 'solar'),
     )
-    save_fields = ['last_run_at', 'total_run_count', 'no_changes']
+    save_fields = ['last_run_at', 'total_run_count', 'next_run_at',
+                   'no_changes']
+    # the columns written by `save_many`
+    bulk_save_fields = ['last_run_at', 'total_run_count', 'next_run_at']
 
     def __init__(self, model, Session, app=None, **kw):
-        """Initialize the model entry."""
+        """Initialize the model entry.
+
+        :param model: the ``PeriodicTask``, or an :data:`EntryRow`
+        :param schedule: the compiled schedule, needed when ``model``
+            is an :data:`EntryRow`.
+        :param session_scope: callable returning the context manager
+            providing the session for writes, the scheduler passes the
+            one sharing the session of the current tick.
+        """
         self.app = app or current_app._get_current_object()
-        self.session = kw.get('session')
-        self.Session = Session
-
-        self.model = model
-        self.name = model.name
-        self.task = model.task
-
+        self.session_scope = (kw.get('session_scope') or
+                              partial(session_scope, Session))
+
+        # the columns as loaded, the entry's own fields hold the run state
+        row = self._row = self.to_row(model)
+        self.name = row.name
+        self.task = row.task
+        self.enabled = row.enabled
+        self.no_changes = getattr(model, 'no_changes', False)
+        self._args = self._kwargs = None
+
+        self.schedule = kw.get('schedule')
         try:
-            self.schedule = model.schedule
+            if self.schedule is None:
+                self.schedule = model.schedule
             logger.debug('schedule: {}'.format(self.schedule))
         except Exception as e:
             logger.error(e)
@@ -72,65 +197,92 @@ class ModelEntry(ScheduleEntry):
             )
             self._disable(model)
 
-        try:
-            self.args = loads(model.args or '[]')
-            self.kwargs = loads(model.kwargs or '{}')
-        except ValueError as exc:
-            logger.exception(
-                'Removing schedule %s for argument deseralization error: %r',
-                self.name, exc,
-            )
-            self._disable(model)
-
         self.options = {}
         for option in ['queue', 'exchange', 'routing_key', 'expires',
                        'priority']:
-            value = getattr(model, option)
+            value = getattr(row, option)
             if value is None:
                 continue
             self.options[option] = value
 
-        self.total_run_count = model.total_run_count
-        self.enabled = model.enabled
-
-        if not model.last_run_at:
-            model.last_run_at = self._default_now()
-        self.last_run_at = model.last_run_at
+        self.total_run_count = row.total_run_count
 
         # 因为从数据库读取的 last_run_at 可能没有时区信息，所以这里必须加上时区信息
-        self.last_run_at = self.last_run_at.replace(tzinfo=self.app.timezone)
+        self.last_run_at = (row.last_run_at or self._default_now()).replace(
+            tzinfo=self.app.timezone)
 
         # self.options['expires'] 同理
         # if 'expires' in self.options:
         #     expires = self.options['expires']
         #     self.options['expires'] = expires.replace(tzinfo=self.app.timezone)
 
-    def _disable(self, model):
-        model.no_changes = True
-        self.model.enabled = self.enabled = model.enabled = False
-        if self.session:
-            self.session.add(model)
-            self.session.commit()
-        else:
-            session = self.Session()
-            with session_cleanup(session):
-                session.add(model)
-                session.commit()
+    @staticmethod
+    def to_row(model):
+        """Return the :data:`EntryRow` of a ``PeriodicTask``."""
+        if isinstance(model, EntryRow):
+            return model
+        return EntryRow._make(getattr(model, field)
+                              for field in EntryRow._fields)
+
+    @property
+    def id(self):
+        return self._row.id
+
+    @property
+    def args(self):
+        if self._args is None:
+            self._decode_arguments()
+        return self._args
+
+    @args.setter
+    def args(self, value):
+        self._args = value
+        self._row = self._row._replace(args=dumps(value))
+
+    @property
+    def kwargs(self):
+        if self._kwargs is None:
+            self._decode_arguments()
+        return self._kwargs
+
+    @kwargs.setter
+    def kwargs(self, value):
+        self._kwargs = value
+        self._row = self._row._replace(kwargs=dumps(value))
 
-            #     obj = session.query(PeriodicTask).get(model.id)
-            #     obj.enable = model.enabled
-            #     session.add(obj)
-            #     session.commit()
+    def _decode_arguments(self):
+        try:
+            self._args = loads(self._row.args or '[]')
+            self._kwargs = loads(self._row.kwargs or '{}')
+        except ValueError as exc:
+            logger.exception(
+                'Removing schedule %s for argument deseralization error: %r',
+                self.name, exc,
+            )
+            self._args, self._kwargs = [], {}
+            # unlike `_disable`, mark the schedule as changed: the entry is
+            # in the heap already and has to be removed by a reload
+            self.enabled = False
+            self.no_changes = False
+            self.save(('enabled',))
+
+    def _disable(self, model):
+        self.no_changes = True
+        self.enabled = False
+        with self.session_scope() as session:
+            # the model may belong to another session
+            session.query(PeriodicTask).filter_by(id=model.id).update(
+                {'enabled': False}, synchronize_session=False)
 
     def is_due(self):
-        if not self.model.enabled:
+        if not self.enabled:
             # 5 second delay for re-enable.
             return schedules.schedstate(False, 5.0)
 
         # START DATE: only run after the `start_time`, if one exists.
-        if self.model.start_time is not None:
+        if self._row.start_time is not None:
             now = maybe_make_aware(self._default_now())
-            start_time = self.model.start_time.replace(
+            start_time = self._row.start_time.replace(
                 tzinfo=self.app.timezone)
             if now < start_time:
                 # The datetime is before the start date - don't run.
@@ -139,17 +291,48 @@ class ModelEntry(ScheduleEntry):
                 return schedules.schedstate(False, delay)
 
         # ONE OFF TASK: Disable one off tasks after they've ran once
-        if self.model.one_off and self.model.enabled \
-                and self.model.total_run_count > 0:
-            self.model.enabled = False  # disable
-            self.model.total_run_count = 0  # Reset
-            self.model.no_changes = False  # Mark the model entry as changed
+        if self._row.one_off and self.enabled \
+                and self.total_run_count > 0:
+            self.enabled = False  # disable
+            self.total_run_count = 0  # Reset
+            self.no_changes = False  # Mark the model entry as changed
             save_fields = ('enabled',)   # the additional fields to save
             self.save(save_fields)
 
             return schedules.schedstate(False, None)  # Don't recheck
 
-        return self.schedule.is_due(self.last_run_at)
+        state = self.schedule.is_due(self.last_run_at)
+        if state.is_due and self._args is None:
+            # about to be sent, disabled when the arguments are invalid
+            self._decode_arguments()
+            if not self.enabled:
+                return schedules.schedstate(False, 5.0)
+        return state
+
+    @property
+    def next_run_at(self):
+        """When the task is due next, or None for disabled entries."""
+        if not self.enabled or self.schedule is None:
+            return None
+        is_due, next_time_to_run = self.schedule.is_due(self.last_run_at)
+        now = self._default_now()
+        if is_due:
+            return now
+        return now + dt.timedelta(seconds=next_time_to_run)
+
+    @property
+    def interval_seconds(self):
+        """The period of an enabled interval entry, None for the others.
+
+        Relative intervals and the entries with a start time or run once
+        are left to :meth:`is_due`.
+        """
+        schedule = self.schedule
+        if (type(schedule) is not schedules.schedule or schedule.relative
+                or not self.enabled or self._row.start_time is not None
+                or self._row.one_off):
+            return None
+        return schedule.seconds
 
     def _default_now(self):
         now = self.app.now()
@@ -160,39 +343,207 @@ class ModelEntry(ScheduleEntry):
         return now.replace(tzinfo=self.app.timezone)
 
     def __next__(self):
-        # should be use `self._default_now()` or `self.app.now()` ?
-        self.model.last_run_at = self.app.now()
-        self.model.total_run_count += 1
-        self.model.no_changes = True
-        return self.__class__(self.model, Session=self.Session)
+        # The schedule, the arguments and the options stay the same, copy
+        # them instead of building the entry from the row again.
+        entry = self._copy()
+        entry.last_run_at = self._default_now()
+        entry.total_run_count = self.total_run_count + 1
+        entry.no_changes = True
+        return entry
     next = __next__  # for 2to3
 
+    def _copy(self):
+        cls = self.__class__
+        entry = object.__new__(cls)
+        fields, has_dict = _entry_layout(cls)
+        for field in fields:
+            setattr(entry, field, getattr(self, field))
+        if has_dict:
+            # set by subclasses without slots, reading __dict__ creates it
+            # on the entries which don't have one
+            entry.__dict__.update(self.__dict__)
+        return entry
+
+    def __iter__(self):
+        for field in ('name', 'task', 'last_run_at', 'total_run_count',
+                      'schedule', 'args', 'kwargs', 'options'):
+            yield field, getattr(self, field)
+
+    def editable_fields_equal(self, other):
+        """override
+
+        Compare the JSON text of the arguments, without decoding them.
+        """
+        if not isinstance(other, ModelEntry):
+            return super(ModelEntry, self).editable_fields_equal(other)
+        for attr in ('task', 'options', 'schedule'):
+            if getattr(self, attr) != getattr(other, attr):
+                return False
+        return (self._row.args == other._row.args and
+                self._row.kwargs == other._row.kwargs)
+
+    def keep_due_time(self, other):
+        """Give ``other``, this entry loaded again, the same due time.
+
+        Returns False when ``other`` is due at another time, its schedule
+        or its run state changed.
+        """
+        if (self._row.last_run_at is None and
+                other._row.last_run_at is None and
+                self.total_run_count == other.total_run_count):
+            # never ran, loading it again doesn't make it due later
+            other.last_run_at = self.last_run_at
+        return (self.schedule == other.schedule and
+                self.last_run_at == other.last_run_at and
+                self.enabled == other.enabled and
+                self._row.start_time == other._row.start_time and
+                self._row.one_off == other._row.one_off)
+
+    def update(self, other):
+        """override
+
+        ``ScheduleEntry.update`` writes to ``__dict__``.
+        """
+        for field in ('task', 'schedule', 'args', 'kwargs', 'options'):
+            setattr(self, field, getattr(other, field))
+
     def save(self, fields=tuple()):
         """
-        :params fields: tuple, the additional fields to save
+        :params fields: tuple, the additional fields to save. Saving the
+            run state only keeps ``date_changed``, the other fields are
+            edits of the task the incremental reloads have to see.
         """
-        # TODO:
-        session = self.Session()
-        with session_cleanup(session):
+        with self.session_scope() as session:
             # Object may not be synchronized, so only
             # change the fields we care about.
-            obj = session.query(PeriodicTask).get(self.model.id)
+            obj = session.query(PeriodicTask).get(self.id)
 
             for field in self.save_fields:
-                setattr(obj, field, getattr(self.model, field))
+                setattr(obj, field, getattr(self, field))
             for field in fields:
-                setattr(obj, field, getattr(self.model, field))
+                setattr(obj, field, getattr(self, field))
+            if not fields:
+                # the run state isn't an edit of the task
+                obj.date_changed = PeriodicTask.date_changed
             session.add(obj)
-            session.commit()
 
     @classmethod
-    def to_model_schedule(cls, session, schedule):
+    def save_many(cls, session, entries, fields=None):
+        """Save the run state of many entries in one executemany UPDATE.
+
+        ``date_changed`` is kept, the incremental reloads don't load the
+        tasks again because they ran. The caller is responsible for
+        committing the session.
+
+        :param fields: the columns to write, `bulk_save_fields` by default
+        """
+        table = PeriodicTask.__table__
+        fields = fields or cls.bulk_save_fields
+        # the names of the parameters can't be the ones of the columns
+        values = {field: bindparam('_' + field, type_=table.c[field].type)
+                  for field in fields}
+        statement = table.update().where(
+            table.c.id == bindparam('_id')).values(
+                date_changed=table.c.date_changed, **values)
+        parameters = []
+        for entry in entries:
+            row = {'_id': entry.id}
+            for field in fields:
+                row['_' + field] = getattr(entry, field)
+            parameters.append(row)
+        if parameters:
+            session.execute(statement, parameters)
+
+    @classmethod
+    def claim_many(cls, session, claims, now):
+        """Claim the runs of many entries with one compare-and-set UPDATE.
+
+        A run is claimed when ``total_run_count`` is still the one of the
+        entry, the UPDATE then stores the run state of the next entry. The
+        rows read back afterwards tell which of them this UPDATE wrote.
+
+        The caller is responsible for committing the session, or rolling
+        it back when the result is None.
+
+        :param claims: a list of ``(entry, next_entry)`` pairs, the next
+            entries run at ``now``
+        :return: a tuple of ``(claimed, state)``: ``claimed`` is the set of
+            ids claimed and ``state`` maps the ids to the
+            ``(total_run_count, last_run_at)`` of their row. None when the
+            rows read back don't match the rows updated, because the
+            database drops the microseconds for instance.
+        """
+        table = PeriodicTask.__table__
+        claimed, state = set(), {}
+        for start in range(0, len(claims), CLAIM_CHUNK):
+            chunk = claims[start:start + CLAIM_CHUNK]
+            expected = {entry.id: entry.total_run_count for entry, _ in chunk}
+            result = session.execute(table.update().where(or_(*[
+                and_(table.c.id == entry.id,
+                     table.c.total_run_count == entry.total_run_count)
+                for entry, _ in chunk
+            ])).values(
+                last_run_at=now,
+                total_run_count=table.c.total_run_count + 1,
+                next_run_at=case(
+                    {entry.id: next_entry.next_run_at
+                     for entry, next_entry in chunk},
+                    value=table.c.id),
+                # the run state isn't an edit of the task
+                date_changed=table.c.date_changed,
+            ))
+            rows = session.execute(select([
+                table.c.id, table.c.total_run_count, table.c.last_run_at,
+            ]).where(table.c.id.in_(list(expected))))
+            won = set()
+            for id_, total_run_count, last_run_at in rows:
+                state[id_] = (total_run_count, last_run_at)
+                if (total_run_count == expected[id_] + 1 and
+                        _same_time(last_run_at, now)):
+                    won.add(id_)
+            if len(won) != result.rowcount:
+                return None
+            claimed |= won
+        return claimed, state
+
+    @classmethod
+    def claim_each(cls, session, claims, now):
+        """Fallback of :meth:`claim_many`, one UPDATE by entry."""
+        table = PeriodicTask.__table__
+        claimed = set()
+        for entry, next_entry in claims:
+            result = session.execute(table.update().where(and_(
+                table.c.id == entry.id,
+                table.c.total_run_count == entry.total_run_count,
+            )).values(
+                last_run_at=now,
+                total_run_count=table.c.total_run_count + 1,
+                next_run_at=next_entry.next_run_at,
+                date_changed=table.c.date_changed,
+            ))
+            if result.rowcount == 1:
+                claimed.add(entry.id)
+        state = {}
+        ids = [entry.id for entry, _ in claims if entry.id not in claimed]
+        for start in range(0, len(ids), BULK_QUERY_CHUNK):
+            rows = session.execute(select([
+                table.c.id, table.c.total_run_count, table.c.last_run_at,
+            ]).where(table.c.id.in_(ids[start:start + BULK_QUERY_CHUNK])))
+            for id_, total_run_count, last_run_at in rows:
+                state[id_] = (total_run_count, last_run_at)
+        return claimed, state
+
+    @classmethod
+    def to_model_schedule(cls, session, schedule, resolver=None):
         for schedule_type, model_type, model_field in cls.model_schedules:
             # change to schedule
             schedule = schedules.maybe_schedule(schedule)
             if isinstance(schedule, schedule_type):
-                # TODO:
-                model_schedule = model_type.from_schedule(session, schedule)
+                if resolver is not None:
+                    model_schedule = resolver.get(model_type, schedule)
+                else:
+                    model_schedule = model_type.from_schedule(
+                        session, schedule)
                 return model_schedule, model_field
         raise ValueError(
             'Cannot convert schedule type {0!r} to model'.format(schedule))
@@ -225,13 +576,75 @@ class ModelEntry(ScheduleEntry):
             except Exception as exc:
                 logger.error(exc)
                 session.rollback()
-            res = cls(periodic_task, app=app, Session=Session, session=session)
+            res = cls(periodic_task, app=app, Session=Session)
             return res
 
+    @classmethod
+    def from_entries(cls, mapping, Session, app=None, **kw):
+        """Create or update the periodic tasks of many entries at once.
+
+        The existing tasks and schedules are loaded with a few queries,
+        compared with the entries in memory, and the changes are written
+        in one transaction. Entries which can't be converted are logged
+        and skipped.
+
+        Returns a dict of the entries by name.
+        """
+        scope = kw.get('session_scope') or partial(
+            session_scope, Session, expire_on_commit=False)
+        with scope() as session:
+            names = list(mapping)
+            tasks = {}
+            for i in range(0, len(names), BULK_QUERY_CHUNK):
+                for task in session.query(PeriodicTask).filter(
+                        PeriodicTask.name.in_(
+                            names[i:i + BULK_QUERY_CHUNK])):
+                    tasks[task.name] = task
+            resolver = ScheduleResolver(session, [
+                model_type for _, model_type, _ in cls.model_schedules])
+
+            resolved = {}
+            for name, entry_fields in mapping.items():
+                try:
+                    resolved[name] = cls.to_model_schedule(
+                        session, entry_fields['schedule'], resolver=resolver)
+                except Exception as exc:
+                    logger.error(ADD_ENTRY_ERROR, name, exc, entry_fields)
+            # give the new schedules their ids
+            session.flush()
+
+            updated = []
+            for name, model_schedule in resolved.items():
+                entry_fields = mapping[name]
+                try:
+                    temp = cls._unpack_fields(
+                        session, model_schedule=model_schedule,
+                        **entry_fields)
+                except Exception as exc:
+                    logger.error(ADD_ENTRY_ERROR, name, exc, entry_fields)
+                    continue
+                periodic_task = tasks.get(name)
+                if periodic_task is None:
+                    periodic_task = tasks[name] = PeriodicTask(name=name)
+                    session.add(periodic_task)
+                # only touch what changed, unchanged tasks aren't updated
+                for field, value in temp.items():
+                    if getattr(periodic_task, field) != value:
+                        setattr(periodic_task, field, value)
+                updated.append(name)
+            session.flush()
+
+            # the schedules are in the identity map already
+            return {
+                name: cls(tasks[name], app=app, Session=Session,
+                          session_scope=scope)
+                for name in updated
+            }
+
     @classmethod
     def _unpack_fields(cls, session, schedule,
                        args=None, kwargs=None, relative=None, options=None,
-                       **entry):
+                       model_schedule=None, **entry):
         """
 
         **entry sample:
@@ -240,8 +653,11 @@ class ModelEntry(ScheduleEntry):
              'schedule': <crontab: 0 4 * * * (m/h/d/dM/MY)>,
              'options': {'expires': 43200}}
 
+        :param model_schedule: tuple of ``(model_schedule, model_field)``
+            when the schedule was converted already
         """
-        model_schedule, model_field = cls.to_model_schedule(session, schedule)
+        model_schedule, model_field = (
+            model_schedule or cls.to_model_schedule(session, schedule))
         entry.update(
             # the model_id which to relationship
             {model_field + '_id': model_schedule.id},
@@ -259,7 +675,8 @@ class ModelEntry(ScheduleEntry):
             'exchange': exchange,
             'routing_key': routing_key,
             'priority': priority,
-            'one_off': one_off,
+            # as stored, not to update the unchanged tasks
+            'one_off': bool(one_off),
         }
         if expires:
             if isinstance(expires, int):
@@ -283,27 +700,160 @@ class DatabaseScheduler(Scheduler):
     Entry = ModelEntry
     Model = PeriodicTask
     Changes = PeriodicTaskChanged
+    Deleted = PeriodicTaskDeleted
 
     _schedule = None
-    _last_timestamp = None
+    _tick_session = None
+    _last_changed = None
     _initial_read = True
     _heap_invalidated = False
+    _heap_patched = False
+    _lookahead_reload_at = None
+    _coordinator = None
+    _elector = None
+    _batch = None
+    _wheel = None
 
     def __init__(self, *args, **kwargs):
         """Initialize the database scheduler."""
         self.app = kwargs['app']
         self.dburi = kwargs.get('dburi') or self.app.conf.get(
             'beat_dburi') or DEFAULT_BEAT_DBURI
-        self.engine, self.Session = session_manager.create_session(self.dburi)
+        self.engine_options = dict(
+            DEFAULT_ENGINE_OPTIONS,
+            **(kwargs.get('engine_options') or
+               self.app.conf.get('beat_engine_options') or {}))
+        self.engine, self.Session = session_manager.create_session(
+            self.dburi, **self.engine_options)
         session_manager.prepare_models(self.engine)
 
+        self.load_strategy = (kwargs.get('load_strategy') or
+                              self.app.conf.get('beat_load_strategy') or
+                              DEFAULT_LOAD_STRATEGY)
+        if self.load_strategy not in LOAD_STRATEGIES:
+            raise ValueError('Unknown load strategy {0!r}: {1}'.format(
+                self.load_strategy, ', '.join(sorted(LOAD_STRATEGIES))))
+        self.incremental_reload = kwargs.get('incremental_reload')
+        if self.incremental_reload is None:
+            self.incremental_reload = self.app.conf.get(
+                'beat_incremental_reload', False)
+
+        self.lookahead_window = (
+            kwargs.get('lookahead_window') or
+            self.app.conf.get('beat_lookahead_window'))
+        if isinstance(self.lookahead_window, dt.timedelta):
+            self.lookahead_window = self.lookahead_window.total_seconds()
+
+        self.change_notifier = (
+            kwargs.get('change_notifier') or
+            self.app.conf.get('beat_change_notifier'))
+        self._notifier = None
+
+        self.shards = (kwargs.get('shards') or
+                       self.app.conf.get('beat_shards'))
+        self.node_id = (kwargs.get('node_id') or
+                        self.app.conf.get('beat_node_id'))
+        self.lease_ttl = (kwargs.get('lease_ttl') or
+                          self.app.conf.get('beat_lease_ttl'))
+        self.standby = kwargs.get('standby')
+        if self.standby is None:
+            self.standby = self.app.conf.get('beat_standby', False)
+        if self.standby and self.shards:
+            raise ValueError(
+                'beat_standby and beat_shards cannot be used together, '
+                'the shards of a beat are taken over by the others already')
+        self.claim_runs = kwargs.get('claim_runs')
+        if self.claim_runs is None:
+            self.claim_runs = self.app.conf.get('beat_claim_runs', False)
+        self.write_behind = kwargs.get('write_behind')
+        if self.write_behind is None:
+            self.write_behind = self.app.conf.get('beat_write_behind', False)
+        self.write_behind_workers = (
+            kwargs.get('write_behind_workers') or
+            self.app.conf.get('beat_write_behind_workers') or 1)
+        self.write_behind_max_pending = (
+            kwargs.get('write_behind_max_pending') or
+            self.app.conf.get('beat_write_behind_max_pending'))
+        self._writer = None
+        self.metrics_sink = (kwargs.get('metrics') or
+                             self.app.conf.get('beat_metrics'))
+        self._metrics = None
+        self.batch_intervals = kwargs.get('batch_intervals')
+        if self.batch_intervals is None:
+            self.batch_intervals = self.app.conf.get(
+                'beat_batch_intervals', False)
+        self.timing_wheel = kwargs.get('timing_wheel')
+        if self.timing_wheel is None:
+            self.timing_wheel = self.app.conf.get('beat_timing_wheel', False)
+        if self.timing_wheel and self.batch_intervals:
+            raise ValueError(
+                'beat_timing_wheel and beat_batch_intervals cannot be used '
+                'together, the wheel finds the interval entries due already')
+
         self._dirty = set()
+        # names saved in the current tick, not committed yet
+        self._tick_saved = set()
         Scheduler.__init__(self, *args, **kwargs)
         self._finalize = Finalize(self, self.sync, exitpriority=5)
+        self._finalize_notifier = Finalize(
+            self, self.close_notifier, exitpriority=5)
+        self._finalize_writer = Finalize(
+            self, self.close_writer, exitpriority=5)
+        # after the last sync
+        self._finalize_coordinator = Finalize(
+            self, self.close_coordinator, exitpriority=4)
+        self._finalize_elector = Finalize(
+            self, self.close_elector, exitpriority=4)
+        self._finalize_metrics = Finalize(
+            self, self.close_metrics, exitpriority=4)
         self.max_interval = (kwargs.get('max_interval') or
                              self.app.conf.beat_max_loop_interval or
                              DEFAULT_MAX_INTERVAL)
 
+    @contextmanager
+    def session_scope(self):
+        """Provide the session of the current tick, or a new session
+        committed when the block succeeds outside of a tick.
+        """
+        session = self._tick_session
+        if session is None:
+            # the entries keep using the models loaded by the session
+            with session_scope(self.Session,
+                               expire_on_commit=False) as session:
+                yield session
+            return
+        try:
+            yield session
+        except Exception:
+            self._rollback_tick(session)
+            raise
+
+    @contextmanager
+    def unit_of_work(self):
+        """Share one session and one commit between the change detection,
+        the reloads and the writes of a tick.
+        """
+        if self._tick_session is not None:
+            yield self._tick_session
+            return
+        session = self._tick_session = self.Session(expire_on_commit=False)
+        try:
+            yield session
+            session.commit()
+            self._tick_saved.clear()
+        except Exception:
+            self._rollback_tick(session)
+            raise
+        finally:
+            self._tick_session = None
+            session.close()
+
+    def _rollback_tick(self, session):
+        session.rollback()
+        # retry later what was written in the tick
+        self._dirty |= self._tick_saved
+        self._tick_saved.clear()
+
     def setup_schedule(self):
         """override"""
         logger.info('setup_schedule')
@@ -311,40 +861,697 @@ class DatabaseScheduler(Scheduler):
         self.update_from_dict(self.app.conf.beat_schedule)
 
     def all_as_schedule(self):
-        # TODO:
-        session = self.Session()
-        with session_cleanup(session):
+        with self.session_scope() as session:
             logger.debug('DatabaseScheduler: Fetching database schedule')
             # get all enabled PeriodicTask
-            models = session.query(self.Model).filter_by(enabled=True).all()
+            query = self._query_models(session).filter_by(enabled=True)
+            if self.lookahead_window:
+                query = self._filter_lookahead(query)
+            models = query.all()
+            self.metrics.incr('rows_loaded_total', len(models))
             s = {}
             for model in models:
+                self._update_watermark(model.date_changed)
                 try:
-                    s[model.name] = self.Entry(model,
-                                               app=self.app,
-                                               Session=self.Session,
-                                               session=session)
+                    s[model.name] = self.Entry(
+                        model, app=self.app, Session=self.Session,
+                        session_scope=self.session_scope)
                 except ValueError:
                     pass
             return s
 
+    def _filter_lookahead(self, query):
+        """Only load the tasks due within the lookahead window, and the
+        ones not knowing when they are due.
+        """
+        horizon = self.app.now() + dt.timedelta(
+            seconds=self.lookahead_window)
+        # load again before the tasks due after the window are
+        self._lookahead_reload_at = (
+            time.monotonic() + self.lookahead_window / 2.0)
+        return query.filter(or_(
+            self.Model.next_run_at.is_(None),
+            self.Model.next_run_at < horizon,
+        ))
+
+    def _save_next_run_at(self, entries):
+        """Save when the entries not knowing it are due with the next sync,
+        so the next load in lookahead mode can skip them.
+        """
+        if self.lookahead_window:
+            self._dirty.update(entry.name for entry in entries
+                               if entry._row.next_run_at is None)
+
+    def lookahead_expired(self):
+        return (self._lookahead_reload_at is not None and
+                time.monotonic() >= self._lookahead_reload_at)
+
+    def _query_models(self, session):
+        """Query the periodic tasks, loading their schedules with the
+        configured load strategy.
+        """
+        loader = LOAD_STRATEGIES[self.load_strategy]
+        query = session.query(self.Model).options(
+            loader(self.Model.interval),
+            loader(self.Model.crontab),
+            loader(self.Model.solar),
+        )
+        if self.shards:
+            owned = self.coordinator.owned
+            if not owned:
+                return query.filter(sqlalchemy.false())
+            query = query.filter(
+                (self.Model.id % self.shards).in_(sorted(owned)))
+        return query
+
+    def _update_watermark(self, changed):
+        if changed and (self._last_changed is None or
+                        changed > self._last_changed):
+            self._last_changed = changed
+
+    def changed_as_schedule(self):
+        """Fetch only the rows changed since the last load.
+
+        Returns a tuple of ``(changed, removed)``: ``changed`` maps the
+        names of enabled tasks to their new entries and ``removed`` is the
+        set of names which are disabled or deleted from the database.
+        """
+        with self.session_scope() as session:
+            logger.debug('DatabaseScheduler: Fetching changed schedule')
+            query = self._query_models(session)
+            since = None
+            if self._last_changed is not None:
+                since = self._last_changed - INCREMENTAL_RELOAD_OVERLAP
+                query = query.filter(self.Model.date_changed >= since)
+            changed, removed = {}, set()
+            models = query.all()
+            deleted = self.Deleted.deleted_since(session, since)
+            self.metrics.incr('rows_loaded_total', len(models))
+            for model in models:
+                self._update_watermark(model.date_changed)
+                if not model.enabled:
+                    removed.add(model.name)
+                    continue
+                try:
+                    entry = self.Entry(
+                        model, app=self.app, Session=self.Session,
+                        session_scope=self.session_scope)
+                except ValueError:
+                    continue
+                if entry.enabled:
+                    changed[model.name] = entry
+                else:
+                    removed.add(model.name)
+            for name, date_deleted in deleted:
+                self._update_watermark(date_deleted)
+                # unless a task of the same name was added since
+                if name not in changed:
+                    removed.add(name)
+            return changed, removed
+
+    def _patch_schedule(self, changes=None):
+        """Apply an incremental reload to the schedule and the heap.
+
+        :param changes: the result of :meth:`changed_as_schedule`, fetched
+            now when not given.
+        """
+        changed, removed = changes or self.changed_as_schedule()
+        if self.write_behind or self._dirty:
+            # not saved yet
+            self._keep_run_state(changed)
+        for name in removed:
+            self._schedule.pop(name, None)
+        self._schedule.update(changed)
+        self._save_next_run_at(changed.values())
+        logger.info('DatabaseScheduler: %d changed, %d removed.',
+                    len(changed), len(removed))
+
+        if self._wheel is not None:
+            for name in removed:
+                self._wheel.remove(name)
+            now = time.time()
+            for entry in changed.values():
+                self._add_to_wheel(entry, now)
+            return
+        if self._heap is None:
+            return
+        stale = removed | set(changed)
+        heap = [event for event in self._heap if event[2].name not in stale]
+        batch = self._batch
+        if batch is not None:
+            for name in removed:
+                batch.discard(name)
+        for entry in changed.values():
+            if batch is not None and batch.add(entry):
+                continue
+            is_due, next_call_delay = entry.is_due()
+            heap.append(event_t(
+                self._when(entry, 0 if is_due else next_call_delay) or 0,
+                5, entry,
+            ))
+        heapq.heapify(heap)
+        self._heap = heap
+        # the heap is up to date, keep Scheduler.tick from rebuilding it
+        self._heap_patched = True
+
+    def _keep_run_state(self, schedule):
+        """Keep the run state of the tasks sent since ``schedule`` was
+        loaded, their rows are saved by a later sync.
+        """
+        if not self._schedule:
+            return
+        for name, entry in schedule.items():
+            current = self._schedule.get(name)
+            # the count only grows with the runs sent, unlike last_run_at
+            # which defaults to now for the rows without one
+            if current is not None and (
+                    current.total_run_count > entry.total_run_count):
+                entry.last_run_at = current.last_run_at
+                entry.total_run_count = current.total_run_count
+
+    @property
+    def notifier(self):
+        # created on first use, the lazy instances celery beat
+        # creates for introspection never listen for changes
+        if self._notifier is None:
+            self._notifier = get_notifier(self, self.change_notifier)
+        return self._notifier
+
+    def close_notifier(self):
+        if self._notifier is not None:
+            self._notifier.close()
+            self._notifier = None
+
     def schedule_changed(self):
-        session = self.Session()
-        with session_cleanup(session):
-            changes = session.query(self.Changes).get(1)
-            if not changes:
-                changes = self.Changes(id=1)
-                session.add(changes)
-                session.commit()
-                return False
+        with self.metrics.timer('schedule_changed_seconds'):
+            changed = self.notifier.changed()
+        if changed:
+            # the schedule rows may have been edited by another process
+            schedule_ids.clear()
+        return changed
+
+    @property
+    def metrics(self):
+        # created on first use like the notifier, the lazy instances
+        # don't serve metrics
+        if self._metrics is None:
+            self._metrics = get_metrics(self, self.metrics_sink)
+            if self._metrics.enabled:
+                self._metrics.add_collector(self._collect_metrics)
+                event.listen(self.engine, 'before_cursor_execute',
+                             self._count_query)
+        return self._metrics
+
+    def close_metrics(self):
+        if self._metrics is not None:
+            if self._metrics.enabled:
+                event.remove(self.engine, 'before_cursor_execute',
+                             self._count_query)
+            self._metrics.close()
+            self._metrics = None
+
+    def _count_query(self, *args):
+        self._metrics.incr('queries_total')
+
+    def _collect_metrics(self, metrics):
+        if self._schedule is not None:
+            metrics.set('schedule_entries', len(self._schedule))
+        if self._batch is not None:
+            metrics.set('interval_batch_entries', len(self._batch))
+        writer = self._writer
+        if writer is not None:
+            metrics.set('write_behind_pending', writer.pending)
+            for key, value in writer.stats.items():
+                metrics.set('write_behind_' + key, value)
+
+    def is_due(self, entry):
+        """override"""
+        metrics = self.metrics
+        if not metrics.enabled:
+            return entry.is_due()
+        with metrics.timer('is_due_seconds'):
+            return entry.is_due()
+
+    def apply_entry(self, entry, producer=None):
+        """override"""
+        metrics = self.metrics
+        if metrics.enabled:
+            metrics.incr('tasks_sent_total')
+            lag = self._send_lag(entry)
+            if lag is not None:
+                metrics.observe('send_lag_seconds', lag)
+        return super(DatabaseScheduler, self).apply_entry(
+            entry, producer=producer)
+
+    @staticmethod
+    def _send_lag(entry):
+        """Return the seconds since the entry was due."""
+        try:
+            remaining = entry.schedule.remaining_estimate(entry.last_run_at)
+        except Exception:
+            # not every schedule can tell
+            return None
+        return max(-remaining.total_seconds(), 0)
+
+    @property
+    def writer(self):
+        if self._writer is None:
+            self._writer = WriteBehind(
+                self.Session, self.Entry,
+                workers=self.write_behind_workers,
+                max_pending=self.write_behind_max_pending,
+                # the claims save the run state already
+                fields=['next_run_at'] if self.claim_runs else None)
+        return self._writer
+
+    def close_writer(self):
+        """Save the entries queued, the later syncs write them
+        themselves.
+        """
+        if self._writer is not None:
+            self.sync()
+            self._writer.close()
+            self._writer = None
+        self.write_behind = False
+
+    def close(self):
+        """override"""
+        super(DatabaseScheduler, self).close()
+        self.close_writer()
+
+    @property
+    def coordinator(self):
+        # created on first use like the notifier, the lazy instances
+        # must not take any shard
+        if self._coordinator is None:
+            self._coordinator = ShardCoordinator(
+                self.Session, self.shards,
+                node_id=self.node_id, ttl=self.lease_ttl)
+        return self._coordinator
+
+    def close_coordinator(self):
+        if self._coordinator is not None:
+            self._coordinator.close()
+            self._coordinator = None
+
+    @property
+    def elector(self):
+        if self._elector is None:
+            self._elector = LeaderElector(
+                self.Session, node_id=self.node_id, ttl=self.lease_ttl)
+        return self._elector
+
+    def close_elector(self):
+        if self._elector is not None:
+            self._elector.close()
+            self._elector = None
 
-            last, ts = self._last_timestamp, changes.last_update
+    @property
+    def is_leader(self):
+        """True if this beat sends the tasks: it isn't in standby mode,
+        or it holds the leader lease.
+        """
+        return not self.standby or self.elector.is_leader
+
+    def owns(self, entry):
+        """Return True if the entry belongs to the shards of this beat."""
+        return not self.shards or self.coordinator.owns(entry.id)
+
+    def tick(self, *args, **kwargs):
+        """override
+
+        Everything done in the tick shares one session and one commit.
+        With a push notifier, block until the next entry is due or the
+        schedule changed instead of waking up every `max_interval`. The
+        beat wakes up in time to renew its leases either way.
+        """
+        self.metrics.flush()
+        if self.standby and self.elector.refresh_due():
+            if self.elector.refresh() and self.elector.is_leader:
+                self.take_over()
+        if not self.is_leader:
+            return self.stand_by()
+
+        with self.metrics.timer('tick_seconds'), self.unit_of_work():
+            if self.timing_wheel:
+                delay = self.wheel_tick()
+            elif self.claim_runs:
+                delay = self.claim_tick()
+            else:
+                delay = super(DatabaseScheduler, self).tick(*args, **kwargs)
+                if self._batch is not None:
+                    delay = self.batch_tick(delay)
+        if self.shards:
+            # once the run state saved by the reload is committed, the
+            # beat taking the shards over must not send them again
+            self.coordinator.release()
+        if not delay or delay <= 0:
+            return delay
+        if not self.notifier.push:
+            return self._lease_delay(delay)
+
+        delay = self.next_due_delay()
+        logger.debug('DatabaseScheduler: Waiting %.2fs for changes.', delay)
+        if self.notifier.wait(delay):
+            logger.debug('DatabaseScheduler: Woken up by a change.')
+        # the loop of beat.Service skips this when we don't sleep there
+        if self.should_sync():
+            self._do_sync()
+        return 0
+
+    def wheel_tick(self):
+        """Like ``Scheduler.tick``, with the entries due taken from the
+        timing wheel. All of them are sent in the tick.
+        """
+        schedule = self.schedule
+        if self._wheel is None:
+            self.populate_wheel(schedule)
+        wheel = self._wheel
+        now = time.time()
+        due = []
+        for entry in wheel.pop_due(now):
+            is_due, next_time_to_run = self.is_due(entry)
+            if is_due:
+                due.append((entry, next_time_to_run))
+            else:
+                wheel.add(entry, now + (
+                    self.max_interval if next_time_to_run is None
+                    else next_time_to_run))
+        if due:
+            self._send_from_wheel(due, now)
+            return 0
+        due_at = wheel.next_due_at()
+        if due_at is None:
+            return self.max_interval
+        return min(self.adjust(max(due_at - now, 0)) or 0,
+                   self.max_interval)
+
+    def _send_from_wheel(self, due, now):
+        claimed = None
+        if self.claim_runs:
+            claimed = self.claim([entry for entry, _ in due])
+        for entry, next_time_to_run in due:
+            if not self.claim_runs:
+                next_entry = self.reserve(entry)
+                self.apply_entry(entry, producer=self.producer)
+            elif claimed is None:
+                # try again later, the run state is unchanged
+                next_entry, next_time_to_run = entry, self.max_interval
+            elif entry.name in claimed:
+                next_entry = claimed[entry.name]
+                self.apply_entry(entry, producer=self.producer)
+            else:
+                logger.debug('DatabaseScheduler: %s was sent by another '
+                             'beat.', entry.name)
+                next_entry = entry
+            self._wheel.add(next_entry, now + next_time_to_run)
+
+    def populate_wheel(self, schedule=None):
+        """Build the timing wheel from the schedule."""
+        if schedule is None:
+            schedule = self.schedule
+        now = time.time()
+        self._wheel = TimingWheel(now)
+        for entry in schedule.values():
+            self._add_to_wheel(entry, now)
+
+    def _add_to_wheel(self, entry, now):
+        is_due, next_call_delay = entry.is_due()
+        if is_due or next_call_delay is None:
+            self._wheel.add(entry, now)
+        else:
+            self._wheel.add(entry, now + next_call_delay)
+
+    def _reindex(self, old):
+        """Update the heap or the timing wheel after a full reload
+        replaced the schedule ``old``.
+        """
+        if self._wheel is None:
+            # the schedule changed, invalidate the heap in Scheduler.tick
+            self._heap = []
+            self._heap_invalidated = True
+            return
+        wheel = self._wheel
+        now = time.time()
+        for name in old:
+            if name not in self._schedule:
+                wheel.remove(name)
+        for name, entry in self._schedule.items():
+            previous = old.get(name)
+            if previous is not None and previous.keep_due_time(entry):
+                if wheel.replace(entry):
+                    continue
+            self._add_to_wheel(entry, now)
+
+    def claim_tick(self, event_t=event_t, heappop=heapq.heappop,
+                   heappush=heapq.heappush):
+        """Like ``Scheduler.tick``, but claim the runs of all the entries
+        due before sending them, so that the beats sharing the database
+        send each run once.
+        """
+        max_interval = self.max_interval
+        if (self._heap is None or
+                not self.schedules_equal(self.old_schedulers, self.schedule)):
+            self.old_schedulers = copy.copy(self.schedule)
+            self.populate_heap()
+
+        H, batch = self._heap, self._batch
+        if not H and not batch:
+            return max_interval
+
+        # (entry, next_time_to_run, priority), no priority for the batch
+        due = []
+        delay = max_interval
+        while H:
+            event = H[0]
+            is_due, next_time_to_run = self.is_due(event[2])
+            if not is_due:
+                delay = min(self.adjust(next_time_to_run) or max_interval,
+                            max_interval)
+                break
+            heappop(H)
+            due.append((event[2], next_time_to_run, event[1]))
+        if batch:
+            due.extend((entry, next_time_to_run, None)
+                       for entry, next_time_to_run in self.batch_due())
+        if not due:
+            return self._batch_delay(delay)
+
+        claimed = self.claim([entry for entry, _, _ in due])
+        now = time.time()
+        for entry, next_time_to_run, priority in due:
+            if claimed is None:
+                # try again later, the run state is unchanged
+                next_entry, next_time_to_run = entry, max_interval
+            elif entry.name in claimed:
+                next_entry = claimed[entry.name]
+                self.apply_entry(entry, producer=self.producer)
+            else:
+                logger.debug('DatabaseScheduler: %s was sent by another '
+                             'beat.', entry.name)
+                next_entry = entry
+                if priority is None:
+                    # due again after the run of the other beat
+                    batch.add(entry)
+                    continue
+            if priority is None:
+                batch.add(next_entry, now + next_time_to_run)
+            else:
+                heappush(H, event_t(self._when(next_entry, next_time_to_run),
+                                    priority, next_entry))
+        return 0
+
+    def claim(self, entries):
+        """Claim the next runs of ``entries`` in the database.
+
+        The claims are committed before anything is sent. The entries which
+        lost their claim take the run state of their row.
+
+        Returns the next entries of the claimed runs by name, or None when
+        the database can't be reached.
+        """
+        claims, now = [], None
+        for entry in entries:
+            next_entry = next(entry)
+            # the batch runs at the same time, it tells its rows apart
+            now = now or next_entry.last_run_at
+            next_entry.last_run_at = now
+            claims.append((entry, next_entry))
+
+        with self.unit_of_work() as session:
             try:
-                if ts and ts > (last if last else ts):
-                    return True
-            finally:
-                self._last_timestamp = ts
-            return False
+                # what the tick wrote so far isn't rolled back with a claim
+                session.commit()
+                self._tick_saved.clear()
+                self.metrics.incr('claims_total', len(claims))
+                result = self.Entry.claim_many(session, claims, now)
+                if result is None:
+                    logger.warning('DatabaseScheduler: Cannot tell the '
+                                   'claimed runs apart, claiming them one '
+                                   'by one.')
+                    session.rollback()
+                    result = self.Entry.claim_each(session, claims, now)
+                session.commit()
+            except sqlalchemy.exc.SQLAlchemyError as exc:
+                logger.exception('Database error while claiming: %r', exc)
+                session.rollback()
+                return None
+        claimed, state = result
+        self.metrics.incr('claims_lost_total', len(claims) - len(claimed))
+
+        next_entries = {}
+        for entry, next_entry in claims:
+            if entry.id in claimed:
+                if self._schedule.get(entry.name) is entry:
+                    self._schedule[entry.name] = next_entry
+                next_entries[entry.name] = next_entry
+            elif entry.id in state:
+                total_run_count, last_run_at = state[entry.id]
+                entry.total_run_count = total_run_count
+                if last_run_at is not None:
+                    entry.last_run_at = last_run_at.replace(
+                        tzinfo=self.app.timezone)
+        return next_entries
+
+    def stand_by(self):
+        """Keep the schedule and the heap up to date without sending
+        anything, ready to take over. Returns the seconds until the next
+        attempt to become the leader.
+        """
+        with self.unit_of_work():
+            schedule = self.schedule
+            if self.timing_wheel:
+                if self._wheel is None:
+                    self.populate_wheel(schedule)
+            elif (self._heap is None or
+                    not self.schedules_equal(self.old_schedulers, schedule)):
+                self.old_schedulers = copy.copy(schedule)
+                self.populate_heap()
+        return min(self.elector.refresh_in(), self.max_interval)
+
+    def take_over(self):
+        """Catch up with the run state saved by the previous leader.
+
+        The schedule is loaded already, only the run state of its entries
+        is read again. The entries left dirty are saved with these values
+        by the next sync.
+        """
+        if self._schedule is None:
+            return
+        with self.unit_of_work() as session:
+            query = session.query(
+                self.Model.name, self.Model.last_run_at,
+                self.Model.total_run_count,
+            ).filter_by(enabled=True)
+            for name, last_run_at, total_run_count in query:
+                entry = self._schedule.get(name)
+                if entry is None or last_run_at is None:
+                    continue
+                entry.last_run_at = last_run_at.replace(
+                    tzinfo=self.app.timezone)
+                entry.total_run_count = total_run_count
+        # the entries are due at other times now
+        self._heap = self._wheel = None
+        logger.info('DatabaseScheduler: Took over %d entries.',
+                    len(self._schedule))
+
+    def next_due_delay(self):
+        """Return the seconds until the first entry of the heap is due."""
+        max_wait = PUSH_MAX_WAIT
+        if self._lookahead_reload_at is not None:
+            max_wait = min(max_wait, max(
+                self._lookahead_reload_at - time.monotonic(), 0))
+        max_wait = self._lease_delay(max_wait)
+        max_wait = self._batch_delay(max_wait)
+        if self._wheel is not None:
+            due_at = self._wheel.next_due_at()
+            if due_at is None:
+                return max_wait
+            return min(max(due_at - time.time(), 0), max_wait)
+        if not self._heap:
+            return max_wait
+        is_due, next_time_to_run = self.is_due(self._heap[0][2])
+        if is_due:
+            return 0
+        return min(max(self.adjust(next_time_to_run) or 0, 0), max_wait)
+
+    def _lease_delay(self, delay):
+        """Return ``delay`` or the seconds until the leases have to be
+        renewed, if sooner.
+        """
+        if self.shards:
+            delay = min(delay, self.coordinator.refresh_in())
+        if self.standby:
+            delay = min(delay, self.elector.refresh_in())
+        return delay
+
+    def populate_heap(self, event_t=event_t, heapify=heapq.heapify):
+        """override
+
+        With ``beat_batch_intervals`` the interval entries go to the batch
+        instead of the heap.
+        """
+        if not self.batch_intervals:
+            return super(DatabaseScheduler, self).populate_heap(
+                event_t, heapify)
+        batch = self._batch = IntervalBatch()
+        self._heap = []
+        for entry in self.schedule.values():
+            if batch.add(entry):
+                continue
+            is_due, next_call_delay = entry.is_due()
+            self._heap.append(event_t(
+                self._when(entry, 0 if is_due else next_call_delay) or 0,
+                5, entry,
+            ))
+        heapify(self._heap)
+
+    def batch_tick(self, delay):
+        """Send the interval entries due, after ``Scheduler.tick``.
+
+        Returns the seconds until the next entry is due, ``delay`` being
+        the one of the heap.
+        """
+        due = self.batch_due()
+        if not due:
+            return self._batch_delay(delay)
+        now = time.time()
+        for entry, next_time_to_run in due:
+            next_entry = self.reserve(entry)
+            self.apply_entry(entry, producer=self.producer)
+            self._batch.add(next_entry, now + next_time_to_run)
+        return 0
+
+    def batch_due(self):
+        """Return the interval entries due with the seconds until their
+        next run, taken out of the batch.
+        """
+        batch = self._batch
+        now = time.time()
+        with self.metrics.timer('interval_batch_seconds'):
+            candidates = batch.due(now)
+        due = []
+        for entry in candidates:
+            # the batch is only a filter, the entry has the last word
+            is_due, next_time_to_run = self.is_due(entry)
+            if is_due:
+                due.append((entry, next_time_to_run))
+            elif next_time_to_run is None:
+                batch.discard(entry.name)
+            else:
+                batch.add(entry, now + next_time_to_run)
+        return due
+
+    def _batch_delay(self, delay):
+        """Return ``delay`` or the seconds until the first entry of the
+        batch is due, if sooner.
+        """
+        if not self._batch:
+            return delay
+        next_time_to_run = self._batch.delay(time.time())
+        if next_time_to_run is None:
+            return delay
+        return min(self.adjust(next_time_to_run) or 0, delay)
 
     def reserve(self, entry):
         """override
@@ -352,6 +1559,9 @@ class DatabaseScheduler(Scheduler):
         It will be called in parent class.
         """
         new_entry = next(entry)
+        # the entries don't share their model, `sync` saves the new one
+        if self._schedule.get(new_entry.name) is entry:
+            self._schedule[new_entry.name] = new_entry
         # Need to store entry by name, because the entry may change
         # in the mean time.
         self._dirty.add(new_entry.name)
@@ -359,45 +1569,102 @@ class DatabaseScheduler(Scheduler):
 
     def sync(self):
         """override"""
+        if not self.is_leader:
+            # the run state is the leader's to save
+            return
         logger.info('Writing entries...')
-        _tried = set()
+        entries = []
         _failed = set()
+        while self._dirty:
+            name = self._dirty.pop()
+            try:
+                entries.append(self._schedule[name])
+            except (KeyError) as exc:
+                logger.error(exc)
+                _failed.add(name)
+        if not entries:
+            self._dirty |= _failed
+            return
+
+        self.metrics.observe('sync_batch_size', len(entries))
         try:
-            while self._dirty:
-                name = self._dirty.pop()
-                try:
-                    self.schedule[name].save()  # save to database
-                    logger.debug(
-                        '{name} save to database'.format(name=name))
-                    _tried.add(name)
-                except (KeyError) as exc:
-                    logger.error(exc)
-                    _failed.add(name)
-        except sqlalchemy.exc.IntegrityError as exc:
-            logger.exception('Database error while sync: %r', exc)
-        except Exception as exc:
-            logger.exception(exc)
+            with self.metrics.timer('sync_seconds'):
+                _failed |= self._save_entries(entries)
         finally:
             # retry later, only for the failed ones
             self._dirty |= _failed
 
+    def _save_entries(self, entries):
+        """Save the run state of the entries for :meth:`sync`.
+
+        Returns the names of the entries which could not be saved.
+        """
+        if self.write_behind:
+            # saved by the threads of the writer, without waiting
+            self.writer.put(entries)
+            return set()
+        try:
+            with self.session_scope() as session:
+                # one executemany UPDATE and one commit for all entries,
+                # the claims save the run state already
+                self.Entry.save_many(
+                    session, entries,
+                    ['next_run_at'] if self.claim_runs else None)
+            if self._tick_session is not None:
+                self._tick_saved.update(entry.name for entry in entries)
+            logger.debug('%d entries save to database', len(entries))
+        except sqlalchemy.exc.SQLAlchemyError as exc:
+            logger.exception('Database error while sync: %r', exc)
+            return self._save_each(entries)
+        return set()
+
+    def _save_each(self, entries):
+        """Fallback of :meth:`sync`, save the entries one by one.
+
+        Returns the names of the entries which could not be saved.
+        """
+        _failed = set()
+        for entry in entries:
+            try:
+                with self.metrics.timer('entry_save_seconds'):
+                    entry.save()  # save to database
+                logger.debug(
+                    '{name} save to database'.format(name=entry.name))
+            except Exception as exc:
+                logger.exception(exc)
+                _failed.add(entry.name)
+        return _failed
+
     def update_from_dict(self, mapping):
+        try:
+            entries = self.Entry.from_entries(
+                mapping, Session=self.Session, app=self.app,
+                session_scope=self.session_scope)
+        except Exception as exc:
+            logger.exception(
+                'Cannot add entries in bulk, adding one by one: %r', exc)
+            entries = self._entries_from_dict(mapping)
+        s = {name: entry for name, entry in entries.items()
+             if entry.enabled and self.owns(entry)}
+
+        # update self.schedule
+        self.schedule.update(s)
+        self._save_next_run_at(s.values())
+
+    def _entries_from_dict(self, mapping):
+        """Fallback of :meth:`update_from_dict`, one transaction by entry."""
         s = {}
         for name, entry_fields in mapping.items():
             # {'task': 'celery.backend_cleanup',
             #  'schedule': schedules.crontab('0', '4', '*'),
             #  'options': {'expires': 43200}}
             try:
-                entry = self.Entry.from_entry(
+                s[name] = self.Entry.from_entry(
                     name, Session=self.Session, app=self.app,
                     **entry_fields)
-                if entry.model.enabled:
-                    s[name] = entry
             except Exception as exc:
                 logger.error(ADD_ENTRY_ERROR, name, exc, entry_fields)
-
-        # update self.schedule
-        self.schedule.update(s)
+        return s
 
     def install_default_entries(self, data):
         entries = {}
@@ -415,11 +1682,15 @@ class DatabaseScheduler(Scheduler):
         if self._heap_invalidated:
             self._heap_invalidated = False
             return False
+        if self._heap_patched:
+            self._heap_patched = False
+            self.old_schedulers = copy.copy(self._schedule)
+            return True
         return super(DatabaseScheduler, self).schedules_equal(*args, **kwargs)
 
     @property
     def schedule(self):
-        initial = update = False
+        initial = update = refresh = False
         if self._initial_read:
             logger.debug('DatabaseScheduler: initial read')
             initial = update = True
@@ -428,21 +1699,49 @@ class DatabaseScheduler(Scheduler):
             # when you updated the `PeriodicTasks` model's `last_update` field
             logger.info('DatabaseScheduler: Schedule changed.')
             update = True
+        elif self.lookahead_expired():
+            logger.info('DatabaseScheduler: Lookahead window moved.')
+            update = refresh = True
+        if self.shards and self.coordinator.refresh_due():
+            if self.coordinator.refresh() and not initial:
+                logger.info('DatabaseScheduler: Shards changed.')
+                update = refresh = True
 
         if update:
-            self.sync()
-            self._schedule = self.all_as_schedule()
-            # the schedule changed, invalidate the heap in Scheduler.tick
-            if not initial:
-                self._heap = []
-                self._heap_invalidated = True
-            if logger.isEnabledFor(logging.DEBUG):
-                logger.debug('Current schedule:\n%s', '\n'.join(
-                    repr(entry) for entry in self._schedule.values()),
-                )
+            with self.metrics.timer('schedule_reload_seconds'):
+                patched = self._reload(initial, refresh)
+            self.metrics.incr('schedule_reloads_total')
+            if patched:
+                return self._schedule
+        if self.shards and self._tick_session is None:
+            # the schedule is reloaded without the shards given up
+            self.coordinator.release()
         # logger.debug(self._schedule)
         return self._schedule
 
+    def _reload(self, initial=False, refresh=False):
+        """Save the run state and load the schedule again.
+
+        Returns True when only the changed tasks were loaded.
+        """
+        self.sync()
+        if not (initial or refresh) and self.incremental_reload:
+            self._patch_schedule()
+            return True
+        schedule = self.all_as_schedule()
+        if self.write_behind or self._dirty:
+            # not saved yet
+            self._keep_run_state(schedule)
+        old, self._schedule = self._schedule, schedule
+        self._save_next_run_at(self._schedule.values())
+        if not initial:
+            self._reindex(old)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Current schedule:\n%s', '\n'.join(
+                repr(entry) for entry in self._schedule.values()),
+            )
+        return False
+
     @property
     def info(self):
         """override"""
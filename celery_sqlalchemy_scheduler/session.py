@@ -1,15 +1,19 @@
 # coding=utf-8
 """SQLAlchemy session."""
 
+import os
 from contextlib import contextmanager
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, exc, inspect
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.pool import NullPool
 
+from celery.utils.log import get_logger
 from kombu.utils.compat import register_after_fork
 
+logger = get_logger('celery_sqlalchemy_scheduler.session')
+
 ModelBase = declarative_base()
 
 
@@ -24,10 +28,79 @@ def session_cleanup(session):
         session.close()
 
 
+@contextmanager
+def session_scope(Session, **kwargs):
+    """Provide a new session, committed when the block succeeds."""
+    session = Session(**kwargs)
+    with session_cleanup(session):
+        yield session
+        session.commit()
+
+
 def _after_fork_cleanup_session(session):
     session._after_fork()
 
 
+def _on_connect(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    # A connection inherited from the parent process must not be used, nor
+    # closed: that would end the parent's session on the server as well.
+    pid = os.getpid()
+    if connection_record.info['pid'] != pid:
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError(
+            'Connection record belongs to pid {0}, '
+            'attempting to check out in pid {1}'.format(
+                connection_record.info['pid'], pid))
+
+
+def make_fork_safe(engine):
+    """Keep the pool of the engine from handing out connections that
+    were opened before the process forked.
+    """
+    event.listen(engine, 'connect', _on_connect)
+    event.listen(engine, 'checkout', _on_checkout)
+    return engine
+
+
+def add_missing_columns(engine, metadata):
+    """Add the columns and the indexes of ``metadata`` missing from the
+    existing tables, so databases created by an older version keep
+    working. Only nullable columns can be added this way, and unique
+    indexes only when the rows are unique already.
+    """
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    preparer = engine.dialect.identifier_preparer
+    for table in metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        columns = {column['name']
+                   for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in columns:
+                continue
+            with engine.begin() as connection:
+                connection.execute('ALTER TABLE {0} ADD COLUMN {1} {2}'.format(
+                    preparer.format_table(table),
+                    preparer.format_column(column),
+                    column.type.compile(dialect=engine.dialect)))
+        indexes = {index['name']
+                   for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in indexes:
+                continue
+            try:
+                index.create(engine)
+            except exc.IntegrityError as error:
+                logger.warning('Cannot create the unique index %s, remove '
+                               'the duplicate rows of %s first: %r',
+                               index.name, table.name, error.orig)
+
+
 class SessionManager(object):
     """Manage SQLAlchemy sessions."""
 
@@ -42,12 +115,30 @@ class SessionManager(object):
     def _after_fork(self):
         self.forked = True
 
+    @staticmethod
+    def _engine_key(dburi, kwargs):
+        try:
+            return dburi, frozenset(kwargs.items())
+        except TypeError:
+            # ``connect_args`` and the like aren't hashable
+            return dburi, repr(sorted(kwargs.items()))
+
     def get_engine(self, dburi, **kwargs):
-        if self.forked:
+        """Return the engine of ``dburi``.
+
+        Engine options (``pool_size``, ``max_overflow``, ``pool_recycle``,
+        ``pool_pre_ping``, ...) ask for a pooled engine, shared by the
+        sessions of the process asking for the same options. Without
+        options the engine doesn't pool connections until the process
+        forked.
+        """
+        if self.forked or kwargs:
+            key = self._engine_key(dburi, kwargs)
             try:
-                return self._engines[dburi]
+                return self._engines[key]
             except KeyError:
-                engine = self._engines[dburi] = create_engine(dburi, **kwargs)
+                engine = self._engines[key] = make_fork_safe(
+                    create_engine(dburi, **kwargs))
                 return engine
         else:
             return create_engine(dburi, poolclass=NullPool)
@@ -55,15 +146,17 @@ class SessionManager(object):
     def create_session(self, dburi, short_lived_sessions=False, **kwargs):
         engine = self.get_engine(dburi, **kwargs)
         if self.forked:
-            if short_lived_sessions or dburi not in self._sessions:
-                self._sessions[dburi] = sessionmaker(bind=engine)
-            return engine, self._sessions[dburi]
+            key = self._engine_key(dburi, kwargs)
+            if short_lived_sessions or key not in self._sessions:
+                self._sessions[key] = sessionmaker(bind=engine)
+            return engine, self._sessions[key]
         else:
             return engine, sessionmaker(bind=engine)
 
     def prepare_models(self, engine):
         if not self.prepared:
             ModelBase.metadata.create_all(engine)
+            add_missing_columns(engine, ModelBase.metadata)
             self.prepared = True
 
     def session_factory(self, dburi, **kwargs):
@@ -0,0 +1,109 @@
+# coding=utf-8
+"""Solar schedules sharing the solar events they compute.
+
+celery's ``solar`` asks ephem for the next event on every ``is_due()``.
+:class:`CachedSolar` takes it from :data:`solar_events` instead, which
+computes the events of a location once a day for all the schedules of
+that location.
+"""
+
+import bisect
+import datetime as dt
+import threading
+
+from celery import schedules
+
+ONE_DAY = dt.timedelta(days=1)
+ONE_SECOND = dt.timedelta(seconds=1)
+
+# Bound the search of days without the event, like the polar nights.
+MAX_DAYS = 400
+
+# Days of events kept, by location and event.
+SOLAR_CACHE_SIZE = 4096
+
+
+class SolarEvents(object):
+    """The solar events by location and by day (UTC), computed once.
+
+    Unlike celery's ``solar``, a day without the event (the sun doesn't
+    rise or set there) isn't a run of the task: the next event is looked
+    for in the following days.
+    """
+
+    def __init__(self):
+        self._days = {}
+        self._lock = threading.Lock()
+
+    def next_event(self, schedule, after):
+        """Return the first event of ``schedule`` after ``after``, both
+        aware datetimes in UTC.
+        """
+        day = after.date()
+        for _ in range(MAX_DAYS):
+            events = self.day_events(schedule, day)
+            index = bisect.bisect_right(events, after)
+            if index < len(events):
+                return events[index]
+            day += ONE_DAY
+        raise RuntimeError('No {0} in {1} days at latitude {2}, longitude '
+                           '{3}'.format(schedule.event, MAX_DAYS,
+                                        schedule.lat, schedule.lon))
+
+    def day_events(self, schedule, day):
+        """Return the events of ``schedule`` during ``day``, sorted."""
+        key = (schedule.event, schedule.lat, schedule.lon, day)
+        try:
+            return self._days[key]
+        except KeyError:
+            pass
+        with self._lock:
+            events = self._compute(schedule, day)
+            if len(self._days) >= SOLAR_CACHE_SIZE:
+                self._days.clear()
+            self._days[key] = events
+        return events
+
+    def _compute(self, schedule, day):
+        start = dt.datetime.combine(day, dt.time(), tzinfo=dt.timezone.utc)
+        end = start + ONE_DAY
+        ephem, cal = schedule.ephem, schedule.cal
+        events = []
+        when = start
+        while when < end:
+            cal.date = when
+            try:
+                if schedule.use_center:
+                    next_utc = getattr(cal, schedule.method)(
+                        ephem.Sun(), start=when, use_center=True)
+                else:
+                    next_utc = getattr(cal, schedule.method)(
+                        ephem.Sun(), start=when)
+            except ephem.CircumpolarError:
+                # no event today, look again after the next anti-transit
+                next_utc = ephem.Date(
+                    cal.next_antitransit(ephem.Sun()) + ephem.minute)
+                when = next_utc.datetime().replace(tzinfo=dt.timezone.utc)
+                continue
+            event = next_utc.datetime().replace(tzinfo=dt.timezone.utc)
+            if event >= end:
+                break
+            events.append(event)
+            when = event + ONE_SECOND
+        return events
+
+    def clear(self):
+        self._days.clear()
+
+
+solar_events = SolarEvents()
+
+
+class CachedSolar(schedules.solar):
+    """``solar`` taking its events from :data:`solar_events`."""
+
+    def remaining_estimate(self, last_run_at):
+        after = self.maybe_make_aware(last_run_at).astimezone(
+            dt.timezone.utc)
+        next_utc = solar_events.next_event(self, after)
+        return next_utc - self.maybe_make_aware(self.now())
@@ -1,7 +1,16 @@
 # coding=utf-8
-"""Timezone aware Cron schedule Implementation."""
+"""Timezone aware Cron schedule Implementation.
 
+The next fire time is the first minute after the last run matching all the
+fields, on the wall clock of the timezone of the schedule. A fire time
+skipped by a DST transition fires shifted by the length of the gap. One
+repeated by a transition fires once, at its first occurrence, unless the
+hour field matches every hour: the hour repeated is then a run of its own.
+"""
+
+import calendar
 import pytz
+from bisect import bisect_left
 from collections import namedtuple
 import datetime as dt
 
@@ -10,6 +19,17 @@ from celery import schedules
 
 schedstate = namedtuple('schedstate', ('is_due', 'next'))
 
+ONE_MINUTE = dt.timedelta(minutes=1)
+ONE_HOUR = dt.timedelta(hours=1)
+ONE_DAY = dt.timedelta(days=1)
+
+# Years searched for the next fire time, the weekdays of the dates repeat
+# after 28 years.
+MAX_YEARS = 28
+
+# Fire times cached by crontab, the schedules are shared by the entries.
+FIRE_CACHE_SIZE = 4096
+
 
 class TzAwareCrontab(schedules.crontab):
     """Timezone Aware Crontab."""
@@ -29,11 +49,17 @@ class TzAwareCrontab(schedules.crontab):
             # tz=tz,
             nowfun=nowfun, app=app
         )
+        # sorted for the bisections of `next_fire`
+        self._minutes = tuple(sorted(self.minute))
+        self._hours = tuple(sorted(self.hour))
+        self._days = tuple(sorted(self.day_of_month))
+        self._months = tuple(sorted(self.month_of_year))
+        # the hour repeated when the clocks are set back runs again
+        self._every_hour = len(self.hour) == 24
+        self._fires = {}
 
     def nowfunc(self):
-        return self.tz.normalize(
-            pytz.utc.localize(dt.datetime.utcnow())
-        )
+        return dt.datetime.now(self.tz)
 
     def is_due(self, last_run_at):
         """Calculate when the next run will take place.
@@ -42,16 +68,121 @@ class TzAwareCrontab(schedules.crontab):
         The last_run_at argument needs to be timezone aware.
 
         """
-        # convert last_run_at to the schedule timezone
-        last_run_at = last_run_at.astimezone(self.tz)
-
-        rem_delta = self.remaining_estimate(last_run_at)
-        rem = max(rem_delta.total_seconds(), 0)
-        due = rem == 0
-        if due:
-            rem_delta = self.remaining_estimate(self.now())
-            rem = max(rem_delta.total_seconds(), 0)
-        return schedstate(due, rem)
+        now = self.now()
+        fire = self.next_fire(last_run_at)
+        if now < fire:
+            return schedstate(False, (fire - now).total_seconds())
+        # the entry runs now, `last_run_at` won't come back
+        self._fires.pop(last_run_at, None)
+        return schedstate(True, (self._fire_after(now) - now).total_seconds())
+
+    def remaining_estimate(self, last_run_at):
+        return self.next_fire(last_run_at) - self.now()
+
+    def next_fire(self, last_run_at):
+        """Return the first fire time after ``last_run_at``, both timezone
+        aware.
+        """
+        try:
+            return self._fires[last_run_at]
+        except KeyError:
+            pass
+        fire = self._fire_after(last_run_at)
+        if len(self._fires) >= FIRE_CACHE_SIZE:
+            self._fires.clear()
+        self._fires[last_run_at] = fire
+        return fire
+
+    def _fire_after(self, instant):
+        wall = instant.astimezone(self.tz).replace(tzinfo=None)
+        fire = self._first_fire(wall, instant)
+        occurrences = self._occurrences(wall)
+        if (self._every_hour and len(occurrences) == 2 and
+                occurrences[0] == instant):
+            # the wall times before this one come again after the
+            # transition, their second occurrences may come first
+            repeated = wall - (occurrences[1] - occurrences[0])
+            fire = min(fire, self._first_fire(repeated, instant))
+        return fire
+
+    def _first_fire(self, wall, instant):
+        """Return the first fire time after ``instant`` of the wall times
+        after ``wall``.
+        """
+        while True:
+            wall = self._next_wall_time(wall)
+            occurrences = self._occurrences(wall)
+            if not self._every_hour:
+                # like cron, a fixed time runs once on the day it repeats
+                occurrences = occurrences[:1]
+            for fire in occurrences:
+                if fire > instant:
+                    return fire
+
+    def _next_wall_time(self, after):
+        """Return the first naive minute after ``after`` matching all the
+        fields.
+        """
+        t = after.replace(second=0, microsecond=0) + ONE_MINUTE
+        last_year = t.year + MAX_YEARS
+        while t.year <= last_year:
+            if t.month not in self.month_of_year:
+                i = bisect_left(self._months, t.month)
+                if i < len(self._months):
+                    t = dt.datetime(t.year, self._months[i], 1)
+                else:
+                    t = dt.datetime(t.year + 1, self._months[0], 1)
+                continue
+            if t.day not in self.day_of_month:
+                i = bisect_left(self._days, t.day)
+                if (i < len(self._days) and self._days[i] <=
+                        calendar.monthrange(t.year, t.month)[1]):
+                    t = dt.datetime(t.year, t.month, self._days[i])
+                elif t.month == 12:
+                    t = dt.datetime(t.year + 1, 1, 1)
+                else:
+                    t = dt.datetime(t.year, t.month + 1, 1)
+                continue
+            # Sunday is day 0
+            if t.isoweekday() % 7 not in self.day_of_week:
+                t = dt.datetime(t.year, t.month, t.day) + ONE_DAY
+                continue
+            if t.hour not in self.hour:
+                i = bisect_left(self._hours, t.hour)
+                if i == len(self._hours):
+                    t = dt.datetime(t.year, t.month, t.day) + ONE_DAY
+                    continue
+                t = t.replace(hour=self._hours[i], minute=0)
+            if t.minute not in self.minute:
+                i = bisect_left(self._minutes, t.minute)
+                if i == len(self._minutes):
+                    t = t.replace(minute=0) + ONE_HOUR
+                    continue
+                t = t.replace(minute=self._minutes[i])
+            return t
+        raise RuntimeError('unable to rollover, '
+                           'time specification is probably invalid')
+
+    def _occurrences(self, wall):
+        """Return the instants of the naive ``wall`` time, in order: two
+        when a DST transition repeats it, the wall time shifted by the
+        gap when one skips it.
+        """
+        tz = self.tz
+        if not hasattr(tz, 'localize'):
+            # zoneinfo
+            first = wall.replace(tzinfo=tz, fold=0)
+            second = wall.replace(tzinfo=tz, fold=1)
+            if first.utcoffset() > second.utcoffset():
+                return (first, second)
+            return (first,)
+        try:
+            return (tz.localize(wall, is_dst=None),)
+        except pytz.AmbiguousTimeError:
+            return (tz.localize(wall, is_dst=True),
+                    tz.localize(wall, is_dst=False))
+        except pytz.NonExistentTimeError:
+            return (tz.normalize(tz.localize(wall, is_dst=False)),)
 
     # Needed to support pickling
     def __repr__(self):
@@ -0,0 +1,186 @@
+# coding=utf-8
+"""Hierarchical timing wheel of the schedule entries, by due time.
+
+With ``beat_timing_wheel`` the scheduler keeps its entries in a
+:class:`TimingWheel` instead of the heap of ``Scheduler.tick``: adding,
+moving and removing an entry doesn't depend on the size of the schedule,
+so the reloads update the entries that changed instead of building the
+heap again.
+"""
+
+# The wheels turn by steps of RESOLUTION seconds. Level 0 has a slot by
+# step, each slot of the next level spans the whole level below: with 64
+# slots and 4 levels the wheels cover 64 ** 4 steps, about 194 days, the
+# entries due later wait in the overflow.
+RESOLUTION = 1.0  # seconds
+SLOTS = 64
+LEVELS = 4
+
+# Turning the wheels step by step after a longer pause costs more than
+# placing the entries again.
+MAX_STEPS = SLOTS ** 2
+
+OVERFLOW = -1
+
+
+class TimingWheel(object):
+    """The entries by due time, as epochs.
+
+    The entries are kept by name, adding one replaces the entry of the
+    same name. The slots hold ``{name: (due_at, entry)}``, the exact due
+    times, so the resolution only groups the entries.
+    """
+
+    def __init__(self, now, resolution=RESOLUTION, slots=SLOTS,
+                 levels=LEVELS):
+        self.resolution = resolution
+        self.slots = slots
+        self.levels = levels
+        self._wheels = [[{} for _ in range(slots)] for _ in range(levels)]
+        self._overflow = {}
+        # name -> (level, slot), or (OVERFLOW, None)
+        self._where = {}
+        # the steps before it are done
+        self._step = self._to_step(now)
+
+    def _to_step(self, when):
+        return int(when // self.resolution)
+
+    def __len__(self):
+        return len(self._where)
+
+    def __contains__(self, name):
+        return name in self._where
+
+    def add(self, entry, due_at):
+        """Add the entry due at ``due_at``, or move the entry of the same
+        name there.
+        """
+        self.remove(entry.name)
+        self._place(entry.name, due_at, entry)
+
+    def _place(self, name, due_at, entry):
+        # the entries overdue go to the current slot
+        delta = max(self._to_step(due_at) - self._step, 0)
+        step = self._step + delta
+        width = 1
+        for level in range(self.levels):
+            if delta < width * self.slots:
+                slot = (step // width) % self.slots
+                self._wheels[level][slot][name] = (due_at, entry)
+                self._where[name] = (level, slot)
+                return
+            width *= self.slots
+        self._overflow[name] = (due_at, entry)
+        self._where[name] = (OVERFLOW, None)
+
+    def _bucket(self, where):
+        level, slot = where
+        if level == OVERFLOW:
+            return self._overflow
+        return self._wheels[level][slot]
+
+    def remove(self, name):
+        where = self._where.pop(name, None)
+        if where is not None:
+            del self._bucket(where)[name]
+
+    def replace(self, entry):
+        """Replace the entry of the same name, keeping its due time.
+
+        Returns False when there is none.
+        """
+        where = self._where.get(entry.name)
+        if where is None:
+            return False
+        bucket = self._bucket(where)
+        bucket[entry.name] = (bucket[entry.name][0], entry)
+        return True
+
+    def pop_due(self, now):
+        """Remove and return the entries due at ``now``."""
+        target = self._to_step(now)
+        if target - self._step > MAX_STEPS:
+            self._jump(target)
+        due = []
+        wheel = self._wheels[0]
+        while self._step < target:
+            bucket = wheel[self._step % self.slots]
+            if bucket:
+                due.extend(self._take(bucket, bucket))
+            self._step += 1
+            self._cascade()
+        bucket = wheel[self._step % self.slots]
+        if bucket:
+            due.extend(self._take(bucket, [
+                name for name, (due_at, _) in bucket.items()
+                if due_at <= now]))
+        return due
+
+    def _take(self, bucket, names):
+        entries = []
+        for name in list(names):
+            entries.append(bucket.pop(name)[1])
+            del self._where[name]
+        return entries
+
+    def _cascade(self):
+        """Move the entries of the slots starting at the current step
+        down to the levels below.
+        """
+        width = 1
+        for level in range(1, self.levels):
+            width *= self.slots
+            if self._step % width:
+                return
+            bucket = self._wheels[level][(self._step // width) % self.slots]
+            self._replace_all(bucket)
+        self._replace_all(self._overflow)
+
+    def _replace_all(self, bucket):
+        items = list(bucket.items())
+        bucket.clear()
+        for name, (due_at, entry) in items:
+            del self._where[name]
+            self._place(name, due_at, entry)
+
+    def _jump(self, step):
+        """Move to ``step`` at once, placing all the entries again."""
+        items = []
+        for wheel in self._wheels:
+            for bucket in wheel:
+                items.extend(bucket.items())
+                bucket.clear()
+        items.extend(self._overflow.items())
+        self._overflow.clear()
+        self._where.clear()
+        self._step = step
+        for name, (due_at, entry) in items:
+            self._place(name, due_at, entry)
+
+    def next_due_at(self):
+        """Return when the first entry is due, or None when there is
+        none.
+        """
+        if not self._where:
+            return None
+        first = None
+        width = 1
+        for wheel in self._wheels:
+            position = (self._step // width) % self.slots
+            # level 0 starts at the current step, the slot of the current
+            # step of the other levels was cascaded and holds later entries
+            start = 0 if width == 1 else 1
+            for offset in range(start, start + self.slots):
+                bucket = wheel[(position + offset) % self.slots]
+                if bucket:
+                    due_at = min(due_at for due_at, _ in bucket.values())
+                    if first is None or due_at < first:
+                        first = due_at
+                    break
+            width *= self.slots
+        if self._overflow:
+            due_at = min(due_at for due_at, _ in self._overflow.values())
+            if first is None or due_at < first:
+                first = due_at
+        return first
@@ -0,0 +1,240 @@
+# coding=utf-8
+"""Write-behind of the run state of the schedule entries.
+
+With ``beat_write_behind`` ``sync()`` hands the dirty entries over to
+:class:`WriteBehind`, whose threads save them while the beat loop goes on
+sending the tasks due.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+import sqlalchemy
+from celery.utils.log import get_logger
+
+from .session import session_scope
+
+logger = get_logger('celery_sqlalchemy_scheduler.writer')
+
+DEFAULT_MAX_PENDING = 10000
+
+# Entries saved by one executemany UPDATE.
+WRITE_BATCH = 1000
+
+# Seconds before saving again after a database error, doubled after each
+# failure up to the maximum.
+RETRY_DELAY = 1
+RETRY_MAX_DELAY = 30
+
+# How long closing the writer waits for the entries queued.
+CLOSE_TIMEOUT = 30  # seconds
+
+# How often the waits for the threads check that they are still running.
+ALIVE_CHECK_INTERVAL = 1  # seconds
+
+
+class WriteBehind(object):
+    """Save the run state of the entries with background threads.
+
+    The entries waiting to be saved are kept by name: an entry queued
+    again before it was saved replaces the previous one, and the threads
+    never save two entries of the same name at once. :meth:`put` only
+    blocks when ``max_pending`` names are waiting already, `stats` tells
+    how often and how long it did.
+
+    :param fields: the columns to save, see ``ModelEntry.save_many``
+    """
+
+    def __init__(self, Session, Entry, workers=1, max_pending=None,
+                 fields=None):
+        self.Session = Session
+        self.Entry = Entry
+        self.fields = fields
+        self.max_pending = max_pending or DEFAULT_MAX_PENDING
+        self._pending = OrderedDict()
+        self._writing = set()
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._retry_at = 0
+        self._retry_delay = RETRY_DELAY
+        self.stats = {
+            'queued': 0,
+            'coalesced': 0,
+            'saved': 0,
+            'failed': 0,
+            'dropped': 0,
+            'max_pending': 0,
+            'blocked': 0,
+            'blocked_seconds': 0.0,
+        }
+        self._threads = [
+            threading.Thread(target=self._run, daemon=True,
+                             name='celery-beat-writer-{0}'.format(i))
+            for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    @property
+    def pending(self):
+        """The number of entries waiting to be saved or being saved."""
+        with self._cond:
+            return len(self._pending) + len(self._writing)
+
+    def put(self, entries):
+        """Queue the entries to be saved."""
+        stats = self.stats
+        with self._cond:
+            for entry in entries:
+                if entry.name in self._pending:
+                    stats['coalesced'] += 1
+                else:
+                    self._wait_for_room()
+                self._pending[entry.name] = entry
+                stats['queued'] += 1
+                stats['max_pending'] = max(stats['max_pending'],
+                                           len(self._pending))
+            self._cond.notify_all()
+
+    def _wait_for_room(self):
+        if len(self._pending) < self.max_pending:
+            return
+        logger.warning('Write-behind: %d entries waiting to be saved, '
+                       'waiting for the database.', len(self._pending))
+        started = time.monotonic()
+        # the threads may not know about the entries queued so far
+        self._cond.notify_all()
+        while len(self._pending) >= self.max_pending:
+            if not self._alive():
+                break
+            self._cond.wait(ALIVE_CHECK_INTERVAL)
+        self.stats['blocked'] += 1
+        self.stats['blocked_seconds'] += time.monotonic() - started
+
+    def flush(self, timeout=None):
+        """Wait until the entries queued are saved.
+
+        Returns False if they are not after ``timeout`` seconds.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._pending or self._writing:
+                if not self._alive():
+                    return False
+                remaining = ALIVE_CHECK_INTERVAL
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    remaining = min(remaining, ALIVE_CHECK_INTERVAL)
+                self._cond.wait(remaining)
+        return True
+
+    def _alive(self):
+        """Return False, once, when the threads stopped with entries left
+        to save.
+        """
+        if any(thread.is_alive() for thread in self._threads):
+            return True
+        if not self._stopping:
+            logger.error('Write-behind: The threads stopped, %d entries '
+                         'are not saved.', len(self._pending))
+            self._stopping = True
+        return False
+
+    def close(self, timeout=CLOSE_TIMEOUT):
+        """Save the entries queued and stop the threads."""
+        if not self.flush(timeout):
+            logger.warning('Write-behind: %d entries could not be saved.',
+                           self.pending)
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(1)
+        logger.info('Write-behind: %(saved)d entries saved, %(coalesced)d '
+                    'coalesced, blocked %(blocked)d times.', self.stats)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                batch = self._take()
+                while not batch and not self._stopping:
+                    self._cond.wait(self._retry_in())
+                    batch = self._take()
+            if not batch:
+                return
+            self._save(batch)
+
+    def _retry_in(self):
+        remaining = self._retry_at - time.monotonic()
+        return remaining if remaining > 0 else None
+
+    def _take(self):
+        if time.monotonic() < self._retry_at:
+            return []
+        batch = []
+        for name in list(self._pending):
+            if name in self._writing:
+                # saved by another thread, the newer entry goes next
+                continue
+            batch.append(self._pending.pop(name))
+            self._writing.add(name)
+            if len(batch) >= WRITE_BATCH:
+                break
+        if batch:
+            # room for the beat loop waiting in put()
+            self._cond.notify_all()
+        return batch
+
+    def _save(self, batch):
+        retry = dropped = ()
+        try:
+            retry, dropped = self._save_entries(batch)
+        finally:
+            with self._cond:
+                self._writing.difference_update(
+                    entry.name for entry in batch)
+                self.stats['saved'] += len(batch) - len(retry) - len(dropped)
+                self.stats['failed'] += len(retry)
+                self.stats['dropped'] += len(dropped)
+                for entry in retry:
+                    # unless a newer run state is queued already
+                    self._pending.setdefault(entry.name, entry)
+                if retry:
+                    self._retry_at = time.monotonic() + self._retry_delay
+                    self._retry_delay = min(self._retry_delay * 2,
+                                            RETRY_MAX_DELAY)
+                else:
+                    self._retry_delay = RETRY_DELAY
+                self._cond.notify_all()
+
+    def _save_entries(self, batch):
+        """Save the entries, one by one when they can't be saved at once.
+
+        Returns the lists of the entries to save again, the database
+        failing, and of the ones which can't be saved, dropped.
+        """
+        try:
+            with session_scope(self.Session) as session:
+                self.Entry.save_many(session, batch, self.fields)
+        except sqlalchemy.exc.SQLAlchemyError as exc:
+            logger.exception('Write-behind: Database error while saving '
+                             '%d entries: %r', len(batch), exc)
+            return batch, []
+        except Exception as exc:
+            if len(batch) == 1:
+                logger.exception('Write-behind: Cannot save %s, dropping '
+                                 'its run state: %r', batch[0].name, exc)
+                return [], batch
+            logger.exception('Write-behind: Cannot save %d entries, saving '
+                             'them one by one: %r', len(batch), exc)
+            retry, dropped = [], []
+            for entry in batch:
+                failed = self._save_entries([entry])
+                retry.extend(failed[0])
+                dropped.extend(failed[1])
+            return retry, dropped
+        logger.debug('%d entries save to database', len(batch))
+        return [], []
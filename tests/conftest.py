@@ -0,0 +1,72 @@
+# coding=utf-8
+import pytest
+from celery import Celery
+from sqlalchemy import create_engine
+
+from celery_sqlalchemy_scheduler.async_schedulers import \
+    AsyncDatabaseScheduler
+from celery_sqlalchemy_scheduler.schedulers import DatabaseScheduler
+from celery_sqlalchemy_scheduler.session import ModelBase
+
+
+class Result(object):
+    id = 'result'
+
+
+class Recording(object):
+    """Record the names of the tasks sent instead of publishing them."""
+
+    def __init__(self, *args, **kwargs):
+        self.sent = []
+        super(Recording, self).__init__(*args, **kwargs)
+
+    def apply_async(self, entry, producer=None, advance=True, **kwargs):
+        if advance:
+            self.reserve(entry)
+        self.sent.append(entry.name)
+        return Result()
+
+
+class RecordingScheduler(Recording, DatabaseScheduler):
+    pass
+
+
+class RecordingAsyncScheduler(Recording, AsyncDatabaseScheduler):
+    pass
+
+
+@pytest.fixture
+def dburi(tmp_path):
+    dburi = 'sqlite:///{0}'.format(tmp_path / 'schedule.db')
+    # the session manager prepares the first database of the process only
+    engine = create_engine(dburi)
+    ModelBase.metadata.create_all(engine)
+    engine.dispose()
+    return dburi
+
+
+@pytest.fixture
+def app(dburi):
+    app = Celery('tests', broker='memory://', set_as_current=False)
+    app.conf.update(beat_dburi=dburi, timezone='UTC', result_expires=None,
+                    beat_schedule={})
+    return app
+
+
+@pytest.fixture
+def make_scheduler(app):
+    """Return a factory of schedulers, closed after the test."""
+    schedulers = []
+
+    def make_scheduler(scheduler_class=RecordingScheduler, **kwargs):
+        scheduler = scheduler_class(app=app, **kwargs)
+        schedulers.append(scheduler)
+        return scheduler
+
+    yield make_scheduler
+    for scheduler in schedulers:
+        scheduler.close()
+        scheduler.close_coordinator()
+        scheduler.close_elector()
+        scheduler.close_notifier()
+        scheduler.close_metrics()
@@ -0,0 +1,81 @@
+# coding=utf-8
+"""Entries running on a fake clock, to check when the batch and the timing
+wheel send them against the ``is_due()`` of celery at every step.
+"""
+import datetime as dt
+import random
+
+from celery import schedules
+
+START = 1700000000.0
+STEP = 0.5
+
+
+class Clock(object):
+
+    def __init__(self, now=START):
+        self.now = now
+
+    def __call__(self):
+        return dt.datetime.fromtimestamp(self.now, dt.timezone.utc)
+
+
+class SimEntry(object):
+    """The fields of ``ModelEntry`` the batch and the wheel use."""
+
+    def __init__(self, name, schedule, last_run_at):
+        self.name = name
+        self.schedule = schedule
+        self.last_run_at = last_run_at
+
+    @property
+    def interval_seconds(self):
+        if type(self.schedule) is schedules.schedule:
+            return self.schedule.seconds
+        return None
+
+    def is_due(self):
+        return self.schedule.is_due(self.last_run_at)
+
+    def due_at(self, now):
+        """The epoch the entry is due at, seen at ``now``."""
+        return now + max(self.schedule.remaining_estimate(
+            self.last_run_at).total_seconds(), 0)
+
+
+def interval_entries(clock, count=100, seed=0):
+    """Entries of random periods, some of them late already."""
+    rng = random.Random(seed)
+    entries = []
+    for i in range(count):
+        period = STEP * rng.randint(2, 40)
+        last_run_at = clock() - dt.timedelta(
+            seconds=STEP * rng.randint(0, 80))
+        entries.append(SimEntry(
+            'interval-{0}'.format(i),
+            schedules.schedule(dt.timedelta(seconds=period), nowfun=clock),
+            last_run_at))
+    return entries
+
+
+def brute_force(clock, entries, duration):
+    """Return the ``(epoch, name)`` of the runs, checking every entry at
+    every step.
+    """
+    runs = []
+    end = clock.now + duration
+    while clock.now < end:
+        for entry in entries:
+            if entry.is_due()[0]:
+                runs.append((clock.now, entry.name))
+                entry.last_run_at = clock()
+        clock.now += STEP
+    return sorted(runs)
+
+
+def wake_up_in(clock, delay):
+    """Move the clock to the first step after ``delay``, like a beat
+    sleeping that long and waking up on the next step.
+    """
+    steps = max(-(-delay // STEP), 1)
+    clock.now += steps * STEP
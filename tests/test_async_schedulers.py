@@ -0,0 +1,94 @@
+# coding=utf-8
+import datetime as dt
+import threading
+import time
+
+import pytest
+from sqlalchemy import event
+
+from celery_sqlalchemy_scheduler.async_schedulers import create_async_engine
+from celery_sqlalchemy_scheduler.models import PeriodicTask
+
+from .conftest import RecordingAsyncScheduler
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def run_count(scheduler, name='a'):
+    session = scheduler.Session()
+    try:
+        return session.query(PeriodicTask.total_run_count).filter_by(
+            name=name).scalar()
+    finally:
+        session.close()
+
+
+def make_due(scheduler):
+    session = scheduler.Session()
+    session.query(PeriodicTask).update({
+        'last_run_at': dt.datetime.utcnow() - dt.timedelta(minutes=2)})
+    session.commit()
+    session.close()
+    scheduler._reload(refresh=True)
+
+
+def run_through_the_loop(scheduler, engine):
+    """Send a task, save it, reload and close the scheduler, checking
+    that the event loop did the writes on ``engine``.
+    """
+    writes = []
+    event.listen(engine, 'before_cursor_execute', lambda *args: (
+        writes.append(threading.current_thread().name)
+        if args[2].startswith('UPDATE celery_periodic_task ') else None))
+
+    scheduler.tick()
+    assert scheduler.sent == ['a']
+    scheduler.sync()
+    wait_until(lambda: run_count(scheduler) == 1)
+    assert writes == ['celery-beat-db']
+
+    # picked up by the event loop once it polled the changes, applied by
+    # the next tick
+    wait_until(lambda: scheduler.notifier._last_timestamp is not None)
+    session = scheduler.Session()
+    task = session.query(PeriodicTask).filter_by(name='a').one()
+    session.add(PeriodicTask(name='b', task='tasks.b',
+                             interval_id=task.interval_id))
+    session.commit()
+    session.close()
+    wait_until(lambda: scheduler._reloaded is not None)
+    scheduler.tick()
+    assert sorted(scheduler._schedule) == ['a', 'b']
+    assert scheduler._schedule['a'].total_run_count == 1
+
+    # saved by the event loop before it stops
+    scheduler.reserve(scheduler._schedule['a'])
+    scheduler.close()
+    assert not scheduler._thread.is_alive()
+    assert run_count(scheduler) == 2
+    assert set(writes) == {'celery-beat-db'}
+
+
+def test_jobs_run_on_the_event_loop(app, make_scheduler):
+    app.conf.beat_schedule = {'a': {'task': 'tasks.a', 'schedule': 60}}
+    scheduler = make_scheduler(RecordingAsyncScheduler, max_interval=0.1)
+    make_due(scheduler)
+    assert scheduler.async_engine is None
+    run_through_the_loop(scheduler, scheduler.engine)
+
+
+@pytest.mark.skipif(create_async_engine is None,
+                    reason='needs SQLAlchemy 1.4 or later')
+def test_jobs_use_the_asyncio_engine(app, make_scheduler, dburi):
+    pytest.importorskip('aiosqlite')
+    app.conf.beat_schedule = {'a': {'task': 'tasks.a', 'schedule': 60}}
+    scheduler = make_scheduler(
+        RecordingAsyncScheduler, max_interval=0.1,
+        async_dburi=dburi.replace('sqlite://', 'sqlite+aiosqlite://', 1))
+    make_due(scheduler)
+    run_through_the_loop(scheduler, scheduler.async_engine.sync_engine)
@@ -0,0 +1,104 @@
+# coding=utf-8
+import datetime as dt
+
+import pytest
+from celery import schedules
+
+from celery_sqlalchemy_scheduler import batch as batch_module
+from celery_sqlalchemy_scheduler.batch import IntervalBatch
+from celery_sqlalchemy_scheduler.models import PeriodicTask
+
+from .simulation import (
+    Clock, SimEntry, brute_force, interval_entries, wake_up_in,
+)
+
+use_numpy = pytest.mark.parametrize('use_numpy', [
+    pytest.param(True, marks=pytest.mark.skipif(
+        batch_module.numpy is None, reason='needs NumPy')),
+    False,
+])
+
+
+def run_batch(clock, entries, duration, use_numpy):
+    """Return the runs sent the way ``batch_tick`` sends them, sleeping
+    for ``IntervalBatch.delay()`` in between.
+    """
+    batch = IntervalBatch(use_numpy=use_numpy)
+    for entry in entries:
+        assert batch.add(entry, entry.due_at(clock.now))
+    runs = []
+    end = clock.now + duration
+    while clock.now < end:
+        for entry in batch.due(clock.now):
+            is_due, next_time_to_run = entry.is_due()
+            if is_due:
+                runs.append((clock.now, entry.name))
+                entry.last_run_at = clock()
+            batch.add(entry, clock.now + next_time_to_run)
+        wake_up_in(clock, batch.delay(clock.now))
+    return sorted(runs)
+
+
+@use_numpy
+def test_runs_match_is_due(use_numpy):
+    clock = Clock()
+    expected = brute_force(clock, interval_entries(clock), 120)
+    clock = Clock()
+    runs = run_batch(clock, interval_entries(clock), 120, use_numpy)
+    assert runs == expected
+    # more than the first slots allocated
+    assert len({name for _, name in runs}) == 100
+
+
+@use_numpy
+def test_discarded_entries_are_not_due(use_numpy):
+    clock = Clock()
+    batch = IntervalBatch(use_numpy=use_numpy)
+    entries = interval_entries(clock, count=3)
+    for entry in entries:
+        batch.add(entry, clock.now)
+    batch.discard(entries[1].name)
+    assert entries[1].name not in batch and len(batch) == 2
+    assert batch.due(clock.now) == [entries[0], entries[2]]
+    # the slot is reused
+    batch.add(entries[1], clock.now + 5)
+    assert batch.slots[entries[1].name] == 1
+    assert batch.delay(clock.now) == 0
+    for entry in (entries[0], entries[2]):
+        batch.discard(entry.name)
+    assert batch.due(clock.now) == []
+    assert batch.delay(clock.now) == 5
+
+
+def test_only_plain_intervals_are_batched():
+    clock = Clock()
+    batch = IntervalBatch(use_numpy=False)
+    entry = SimEntry('crontab', schedules.crontab(nowfun=clock), clock())
+    assert not batch.add(entry)
+    assert len(batch) == 0 and batch.delay(clock.now) is None
+    interval = SimEntry('interval', schedules.schedule(
+        dt.timedelta(seconds=10), nowfun=clock), clock())
+    assert batch.add(interval, clock.now + 10)
+    assert batch.delay(clock.now) == 10
+
+
+def test_scheduler_sends_the_batch_once(app, make_scheduler):
+    app.conf.beat_schedule = {
+        'interval': {'task': 'tasks.interval', 'schedule': 60},
+        'crontab': {'task': 'tasks.crontab',
+                    'schedule': schedules.crontab()},
+    }
+    scheduler = make_scheduler(batch_intervals=True)
+    session = scheduler.Session()
+    session.query(PeriodicTask).update({
+        'last_run_at': dt.datetime.utcnow() - dt.timedelta(minutes=2)})
+    session.commit()
+    session.close()
+    scheduler._reload(refresh=True)
+    scheduler.tick()
+    assert list(scheduler._batch.slots) == ['interval']
+    for _ in range(5):
+        scheduler.tick()
+    assert scheduler.sent.count('interval') == 1
+    assert 0 < scheduler.tick() <= 60
+    assert scheduler.sent.count('interval') == 1
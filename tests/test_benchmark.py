@@ -0,0 +1,28 @@
+# coding=utf-8
+import json
+import os
+import subprocess
+import sys
+
+BENCHMARK = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'benchmarks', 'bench_scheduler.py')
+
+
+def test_benchmark_runs_and_compares(tmp_path):
+    output = str(tmp_path / 'results.json')
+    subprocess.check_call([
+        sys.executable, BENCHMARK, '-n', '50', '--repeat', '1',
+        '--ticks', '5', '-o', output])
+    with open(output) as f:
+        report = json.load(f)
+    results = {(result['backend'], result['n']): result
+               for result in report['results']}
+    assert sorted(results) == [('sqlite-file', 50), ('sqlite-memory', 50)]
+    for result in results.values():
+        for metric in ('load', 'tick', 'sync', 'schedule_changed',
+                       'reload'):
+            assert metric in result
+
+    comparison = subprocess.check_output([
+        sys.executable, BENCHMARK, '--compare', output, output])
+    assert b'1.00x' in comparison
@@ -0,0 +1,186 @@
+# coding=utf-8
+import datetime as dt
+import time
+
+import pytest
+from celery import schedules
+
+from celery_sqlalchemy_scheduler.coordination import STANDBY_INTERVAL
+from celery_sqlalchemy_scheduler.models import (
+    BeatLease, IntervalSchedule, PeriodicTask,
+)
+from celery_sqlalchemy_scheduler.schedulers import (
+    ModelEntry, session_manager,
+)
+
+
+def add_task(dburi, name='a', seconds=60):
+    """Add a task due now."""
+    Session = session_manager.create_session(dburi)[1]
+    session = Session()
+    try:
+        interval = IntervalSchedule.from_schedule(
+            session, schedules.schedule(dt.timedelta(seconds=seconds)))
+        session.add(PeriodicTask(
+            name=name, task='tasks.' + name, interval_id=interval.id,
+            last_run_at=dt.datetime.utcnow() - dt.timedelta(
+                seconds=seconds * 2)))
+        session.commit()
+    finally:
+        session.close()
+
+
+def test_polling_tick_wakes_up_to_renew_the_lease(dburi, make_scheduler):
+    add_task(dburi)
+    scheduler = make_scheduler(standby=True, lease_ttl=3, max_interval=60)
+    scheduler.tick()
+    assert scheduler.is_leader
+    # the task runs in a minute, the lease is renewed every second
+    assert 0 < scheduler.tick() <= 1
+
+
+def test_polling_tick_wakes_up_to_renew_the_shards(dburi, make_scheduler):
+    add_task(dburi)
+    scheduler = make_scheduler(shards=4, lease_ttl=3, max_interval=60)
+    scheduler.tick()
+    assert scheduler.coordinator.owned == frozenset(range(4))
+    assert 0 < scheduler.tick() <= 1
+
+
+def run_due(scheduler):
+    """Tick until no task is due, celery sends one per tick."""
+    for _ in range(100):
+        if scheduler.tick():
+            break
+
+
+def refresh(scheduler):
+    """Tick with the leases refreshed right away."""
+    scheduler.coordinator._next_refresh = 0
+    run_due(scheduler)
+
+
+def expire_node(scheduler, node_id):
+    """Expire the leases of a beat, like it stopped."""
+    session = scheduler.Session()
+    try:
+        session.query(BeatLease).filter_by(owner=node_id).update(
+            {'expires_at': dt.datetime.utcnow() - dt.timedelta(seconds=1)},
+            synchronize_session=False)
+        session.commit()
+    finally:
+        session.close()
+
+
+def test_shards_are_shared_and_taken_over(dburi, make_scheduler):
+    names = sorted('task-{0}'.format(i) for i in range(16))
+    for name in names:
+        add_task(dburi, name)
+    first = make_scheduler(shards=8, node_id='first', lease_ttl=3)
+    run_due(first)
+    assert first.coordinator.owned == frozenset(range(8))
+    assert sorted(first.sent) == names
+
+    second = make_scheduler(shards=8, node_id='second', lease_ttl=3)
+    run_due(second)
+    # the first beat gives up the shards of the second one
+    refresh(first)
+    refresh(second)
+    owned = first.coordinator.owned, second.coordinator.owned
+    assert owned[0] and owned[1]
+    assert not owned[0] & owned[1]
+    assert owned[0] | owned[1] == frozenset(range(8))
+    assert set(second.schedule) | set(first.schedule) == set(names)
+    assert not set(second.schedule) & set(first.schedule)
+    # saved by the first beat before it gave the shards up
+    assert second.sent == []
+
+    # the second beat stops, its shards come back to the first one
+    expire_node(second, 'second')
+    refresh(first)
+    assert first.coordinator.owned == frozenset(range(8))
+    assert sorted(first.schedule) == names
+    assert sorted(first.sent) == names
+
+
+def run_count(scheduler, name='a'):
+    session = scheduler.Session()
+    try:
+        return session.query(PeriodicTask.total_run_count).filter_by(
+            name=name).scalar()
+    finally:
+        session.close()
+
+
+def test_leader_failover(dburi, make_scheduler):
+    add_task(dburi)
+    first = make_scheduler(standby=True, node_id='first', lease_ttl=3)
+    second = make_scheduler(standby=True, node_id='second', lease_ttl=3)
+    first.tick()
+    second.tick()
+    assert first.is_leader and not second.is_leader
+    assert first.sent == ['a'] and second.sent == []
+    first.sync()
+
+    # the leader stops renewing its lease
+    expire_node(first, 'first')
+    time.sleep(STANDBY_INTERVAL)
+    second.tick()
+    assert second.is_leader
+    # the run of the former leader isn't sent again
+    assert second.sent == []
+    assert second.schedule['a'].total_run_count == 1
+
+    # the former leader stands by once it sees the lease taken
+    first.elector._next_refresh = 0
+    first.tick()
+    assert not first.is_leader
+    assert first.sent == ['a']
+    assert run_count(first) == 1
+
+
+def test_claimed_runs_are_sent_once(dburi, make_scheduler):
+    names = sorted('task-{0}'.format(i) for i in range(8))
+    for name in names:
+        add_task(dburi, name)
+    first = make_scheduler(claim_runs=True)
+    second = make_scheduler(claim_runs=True)
+    # both beats loaded the runs due
+    assert sorted(first.schedule) == sorted(second.schedule) == names
+    run_due(first)
+    run_due(second)
+    assert sorted(first.sent) == names
+    assert second.sent == []
+    # the beat which lost the claims took the run state of the rows
+    assert {entry.total_run_count
+            for entry in second.schedule.values()} == {1}
+    assert {run_count(first, name) for name in names} == {1}
+
+
+@pytest.mark.parametrize('method', ['claim_many', 'claim_each'])
+def test_runs_are_claimed_once(dburi, make_scheduler, method):
+    names = ['a', 'b', 'c']
+    for name in names:
+        add_task(dburi, name)
+    beats = [make_scheduler(), make_scheduler()]
+    sessions = [beat.Session() for beat in beats]
+    results = []
+    try:
+        for beat, session in zip(beats, sessions):
+            claims = [(entry, next(entry))
+                      for entry in beat.schedule.values()]
+            now = claims[0][1].last_run_at
+            for _, next_entry in claims:
+                next_entry.last_run_at = now
+            results.append(getattr(ModelEntry, method)(session, claims, now))
+            session.commit()
+    finally:
+        for session in sessions:
+            session.close()
+    ids = {entry.id for entry in beats[0].schedule.values()}
+    (claimed, _), (lost, state) = results
+    assert claimed == ids
+    assert lost == set()
+    assert {id_: count for id_, (count, _) in state.items()} == \
+        dict.fromkeys(ids, 1)
+    assert {run_count(beats[0], name) for name in names} == {1}
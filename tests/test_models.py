@@ -0,0 +1,191 @@
+# coding=utf-8
+import datetime as dt
+from collections import OrderedDict
+
+import pytest
+import sqlalchemy as sa
+from celery import schedules
+from sqlalchemy import event
+from sqlalchemy.orm import Query
+
+from celery_sqlalchemy_scheduler.models import (
+    CrontabSchedule, IntervalSchedule, PeriodicTask, schedule_cache,
+    schedule_ids,
+)
+from celery_sqlalchemy_scheduler.schedulers import session_manager
+
+
+def every(seconds):
+    return schedules.schedule(dt.timedelta(seconds=seconds))
+
+
+@pytest.fixture
+def Session(dburi):
+    engine, Session = session_manager.create_session(dburi)
+    yield Session
+    engine.dispose()
+
+
+def count(Session, **spec):
+    session = Session()
+    try:
+        return session.query(IntervalSchedule).filter_by(**spec).count()
+    finally:
+        session.close()
+
+
+def test_unique_schedule_rows(Session):
+    session = Session()
+    session.add(IntervalSchedule(every=10, period='seconds'))
+    session.commit()
+    session.add(IntervalSchedule(every=10, period='seconds'))
+    with pytest.raises(sa.exc.IntegrityError):
+        session.commit()
+    session.rollback()
+    session.close()
+    assert count(Session, every=10) == 1
+
+
+def test_row_inserted_by_another_process(Session, monkeypatch):
+    other = Session()
+    other.add(IntervalSchedule(every=20, period='seconds'))
+    other.commit()
+    existing = other.query(IntervalSchedule).one().id
+    other.close()
+
+    session = Session()
+    session.add(PeriodicTask(name='before', task='tasks.before'))
+    session.flush()
+    with monkeypatch.context() as patch:
+        # inserted after the lookup of this session
+        patch.setattr(Query, 'first', lambda query: None)
+        model = IntervalSchedule.from_schedule(session, every(20))
+    assert model.id == existing
+    # the failed insert only rolled back its SAVEPOINT
+    session.commit()
+    session.close()
+    assert count(Session, every=20) == 1
+    session = Session()
+    assert session.query(PeriodicTask).filter_by(name='before').count()
+    session.close()
+
+
+def test_rolled_back_rows_are_forgotten(Session):
+    size = len(schedule_ids)
+    session = Session()
+    IntervalSchedule.from_schedule(session, every(30))
+    session.rollback()
+    session.close()
+    assert count(Session, every=30) == 0
+    assert len(schedule_ids) == size
+
+
+def test_cached_ids_are_used_without_queries(Session):
+    session = Session()
+    created = IntervalSchedule.from_schedule(session, every(40)).id
+    session.commit()
+    session.close()
+
+    statements = []
+    session = Session()
+    engine = session.get_bind()
+    event.listen(engine, 'before_cursor_execute',
+                 lambda *args: statements.append(args[2]))
+    model = IntervalSchedule.from_schedule(session, every(40))
+    assert statements == []
+    assert (model.id, model.every, model.period) == (created, 40, 'seconds')
+    session.add(PeriodicTask(name='task', task='tasks.task', interval=model))
+    session.commit()
+    assert count(Session, every=40) == 1
+
+    # dropped once the row is edited
+    model.every = 41
+    session.commit()
+    session.close()
+    session = Session()
+    assert IntervalSchedule.from_schedule(session, every(40)).id != created
+    session.commit()
+    session.close()
+
+
+def test_least_recently_used_ids_are_dropped(Session, monkeypatch):
+    monkeypatch.setattr(schedule_ids, 'maxsize', 2)
+    monkeypatch.setattr(schedule_ids, '_ids', OrderedDict())
+    monkeypatch.setattr(schedule_ids, '_keys', {})
+    session = Session()
+    for seconds in (50, 51):
+        IntervalSchedule.from_schedule(session, every(seconds))
+    session.commit()
+    assert len(schedule_ids) == 2
+    # used again, the first one is kept
+    IntervalSchedule.from_schedule(session, every(50))
+    IntervalSchedule.from_schedule(session, every(52))
+    session.commit()
+    session.close()
+    assert [key[2] for key in schedule_ids._ids] == [
+        (50, 'seconds'), (52, 'seconds')]
+
+
+def load_schedules(Session):
+    session = Session()
+    try:
+        return {task.name: task.schedule
+                for task in session.query(PeriodicTask)}
+    finally:
+        session.close()
+
+
+def test_compiled_schedules_are_shared(Session):
+    session = Session()
+    interval = IntervalSchedule(every=60, period='seconds')
+    crontab = CrontabSchedule(minute='*/5')
+    session.add_all([
+        PeriodicTask(name='a', task='tasks.a', interval=interval),
+        PeriodicTask(name='b', task='tasks.b', interval=interval),
+        PeriodicTask(name='c', task='tasks.c', crontab=crontab),
+    ])
+    session.commit()
+    session.close()
+    # by the tasks of the row, whatever the session loading them
+    first, second = load_schedules(Session), load_schedules(Session)
+    assert first['a'] is first['b'] is second['a']
+    assert first['c'] is second['c']
+    assert first['a'].run_every == dt.timedelta(seconds=60)
+
+
+def test_edited_schedule_rows_are_compiled_again(Session):
+    session = Session()
+    interval = IntervalSchedule(every=60, period='seconds')
+    session.add(PeriodicTask(name='a', task='tasks.a', interval=interval))
+    session.commit()
+    key = (interval.__tablename__, interval.id)
+    compiled = interval.schedule
+    assert schedule_cache._schedules[key][1] is compiled
+
+    # edited in this process, dropped by the update
+    interval.every = 30
+    session.flush()
+    assert key not in schedule_cache._schedules
+    session.commit()
+    session.close()
+    edited = load_schedules(Session)['a']
+    assert edited.run_every == dt.timedelta(seconds=30)
+
+    # edited by another process, the values differ on the next access
+    session = Session()
+    session.execute(IntervalSchedule.__table__.update().values(every=20))
+    session.commit()
+    session.close()
+    assert key in schedule_cache._schedules
+    assert load_schedules(Session)['a'].run_every == \
+        dt.timedelta(seconds=20)
+
+
+def test_entries_share_the_schedules(app, make_scheduler):
+    app.conf.beat_schedule = {
+        name: {'task': 'tasks.' + name, 'schedule': 10} for name in 'ab'}
+    scheduler = make_scheduler()
+    schedule = scheduler.schedule
+    assert schedule['a'].schedule is schedule['b'].schedule
+    scheduler._reload(refresh=True)
+    assert scheduler._schedule['a'].schedule is schedule['b'].schedule
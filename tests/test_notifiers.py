@@ -0,0 +1,137 @@
+# coding=utf-8
+import itertools
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+from celery_sqlalchemy_scheduler import schedulers
+from celery_sqlalchemy_scheduler.models import PeriodicTask
+from celery_sqlalchemy_scheduler.notifiers import (
+    LocalNotifier, PollingNotifier,
+)
+
+pytestmark = pytest.mark.skipif(not hasattr(socket, 'AF_UNIX'),
+                                reason='needs UNIX sockets')
+
+
+changes = itertools.count()
+
+
+def change_schedule(scheduler):
+    session = scheduler.Session()
+    try:
+        session.add(PeriodicTask(name='changed-{0}'.format(next(changes)),
+                                 task='tasks.changed'))
+        session.commit()
+    finally:
+        session.close()
+
+
+def test_every_beat_is_notified(make_scheduler):
+    first = make_scheduler(change_notifier='local')
+    second = make_scheduler(change_notifier='local')
+    notifiers = [first.notifier, second.notifier]
+    assert all(isinstance(notifier, LocalNotifier) for notifier in notifiers)
+    assert notifiers[0].path != notifiers[1].path
+
+    change_schedule(first)
+    assert [notifier.wait(1) for notifier in notifiers] == [True, True]
+    assert [notifier.changed() for notifier in notifiers] == [True, True]
+    assert [notifier.changed() for notifier in notifiers] == [False, False]
+
+    # closing one beat leaves the socket of the other one alone
+    first.close_notifier()
+    assert os.path.exists(notifiers[1].path)
+    change_schedule(second)
+    assert notifiers[1].wait(1)
+    second.close_notifier()
+    assert not os.path.exists(notifiers[1].directory)
+
+
+def test_sockets_left_behind_are_removed(make_scheduler):
+    scheduler = make_scheduler(change_notifier='local')
+    directory = scheduler.notifier.directory
+    stale = os.path.join(directory, 'stale')
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(stale)
+    sock.close()
+    change_schedule(scheduler)
+    assert not os.path.exists(stale)
+    assert scheduler.notifier.changed()
+
+
+def test_socket_of_former_versions(make_scheduler, dburi):
+    path = dburi[len('sqlite:///'):] + '.notify'
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(path)
+    try:
+        # still listening, the beat polls instead
+        scheduler = make_scheduler(change_notifier='local')
+        assert not scheduler.notifier.push
+    finally:
+        sock.close()
+    # left behind
+    scheduler = make_scheduler(change_notifier='local')
+    assert isinstance(scheduler.notifier, LocalNotifier)
+    assert os.path.isdir(path)
+
+
+def timed_tick(scheduler):
+    started = time.monotonic()
+    delay = scheduler.tick()
+    return delay, time.monotonic() - started
+
+
+def test_change_wakes_up_the_tick(app, make_scheduler):
+    app.conf.beat_schedule = {'a': {'task': 'tasks.a', 'schedule': 60}}
+    scheduler = make_scheduler(change_notifier='local')
+    assert scheduler.notifier.push
+    result = []
+    ticking = threading.Thread(
+        target=lambda: result.append(timed_tick(scheduler)))
+    ticking.start()
+    # waiting for 'a', due in a minute
+    ticking.join(0.3)
+    assert ticking.is_alive()
+    change_schedule(scheduler)
+    ticking.join(5)
+    assert not ticking.is_alive()
+    delay, elapsed = result[0]
+    assert delay == 0 and elapsed < 5
+    # the next tick loads the change
+    scheduler.tick()
+    assert len(scheduler._schedule) == 2
+
+
+def test_wait_ends_when_the_next_task_is_due(app, make_scheduler,
+                                             monkeypatch):
+    app.conf.beat_schedule = {'a': {'task': 'tasks.a', 'schedule': 1}}
+    scheduler = make_scheduler(change_notifier='local')
+    # nothing changes, woken up when 'a' is due
+    delay, elapsed = timed_tick(scheduler)
+    assert delay == 0 and 0.5 < elapsed < 3
+    assert scheduler.sent == []
+    # woken up a little early by the drift of celery
+    deadline = time.monotonic() + 0.5
+    while not scheduler.sent and time.monotonic() < deadline:
+        scheduler.tick()
+    assert scheduler.sent == ['a']
+
+    # or by the bound of a single wait
+    app.conf.beat_schedule = {'b': {'task': 'tasks.b', 'schedule': 60}}
+    monkeypatch.setattr(schedulers, 'PUSH_MAX_WAIT', 0.5)
+    scheduler = make_scheduler(change_notifier='local')
+    delay, elapsed = timed_tick(scheduler)
+    assert delay == 0 and 0.4 < elapsed < 3
+
+
+def test_polling_tick_returns_the_poll_interval(app, make_scheduler):
+    app.conf.beat_schedule = {'a': {'task': 'tasks.a', 'schedule': 60}}
+    scheduler = make_scheduler(max_interval=5)
+    assert isinstance(scheduler.notifier, PollingNotifier)
+    # beat.Service sleeps, the tick doesn't
+    delay, elapsed = timed_tick(scheduler)
+    assert delay == 5 and elapsed < 1
@@ -0,0 +1,467 @@
+# coding=utf-8
+import datetime as dt
+import time
+
+import pytest
+from celery import schedules
+from sqlalchemy import event
+
+from celery_sqlalchemy_scheduler.async_schedulers import \
+    AsyncDatabaseScheduler
+from celery_sqlalchemy_scheduler.metrics import (
+    LoggingMetrics, PrometheusMetrics,
+)
+from celery_sqlalchemy_scheduler.models import PeriodicTask
+from celery_sqlalchemy_scheduler.schedulers import (
+    DatabaseScheduler, ModelEntry, _entry_layout,
+)
+
+
+def add_tasks(app, *names, **fields):
+    fields.setdefault('schedule', dt.timedelta(seconds=10))
+    app.conf.beat_schedule = {
+        name: dict(fields, task='tasks.' + name) for name in names}
+
+
+def rows(scheduler):
+    session = scheduler.Session()
+    try:
+        return {task.name: (task.total_run_count, task.last_run_at)
+                for task in session.query(PeriodicTask)}
+    finally:
+        session.close()
+
+
+def test_keep_run_state_of_rows_never_saved(app, make_scheduler):
+    add_tasks(app, 'a')
+    scheduler = make_scheduler()
+    sent = scheduler.reserve(scheduler.schedule['a'])
+    # not saved, the row has no last_run_at and loads as due now
+    reloaded = scheduler.all_as_schedule()
+    assert reloaded['a'].last_run_at > sent.last_run_at
+    scheduler._keep_run_state(reloaded)
+    assert reloaded['a'].total_run_count == 1
+    assert reloaded['a'].last_run_at == sent.last_run_at
+
+
+def test_reload_after_failed_sync_keeps_run_state(app, make_scheduler,
+                                                  monkeypatch):
+    add_tasks(app, 'a')
+    scheduler = make_scheduler()
+    scheduler.reserve(scheduler.schedule['a'])
+    with monkeypatch.context() as patch:
+        patch.setattr(scheduler, '_save_entries', lambda entries: {
+            entry.name for entry in entries})
+        scheduler._reload(refresh=True)
+    # the run is still to save
+    assert scheduler._dirty == {'a'}
+    assert scheduler._schedule['a'].total_run_count == 1
+    scheduler.sync()
+    assert rows(scheduler)['a'][0] == 1
+
+
+def test_async_reload_keeps_run_state(app, make_scheduler):
+    add_tasks(app, 'a', 'b')
+    scheduler = make_scheduler(AsyncDatabaseScheduler)
+    schedule = scheduler.schedule
+    for name in ('a', 'b'):
+        scheduler.reserve(schedule[name])
+    scheduler.reserve(scheduler._schedule['a'])
+    # loaded by the event loop before the runs were saved
+    scheduler._reloaded = ('load', scheduler.all_as_schedule())
+    scheduler._take_over_results()
+    assert {name: entry.total_run_count
+            for name, entry in scheduler._schedule.items()} == \
+        {'a': 2, 'b': 1}
+    scheduler.sync()
+    assert {name: count for name, (count, _) in rows(scheduler).items()} \
+        == {'a': 2, 'b': 1}
+
+
+def date_changed(scheduler):
+    session = scheduler.Session()
+    try:
+        return {task.name: task.date_changed
+                for task in session.query(PeriodicTask)}
+    finally:
+        session.close()
+
+
+def test_saving_the_run_state_keeps_date_changed(app, make_scheduler):
+    add_tasks(app, 'a', 'b')
+    scheduler = make_scheduler()
+    edited = date_changed(scheduler)
+    schedule = scheduler.schedule
+    time.sleep(1.1)
+    scheduler.reserve(schedule['a'])
+    scheduler.sync()
+    entry = scheduler.reserve(scheduler._schedule['b'])
+    entry.save()
+    assert date_changed(scheduler) == edited
+    assert {name: count for name, (count, _) in rows(scheduler).items()} \
+        == {'a': 1, 'b': 1}
+    assert rows(scheduler)['a'][1] == \
+        scheduler._schedule['a'].last_run_at.replace(tzinfo=None)
+
+
+def test_one_off_task_disabled_for_the_other_beats(app, make_scheduler):
+    add_tasks(app, 'once')
+    first = make_scheduler(incremental_reload=True)
+    second = make_scheduler(incremental_reload=True)
+    # last edited well before the loads
+    session = first.Session()
+    session.query(PeriodicTask).update({
+        'one_off': True,
+        'last_run_at': dt.datetime.utcnow() - dt.timedelta(minutes=1),
+        'date_changed': dt.datetime.utcnow() - dt.timedelta(hours=1),
+    }, synchronize_session=False)
+    session.commit()
+    session.close()
+    for scheduler in (first, second):
+        scheduler._reload(refresh=True)
+
+    sent = first.reserve(first.schedule['once'])
+    # disabled by the first check after its run
+    assert sent.is_due() == (False, None)
+    changed, removed = second.changed_as_schedule()
+    assert removed == {'once'}
+    second._patch_schedule((changed, removed))
+    assert 'once' not in second._schedule
+
+
+def test_incremental_reload_drops_deleted_tasks(app, make_scheduler):
+    add_tasks(app, 'a', 'b', 'c')
+    scheduler = make_scheduler(incremental_reload=True)
+    assert sorted(scheduler.schedule) == ['a', 'b', 'c']
+    # beat_schedule was saved after the first load
+    scheduler._patch_schedule()
+    session = scheduler.Session()
+    for name in ('b', 'c'):
+        session.delete(session.query(PeriodicTask).filter_by(
+            name=name).one())
+    session.commit()
+    # added again
+    session.add(PeriodicTask(name='c', task='tasks.c', interval_id=(
+        session.query(PeriodicTask).filter_by(name='a').one().interval_id)))
+    session.commit()
+    session.close()
+
+    statements = []
+    event.listen(scheduler.engine, 'before_cursor_execute',
+                 lambda *args: statements.append(args[2]))
+    changed, removed = scheduler.changed_as_schedule()
+    # the rows changed shortly before the last load are read again
+    assert 'c' in changed and 'b' not in changed
+    assert removed == {'b'}
+    # only the changed tasks are read, not the names of all of them
+    assert not [statement for statement in statements
+                if 'FROM celery_periodic_task \n' in statement and
+                'date_changed >=' not in statement]
+    scheduler._patch_schedule((changed, removed))
+    assert sorted(scheduler._schedule) == ['a', 'c']
+
+
+class SlottedEntry(ModelEntry):
+    __slots__ = ('extra',)
+
+
+class UnslottedEntry(ModelEntry):
+    pass
+
+
+def test_entry_copies_keep_to_the_slots(app, make_scheduler):
+    add_tasks(app, 'a')
+    assert _entry_layout(ModelEntry) == (ModelEntry.__slots__, False)
+    assert _entry_layout(SlottedEntry) == (
+        ('extra',) + ModelEntry.__slots__, False)
+    assert _entry_layout(UnslottedEntry) == (ModelEntry.__slots__, True)
+
+    scheduler = make_scheduler()
+    entry = scheduler.schedule['a']
+    for cls in (SlottedEntry, UnslottedEntry):
+        copy = cls.__new__(cls)
+        for field in ModelEntry.__slots__:
+            setattr(copy, field, getattr(entry, field))
+        copy.extra = 'extra'
+        following = next(copy)
+        assert type(following) is cls
+        assert following.extra == 'extra'
+        assert following.name == 'a' and following.total_run_count == 1
+
+
+def test_lookahead_loads_the_tasks_due_within_the_window(app,
+                                                         make_scheduler):
+    app.conf.beat_schedule = {
+        'soon': {'task': 'tasks.soon', 'schedule': 10},
+        'later': {'task': 'tasks.later', 'schedule': 3600},
+    }
+    scheduler = make_scheduler(lookahead_window=60)
+    # not knowing when they are due yet
+    assert sorted(scheduler.schedule) == ['later', 'soon']
+    scheduler.sync()
+    session = scheduler.Session()
+    next_run_at = {task.name: task.next_run_at
+                   for task in session.query(PeriodicTask)}
+    session.close()
+    assert next_run_at['soon'] < next_run_at['later']
+    scheduler._reload(refresh=True)
+    assert sorted(scheduler._schedule) == ['soon']
+
+    # due within the window by the next load
+    session = scheduler.Session()
+    session.query(PeriodicTask).filter_by(name='later').update({
+        'next_run_at': dt.datetime.utcnow() + dt.timedelta(seconds=30)},
+        synchronize_session=False)
+    session.commit()
+    session.close()
+    assert not scheduler.lookahead_expired()
+    scheduler._lookahead_reload_at = time.monotonic()
+    assert sorted(scheduler.schedule) == ['later', 'soon']
+
+
+def test_entries_are_reconciled_in_bulk(app, make_scheduler):
+    add_tasks(app, 'same', 'edited')
+    scheduler = make_scheduler()
+    edited = date_changed(scheduler)
+    mapping = dict(app.conf.beat_schedule)
+    mapping['edited'] = dict(mapping['edited'], args=(1,))
+    for name in ('new-1', 'new-2'):
+        mapping[name] = {'task': 'tasks.' + name,
+                         'schedule': dt.timedelta(seconds=10)}
+    mapping['new-crontab'] = {'task': 'tasks.new-crontab',
+                              'schedule': schedules.crontab(minute='*/5')}
+
+    statements = []
+    event.listen(scheduler.engine, 'before_cursor_execute',
+                 lambda *args: statements.append(args[2].split()[:3]))
+    time.sleep(1.1)
+    entries = ModelEntry.from_entries(mapping, Session=scheduler.Session,
+                                      app=app)
+    assert sorted(entries) == sorted(mapping)
+    assert entries['edited'].args == [1]
+    # the tasks and each schedule table read once, whatever the entries
+    reads = [words[1].split('.')[0] for words in statements
+             if words[0] == 'SELECT']
+    assert sorted(set(reads) - {'celery_periodic_task_changed'}) == [
+        'celery_crontab_schedule', 'celery_interval_schedule',
+        'celery_periodic_task', 'celery_solar_schedule']
+    assert len(reads) - reads.count('celery_periodic_task_changed') == 4
+    writes = [words[:3] for words in statements
+              if words[0] in ('INSERT', 'UPDATE') and
+              words[1:3] != ['celery_periodic_task_changed', 'SET']]
+    assert writes.count(['UPDATE', 'celery_periodic_task', 'SET']) == 1
+    assert writes.count(['INSERT', 'INTO', 'celery_periodic_task']) == 3
+    # the interval of the existing tasks is used again
+    assert ['INSERT', 'INTO', 'celery_interval_schedule'] not in writes
+    assert writes.count(['INSERT', 'INTO', 'celery_crontab_schedule']) == 1
+
+    session = scheduler.Session()
+    interval_ids = {task.name: task.interval_id
+                    for task in session.query(PeriodicTask)}
+    session.close()
+    assert interval_ids['new-1'] == interval_ids['new-2'] == \
+        interval_ids['same']
+    assert interval_ids['new-crontab'] is None
+    changed = date_changed(scheduler)
+    assert changed['same'] == edited['same']
+    assert changed['edited'] > edited['edited']
+
+
+def test_invalid_arguments_disable_the_task_on_first_access(app,
+                                                            make_scheduler):
+    add_tasks(app, 'bad-args', 'bad-kwargs', 'good')
+    scheduler = make_scheduler()
+    session = scheduler.Session()
+    session.query(PeriodicTask).update({
+        'last_run_at': dt.datetime.utcnow() - dt.timedelta(minutes=1)})
+    session.query(PeriodicTask).filter_by(name='bad-args').update({
+        'args': '[1,'})
+    session.query(PeriodicTask).filter_by(name='bad-kwargs').update({
+        'kwargs': '{"a": }'})
+    session.commit()
+    session.close()
+    scheduler._reload(refresh=True)
+    schedule = scheduler._schedule
+    # loading doesn't decode them
+    assert all(entry._args is None for entry in schedule.values())
+    assert sorted(schedule) == ['bad-args', 'bad-kwargs', 'good']
+
+    # disabled when due
+    assert schedule['bad-args'].is_due() == (False, 5.0)
+    # or when read before
+    assert schedule['bad-kwargs'].kwargs == {}
+    assert schedule['good'].is_due()[0]
+    assert schedule['good'].args == []
+    assert {name: entry.enabled for name, entry in schedule.items()} == {
+        'bad-args': False, 'bad-kwargs': False, 'good': True}
+    session = scheduler.Session()
+    assert {task.name: task.enabled
+            for task in session.query(PeriodicTask)} == {
+        'bad-args': False, 'bad-kwargs': False, 'good': True}
+    session.close()
+    # changed, removed by the next reload
+    assert scheduler.schedule_changed()
+    scheduler._reload(refresh=True)
+    assert sorted(scheduler._schedule) == ['good']
+
+
+def test_entry_copies_keep_the_decoded_arguments(app, make_scheduler,
+                                                 monkeypatch):
+    add_tasks(app, 'a', args=(1, 2), kwargs={'b': 3})
+    scheduler = make_scheduler()
+    entry = scheduler.schedule['a']
+    assert entry.args == [1, 2]
+    decoded = []
+    monkeypatch.setattr(ModelEntry, '_decode_arguments',
+                        lambda self: decoded.append(self.name))
+    following = next(next(entry))
+    assert following.total_run_count == entry.total_run_count + 2
+    assert following.args is entry.args
+    assert following.kwargs is entry.kwargs
+    assert dict(following)['kwargs'] == {'b': 3}
+    assert decoded == []
+
+
+def mixed_schedule(count):
+    """``count`` entries of as many schedule rows, of the three kinds."""
+    kinds = [
+        lambda i: dt.timedelta(seconds=10 + i),
+        lambda i: schedules.crontab(minute=i % 60, hour=i // 60),
+        lambda i: schedules.solar('sunset', i % 90, 2.35),
+    ]
+    return {
+        'task-{0}'.format(i): {'task': 'tasks.task',
+                               'schedule': kinds[i % 3](i)}
+        for i in range(count)
+    }
+
+
+@pytest.mark.parametrize('strategy,queries', [
+    ('selectin', 4), ('joined', 1), ('subquery', 4),
+    # one more by task
+    ('lazy', 61),
+])
+def test_schedules_loaded_with_the_tasks(app, make_scheduler, strategy,
+                                         queries):
+    app.conf.beat_schedule = mixed_schedule(60)
+    scheduler = make_scheduler(load_strategy=strategy)
+    scheduler.setup_schedule()
+    statements = []
+    event.listen(scheduler.engine, 'before_cursor_execute',
+                 lambda *args: statements.append(args[2]))
+    schedule = scheduler.all_as_schedule()
+    assert len(schedule) == 60
+    assert len(statements) == queries
+    assert schedule['task-4'].schedule.minute == {4}
+
+
+def test_one_commit_per_tick(app, make_scheduler):
+    add_tasks(app, 'a', 'b')
+    scheduler = make_scheduler(DatabaseScheduler, sync_every_tasks=1)
+    session = scheduler.Session()
+    session.query(PeriodicTask).update({
+        'last_run_at': dt.datetime.utcnow() - dt.timedelta(minutes=1)})
+    session.commit()
+    session.close()
+    scheduler._reload(refresh=True)
+
+    commits = []
+    event.listen(scheduler.engine, 'commit',
+                 lambda connection: commits.append(connection))
+    # sending and saving each task
+    for _ in range(2):
+        assert scheduler.tick() == 0
+        assert len(commits) == 1
+        del commits[:]
+    assert {name: count for name, (count, _) in rows(scheduler).items()} \
+        == {'a': 1, 'b': 1}
+
+    # reloading the schedule changed
+    session = scheduler.Session()
+    session.add(PeriodicTask(name='c', task='tasks.c', interval_id=(
+        session.query(PeriodicTask).filter_by(name='a').one().interval_id)))
+    session.commit()
+    session.close()
+    del commits[:]
+    assert scheduler.tick() > 0
+    assert len(commits) == 1
+    assert sorted(scheduler._schedule) == ['a', 'b', 'c']
+
+
+def test_prometheus_rendering(app, make_scheduler):
+    metrics = PrometheusMetrics(make_scheduler())
+    metrics.incr('tasks_sent_total', 2)
+    metrics.incr('tasks_sent_total')
+    metrics.set('schedule_entries', 5)
+    metrics.add_collector(lambda metrics: metrics.set('extra', 1))
+    for size in (3, 30, 300000):
+        metrics.observe('sync_batch_size', size)
+    assert metrics.render().splitlines() == [
+        '# HELP celery_beat_tasks_sent_total Tasks sent.',
+        '# TYPE celery_beat_tasks_sent_total counter',
+        'celery_beat_tasks_sent_total 3',
+        '# TYPE celery_beat_extra gauge',
+        'celery_beat_extra 1',
+        '# HELP celery_beat_schedule_entries Entries of the schedule.',
+        '# TYPE celery_beat_schedule_entries gauge',
+        'celery_beat_schedule_entries 5',
+        '# HELP celery_beat_sync_batch_size Entries saved by a sync.',
+        '# TYPE celery_beat_sync_batch_size histogram',
+        'celery_beat_sync_batch_size_bucket{le="1"} 0',
+        'celery_beat_sync_batch_size_bucket{le="10"} 1',
+        'celery_beat_sync_batch_size_bucket{le="100"} 2',
+        'celery_beat_sync_batch_size_bucket{le="1000"} 2',
+        'celery_beat_sync_batch_size_bucket{le="10000"} 2',
+        'celery_beat_sync_batch_size_bucket{le="100000"} 2',
+        'celery_beat_sync_batch_size_bucket{le="+Inf"} 3',
+        'celery_beat_sync_batch_size_sum 300033',
+        'celery_beat_sync_batch_size_count 3',
+    ]
+
+
+def test_logging_metrics_summary(app, make_scheduler, caplog):
+    metrics = LoggingMetrics(make_scheduler())
+    metrics.incr('queries_total', 4)
+    metrics.set('schedule_entries', 2)
+    for seconds in (0.1, 0.3):
+        metrics.observe('tick_seconds', seconds)
+    caplog.set_level('INFO', 'celery_sqlalchemy_scheduler.metrics')
+    # not before the interval
+    metrics.flush()
+    assert 'Beat metrics' not in caplog.text
+    metrics.close()
+    assert ('Beat metrics: queries_total=4, schedule_entries=2, '
+            'tick_seconds: count=2 avg=0.2 max=0.3') in caplog.text
+
+
+def test_ticks_and_syncs_update_the_metrics(app, make_scheduler):
+    add_tasks(app, 'a', 'b')
+    scheduler = make_scheduler(metrics='prometheus')
+    session = scheduler.Session()
+    session.query(PeriodicTask).update({
+        'last_run_at': dt.datetime.utcnow() - dt.timedelta(minutes=1)})
+    session.commit()
+    session.close()
+    scheduler._reload(refresh=True)
+    metrics = scheduler.metrics
+    assert isinstance(metrics, PrometheusMetrics)
+    assert metrics.counters['rows_loaded_total'] == 2
+    assert metrics.counters['schedule_reloads_total'] == 1
+
+    ticks = 0
+    while len(scheduler.sent) < 2:
+        scheduler.tick()
+        ticks += 1
+    scheduler.sync()
+    metrics.collect()
+    assert metrics.counters['tasks_sent_total'] == 2
+    assert metrics.counters['queries_total'] > 0
+    assert metrics.gauges['schedule_entries'] == 2
+    histograms = metrics.histograms
+    assert histograms['tick_seconds'].count == ticks
+    # sent a minute late
+    assert histograms['send_lag_seconds'].count == 2
+    assert histograms['send_lag_seconds'].max >= 50
+    assert histograms['sync_batch_size'].sum == 2
+    assert histograms['sync_seconds'].count == 1
+    assert 'celery_beat_tasks_sent_total 2\n' in metrics.render()
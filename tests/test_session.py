@@ -0,0 +1,32 @@
+# coding=utf-8
+from celery_sqlalchemy_scheduler.session import SessionManager
+
+
+def test_engines_are_shared_by_options(dburi):
+    manager = SessionManager()
+    engine = manager.get_engine(dburi, pool_recycle=60)
+    assert manager.get_engine(dburi, pool_recycle=60) is engine
+    other = manager.get_engine(dburi, pool_recycle=90)
+    assert other is not engine
+    assert (engine.pool._recycle, other.pool._recycle) == (60, 90)
+
+
+def test_engine_options_not_hashable(dburi):
+    manager = SessionManager()
+    options = {'connect_args': {'timeout': 5}}
+    engine = manager.get_engine(dburi, **options)
+    assert manager.get_engine(dburi, **options) is engine
+    assert manager.get_engine(
+        dburi, connect_args={'timeout': 10}) is not engine
+
+
+def test_forked_sessions_follow_the_engine(dburi):
+    manager = SessionManager()
+    manager._after_fork()
+    engine, Session = manager.create_session(dburi, pool_recycle=60)
+    other_engine, other_Session = manager.create_session(
+        dburi, pool_recycle=90)
+    assert other_engine is not engine
+    assert Session.kw['bind'] is engine
+    assert other_Session.kw['bind'] is other_engine
+    assert manager.create_session(dburi, pool_recycle=60) == (engine, Session)
@@ -0,0 +1,90 @@
+# coding=utf-8
+import datetime as dt
+
+import pytest
+from celery import schedules
+
+from celery_sqlalchemy_scheduler.solar import (
+    ONE_DAY, CachedSolar, solar_events,
+)
+
+EVENTS = sorted(schedules.solar._all_events)
+
+PLACES = [
+    # (latitude, longitude, now)
+    (0.0, -78.5, dt.datetime(2024, 3, 20, 7, 30)),
+    (48.9, 2.35, dt.datetime(2024, 6, 10, 14, 0)),
+    (-33.9, 151.2, dt.datetime(2024, 9, 1, 2, 15)),
+    (64.1, -21.9, dt.datetime(2024, 12, 5, 23, 50)),
+    # polar day and polar night
+    (78.2, 15.6, dt.datetime(2024, 6, 21, 12, 0)),
+    (78.2, 15.6, dt.datetime(2024, 12, 21, 12, 0)),
+    (-77.8, 166.7, dt.datetime(2024, 6, 21, 0, 0)),
+]
+
+
+@pytest.fixture(autouse=True)
+def clear_events():
+    solar_events.clear()
+    yield
+    solar_events.clear()
+
+
+def solar(event, lat, lon, now):
+    now = now.replace(tzinfo=dt.timezone.utc)
+    return CachedSolar(event, lat, lon, nowfun=lambda: now)
+
+
+def celery_next_event(schedule, after):
+    """The next event by the ``remaining_estimate`` of celery, stepping a
+    day further when it fails for a day without the event.
+    """
+    for days in range(400):
+        try:
+            remaining = schedules.solar.remaining_estimate(
+                schedule, after + days * ONE_DAY)
+        except TypeError:
+            # celery adds a timedelta to an ephem.Date there
+            continue
+        return schedule.now() + remaining
+    raise AssertionError('no {0} found'.format(schedule.event))
+
+
+@pytest.mark.parametrize('lat,lon,now', PLACES)
+@pytest.mark.parametrize('event', EVENTS)
+def test_events_match_celery_solar(event, lat, lon, now):
+    schedule = solar(event, lat, lon, now)
+    last_run_at = schedule.now() - dt.timedelta(hours=3)
+    expected = celery_next_event(schedule, last_run_at)
+    next_event = schedule.now() + schedule.remaining_estimate(last_run_at)
+    assert abs(next_event - expected) < dt.timedelta(seconds=1)
+    assert next_event > last_run_at
+
+
+def test_events_are_computed_once_a_day(monkeypatch):
+    computed = []
+    compute = solar_events._compute
+
+    def counting(schedule, day):
+        computed.append((schedule.event, day))
+        return compute(schedule, day)
+    monkeypatch.setattr(solar_events, '_compute', counting)
+
+    now = dt.datetime(2024, 6, 10, 3, 0)
+    sunset = solar('sunset', 48.9, 2.35, now)
+    first = sunset.remaining_estimate(sunset.now())
+    # the other schedules of the place take them from the cache
+    again = solar('sunset', 48.9, 2.35, now)
+    for hours in range(0, 12, 3):
+        again.remaining_estimate(
+            again.now() + dt.timedelta(hours=hours))
+    assert again.remaining_estimate(again.now()) == first
+    assert computed == [('sunset', now.date())]
+
+    # another event or place has days of its own
+    solar('sunrise', 48.9, 2.35, now).remaining_estimate(sunset.now())
+    solar('sunset', 51.5, -0.1, now).remaining_estimate(sunset.now())
+    assert len(computed) == 3
+    # after the sunset of the day, the next day is computed
+    sunset.remaining_estimate(sunset.now() + dt.timedelta(hours=20))
+    assert computed[-1] == ('sunset', now.date() + ONE_DAY)
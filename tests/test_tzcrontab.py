@@ -0,0 +1,100 @@
+# coding=utf-8
+import datetime as dt
+
+import pytest
+import pytz
+
+from celery_sqlalchemy_scheduler.tzcrontab import TzAwareCrontab
+
+BERLIN = pytz.timezone('Europe/Berlin')
+ONE_MINUTE = dt.timedelta(minutes=1)
+
+
+def utc(*args):
+    return dt.datetime(*args, tzinfo=pytz.utc)
+
+
+def crontab(minute='*', hour='*', now=None):
+    schedule = TzAwareCrontab(minute, hour, tz=BERLIN)
+    schedule.nowfun = lambda: now
+    return schedule
+
+
+def repeated(wall):
+    """True for the second occurrence of a time the clocks were set back
+    over.
+    """
+    try:
+        BERLIN.localize(wall.replace(tzinfo=None), is_dst=None)
+    except pytz.AmbiguousTimeError:
+        return not wall.dst()
+    return False
+
+
+def brute_force(schedule, instant):
+    """The first minute after ``instant`` matching the fields, stepping
+    through the instants.
+    """
+    every_hour = len(schedule.hour) == 24
+    t = instant.replace(second=0, microsecond=0) + ONE_MINUTE
+    while True:
+        wall = t.astimezone(BERLIN)
+        if (wall.minute in schedule.minute and wall.hour in schedule.hour
+                and (every_hour or not repeated(wall))):
+            return t
+        t += ONE_MINUTE
+
+
+@pytest.mark.parametrize('minutes', [2, 10, 30])
+def test_every_minute_during_the_repeated_hour(minutes):
+    last_run_at = utc(2024, 10, 27, 1, 3)
+    now = last_run_at + dt.timedelta(minutes=minutes)
+    schedule = crontab(now=now)
+    is_due, next_time = schedule.is_due(last_run_at)
+    assert is_due
+    assert next_time == 60
+
+
+def test_repeated_time_runs_once():
+    # 02:30 CEST is 00:30 UTC, 02:30 CET comes at 01:30 UTC
+    schedule = crontab('30', '2')
+    assert schedule.next_fire(utc(2024, 10, 26, 12)) == \
+        utc(2024, 10, 27, 0, 30)
+    assert schedule.next_fire(utc(2024, 10, 27, 0, 30)) == \
+        utc(2024, 10, 28, 1, 30)
+    # 02:10 CET, after the first occurrence
+    assert schedule.next_fire(utc(2024, 10, 27, 1, 10)) == \
+        utc(2024, 10, 28, 1, 30)
+
+
+def test_repeated_hour_runs_again_every_hour():
+    schedule = crontab('30', '*')
+    assert schedule.next_fire(utc(2024, 10, 27, 0, 30)) == \
+        utc(2024, 10, 27, 1, 30)
+    assert schedule.next_fire(utc(2024, 10, 27, 1, 30)) == \
+        utc(2024, 10, 27, 2, 30)
+
+
+def test_skipped_time_runs_shifted_by_the_gap():
+    # 02:30 doesn't exist on 2024-03-31, 03:30 CEST is 01:30 UTC
+    schedule = crontab('30', '2')
+    assert schedule.next_fire(utc(2024, 3, 30, 12)) == \
+        utc(2024, 3, 31, 1, 30)
+
+
+@pytest.mark.parametrize('start', [
+    utc(2024, 3, 30, 22), utc(2024, 10, 26, 22)])
+@pytest.mark.parametrize('minute,hour', [
+    ('*', '*'), ('*/7', '*'), ('0,30', '*'), ('30', '2'), ('15', '1-3'),
+    ('59', '0,2')])
+def test_around_the_transitions(start, minute, hour):
+    schedule = crontab(minute, hour)
+    for step in range(0, 6 * 60, 7):
+        instant = start + dt.timedelta(minutes=step, seconds=13)
+        expected = brute_force(schedule, instant)
+        if expected.astimezone(BERLIN).dst() == \
+                instant.astimezone(BERLIN).dst():
+            assert schedule.next_fire(instant) == expected, instant
+        else:
+            # the times skipped by the gap run shifted by it
+            assert schedule.next_fire(instant) <= expected, instant
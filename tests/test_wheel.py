@@ -0,0 +1,119 @@
+# coding=utf-8
+import datetime as dt
+import random
+
+import pytest
+from celery import schedules
+
+from celery_sqlalchemy_scheduler.models import PeriodicTask
+from celery_sqlalchemy_scheduler.wheel import TimingWheel
+
+from .simulation import (
+    START, Clock, SimEntry, brute_force, interval_entries, wake_up_in,
+)
+
+wheel_sizes = pytest.mark.parametrize('slots,levels', [(64, 4), (4, 2)])
+
+
+def sim_entries(clock):
+    entries = interval_entries(clock, count=60)
+    for i, minute in enumerate(['*', '*/2', '*/5', '15,17', '20']):
+        entries.append(SimEntry(
+            'crontab-{0}'.format(i),
+            schedules.crontab(minute, nowfun=clock),
+            clock() - dt.timedelta(minutes=i, seconds=30)))
+    return entries
+
+
+def run_wheel(clock, entries, duration, **kwargs):
+    """Return the runs sent the way ``wheel_tick`` sends them, sleeping
+    until ``TimingWheel.next_due_at()`` in between.
+    """
+    wheel = TimingWheel(clock.now, **kwargs)
+    for entry in entries:
+        wheel.add(entry, entry.due_at(clock.now))
+    runs = []
+    end = clock.now + duration
+    while clock.now < end:
+        for entry in wheel.pop_due(clock.now):
+            is_due, next_time_to_run = entry.is_due()
+            if is_due:
+                runs.append((clock.now, entry.name))
+                entry.last_run_at = clock()
+            wheel.add(entry, clock.now + next_time_to_run)
+        assert len(wheel) == len(entries)
+        wake_up_in(clock, wheel.next_due_at() - clock.now)
+    return sorted(runs)
+
+
+@wheel_sizes
+def test_runs_match_is_due(slots, levels):
+    clock = Clock()
+    expected = brute_force(clock, sim_entries(clock), 600)
+    clock = Clock()
+    runs = run_wheel(clock, sim_entries(clock), 600, slots=slots,
+                     levels=levels)
+    assert runs == expected
+    assert {name for _, name in runs} >= {
+        'crontab-{0}'.format(i) for i in range(5)}
+
+
+class Named(object):
+
+    def __init__(self, name):
+        self.name = name
+
+
+@wheel_sizes
+def test_pop_due_across_the_levels(slots, levels):
+    rng = random.Random(0)
+    wheel = TimingWheel(START, slots=slots, levels=levels)
+    due_at = {}
+    for i in range(500):
+        name = 'entry-{0}'.format(i)
+        # up to a few days, past the overflow of the small wheel
+        due_at[name] = START + rng.choice([
+            rng.uniform(-5, 60), rng.uniform(0, 5000),
+            rng.uniform(0, 300000)])
+        wheel.add(Named(name), due_at[name])
+    # moved before it's due
+    wheel.add(Named('entry-0'), START + 10.5)
+    due_at['entry-0'] = START + 10.5
+    wheel.remove('entry-1')
+    del due_at['entry-1']
+
+    now = START
+    while due_at:
+        assert wheel.next_due_at() == min(due_at.values())
+        if now < START + 70:
+            # through the first minute, ending within the steps
+            now += 0.3
+        else:
+            now += rng.choice([1, 7.5, 90, 4000, 20000])
+        popped = {entry.name for entry in wheel.pop_due(now)}
+        assert popped == {name for name, when in due_at.items()
+                          if when <= now}
+        for name in popped:
+            del due_at[name]
+        assert len(wheel) == len(due_at)
+    assert wheel.next_due_at() is None
+
+
+def test_scheduler_sends_from_the_wheel_once(app, make_scheduler):
+    app.conf.beat_schedule = {
+        'interval': {'task': 'tasks.interval', 'schedule': 60},
+        'crontab': {'task': 'tasks.crontab',
+                    'schedule': schedules.crontab(minute='*/5')},
+    }
+    scheduler = make_scheduler(timing_wheel=True)
+    session = scheduler.Session()
+    session.query(PeriodicTask).update({
+        'last_run_at': dt.datetime.utcnow() - dt.timedelta(minutes=10)})
+    session.commit()
+    session.close()
+    scheduler._reload(refresh=True)
+    for _ in range(5):
+        scheduler.tick()
+    assert sorted(scheduler.sent) == ['crontab', 'interval']
+    assert 0 < scheduler.tick() <= 60
+    assert sorted(scheduler.sent) == ['crontab', 'interval']
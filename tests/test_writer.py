@@ -0,0 +1,159 @@
+# coding=utf-8
+import threading
+import time
+from collections import namedtuple
+
+import pytest
+import sqlalchemy
+
+from celery_sqlalchemy_scheduler import writer as writer_module
+from celery_sqlalchemy_scheduler.writer import WriteBehind
+
+Entry = namedtuple('Entry', ('name', 'run'))
+
+
+class Session(object):
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class Recorder(object):
+    """Stands for ``ModelEntry``, recording the batches saved. The saves
+    wait for ``gate`` and raise the errors of ``errors`` first.
+    """
+
+    def __init__(self):
+        self.saved = []
+        self.errors = []
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def save_many(self, session, entries, fields=None):
+        self.gate.wait(5)
+        if self.errors:
+            raise self.errors.pop(0)
+        for entry in entries:
+            if entry.run is None:
+                raise TypeError('no run state')
+        self.saved.append(list(entries))
+
+
+@pytest.fixture
+def recorder():
+    return Recorder()
+
+
+@pytest.fixture
+def make_writer(recorder, monkeypatch):
+    monkeypatch.setattr(writer_module, 'RETRY_DELAY', 0.01)
+    monkeypatch.setattr(writer_module, 'ALIVE_CHECK_INTERVAL', 0.05)
+    writers = []
+
+    def make_writer(**kwargs):
+        writer = WriteBehind(Session, recorder, **kwargs)
+        writers.append(writer)
+        return writer
+
+    yield make_writer
+    recorder.gate.set()
+    for writer in writers:
+        writer.close(timeout=1)
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_entries_queued_again_are_coalesced(make_writer, recorder):
+    writer = make_writer()
+    recorder.gate.clear()
+    writer.put([Entry('a', 1)])
+    # saving 'a', the others wait
+    wait_until(lambda: writer._writing)
+    writer.put([Entry('a', 2), Entry('b', 1)])
+    writer.put([Entry('b', 2), Entry('a', 3)])
+    assert writer.stats['coalesced'] == 2
+    recorder.gate.set()
+    assert writer.flush(5)
+    assert recorder.saved == [[Entry('a', 1)], [Entry('a', 3), Entry('b', 2)]]
+    assert writer.stats['saved'] == 3
+
+
+def test_entries_are_saved_again_after_a_database_error(make_writer,
+                                                        recorder):
+    writer = make_writer()
+    recorder.errors.append(sqlalchemy.exc.OperationalError(
+        'UPDATE', {}, Exception('gone')))
+    writer.put([Entry('a', 1), Entry('b', 1)])
+    assert writer.flush(5)
+    assert recorder.saved == [[Entry('a', 1), Entry('b', 1)]]
+    assert writer.stats['failed'] == 2 and writer.stats['saved'] == 2
+
+
+def test_entries_that_cannot_be_saved_are_dropped(make_writer, recorder):
+    writer = make_writer()
+    recorder.errors.append(ValueError('bad value'))
+    writer.put([Entry('a', 1)])
+    assert writer.flush(5)
+    writer.put([Entry('b', None), Entry('c', 1)])
+    assert writer.flush(5)
+    # the others are saved one by one
+    assert recorder.saved == [[Entry('c', 1)]]
+    assert writer.stats['dropped'] == 2
+    assert not writer._writing and not writer._pending
+    writer.put([Entry('a', 2)])
+    assert writer.flush(5)
+    assert recorder.saved[-1] == [Entry('a', 2)]
+
+
+def test_put_waits_for_room(make_writer, recorder):
+    writer = make_writer(max_pending=2)
+    recorder.gate.clear()
+    writer.put([Entry('a', 1)])
+    wait_until(lambda: writer._writing)
+    writer.put([Entry('b', 1), Entry('c', 1)])
+    putting = threading.Thread(target=writer.put, args=([Entry('d', 1)],))
+    putting.start()
+    putting.join(0.2)
+    assert putting.is_alive()
+    recorder.gate.set()
+    putting.join(5)
+    assert not putting.is_alive()
+    assert writer.flush(5)
+    assert writer.stats['blocked'] == 1
+    assert writer.stats['saved'] == 4
+
+
+@pytest.mark.filterwarnings(
+    'ignore::pytest.PytestUnhandledThreadExceptionWarning')
+def test_put_does_not_wait_for_stopped_threads(make_writer, recorder):
+    writer = make_writer(max_pending=1)
+    # stops the thread, not caught
+    recorder.errors.append(SystemExit())
+    writer.put([Entry('a', 1)])
+    wait_until(lambda: not writer._threads[0].is_alive())
+    assert not writer._writing
+    writer.put([Entry('b', 1), Entry('c', 1)])
+    assert not writer.flush()
+    assert writer.pending == 2
+
+
+def test_close_saves_the_entries_queued(make_writer, recorder):
+    writer = make_writer(workers=2)
+    recorder.gate.clear()
+    writer.put([Entry(name, 1) for name in 'abc'])
+    threading.Timer(0.1, recorder.gate.set).start()
+    writer.close()
+    assert sorted(entry.name for batch in recorder.saved
+                  for entry in batch) == ['a', 'b', 'c']
+    assert not any(thread.is_alive() for thread in writer._threads)